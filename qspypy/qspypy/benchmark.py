@@ -0,0 +1,349 @@
+# MIT License
+#
+# Copyright (c) 2018 Lotus Engineering, LLC
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+#
+# Benchmarks of qspypy's own overhead against a local UDP stand-in for QSPY
+# and the target, run with qspypy_benchmark (see main() for the options).
+#
+
+import argparse
+import asyncio
+import json
+import platform
+import socket
+import struct
+import sys
+import threading
+import time
+
+from qspypy.qspy import qspy, QSPY, QS_RX, QSpyRecords
+from qspypy.qspy_async import qspy_async
+from qspypy.qutest import qutest_context
+from qspypy.config import qutest_config
+
+
+# Seconds without a new record after which a receive benchmark stops waiting
+IDLE_SEC = 0.500
+
+# Most records flood() keeps in flight before waiting for the receiver, so
+# the socket buffer does not overflow and the receive side sets the pace
+FLOOD_WINDOW = 128
+
+# Trg-Ack names of the commands QSPY forwards for the front end
+QSPY_ACKS = {QSPY.SEND_EVENT: 'QS_RX_EVENT',
+             QSPY.SEND_LOC_FILTER: 'QS_RX_LOC_FILTER',
+             QSPY.SEND_CURR_OBJ: 'QS_RX_CURR_OBJ',
+             QSPY.SEND_COMMAND: 'QS_RX_COMMAND',
+             QSPY.SEND_TEST_PROBE: 'QS_RX_TEST_PROBE'}
+
+
+class qspy_stand_in(threading.Thread):
+    """ Local UDP stand-in for QSPY and the target.
+
+    Answers ATTACH and DETACH, acknowledges every QS_RX command with a Trg-Ack line,
+    answers RESET with a QS_TARGET_INFO record and sends text lines on
+    request with flood().
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        super().__init__(daemon=True)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((host, port))
+        self.port = self.socket.getsockname()[1]
+        self.peer = None
+        self.record_seq = 0
+        self.packet_seq = 0
+        self.received = 0
+
+    def sendRecord(self, body):
+        self.socket.sendto(bytes([self.record_seq]) + body, self.peer)
+        self.record_seq = (self.record_seq + 1) & 0xFF
+
+    def sendPacket(self, body):
+        self.socket.sendto(bytes([self.packet_seq]) + body, self.peer)
+        self.packet_seq = (self.packet_seq + 1) & 0xFF
+
+    def sendText(self, record, line):
+        self.sendRecord(bytes([QSpyRecords.QS_TEXT, record]) + line.encode('utf-8'))
+
+    def sendAck(self, name):
+        self.sendText(QSpyRecords.QS_RX_STATUS, '           Trg-Ack  ' + name)
+
+    def flood(self, count, line='0000001234 Bench===> Obj=l_bench,Sig=BENCH_SIG,State=s',
+              progress=None):
+        """ Sends count text lines as fast as the receiver takes them
+
+        Args:
+          count : number of lines
+          line : text of the lines
+          progress : callable returning how many lines the receiver got so
+                     far, at most FLOOD_WINDOW lines are sent ahead of it.
+                     None sends without waiting.
+        """
+        record = bytes([QSpyRecords.QS_TEXT, QSpyRecords.QS_USER1]) + line.encode('utf-8')
+        if progress is not None:
+            start = progress()
+        for sent in range(count):
+            if progress is not None:
+                while sent - (progress() - start) >= FLOOD_WINDOW:
+                    time.sleep(0)
+            self.sendRecord(record)
+
+    def run(self):
+        while True:
+            try:
+                data, self.peer = self.socket.recvfrom(2048)
+            except OSError:
+                return
+            self.received += 1
+            if len(data) < 2:
+                continue
+            packet_id = data[1]
+            if packet_id == QSPY.ATTACH:
+                self.sendPacket(bytes([QSPY.ATTACH]))
+            elif packet_id == QSPY.DETACH:
+                self.sendPacket(bytes([QSPY.DETACH]))
+            elif packet_id == QS_RX.RESET:
+                # Target info of a freshly reset target
+                self.sendRecord(struct.pack('< B B H 13B', QSpyRecords.QS_TARGET_INFO, 0xFF, 0x0680,
+                                            *bytes(13)))
+            elif packet_id in QSPY_ACKS:
+                self.sendAck(QSPY_ACKS[packet_id])
+            elif packet_id == QS_RX.CONTINUE:
+                self.sendAck('QS_RX_TEST_CONTINUE')
+            elif packet_id < QSPY.ATTACH and packet_id in QS_RX.__members__.values():
+                self.sendAck('QS_RX_' + QS_RX(packet_id).name)
+
+    def close(self):
+        self.socket.close()
+
+
+class record_counter():
+    """ Client counting the text records received, for the receive benchmarks """
+
+    def __init__(self):
+        self.count = 0
+        self.first = None
+        self.last = None
+
+    def OnPacket_ATTACH(self, packet):
+        pass
+
+    def OnRecord_QS_TEXT(self, packet):
+        now = time.perf_counter()
+        if self.first is None:
+            self.first = now
+        self.last = now
+        self.count += 1
+
+    def OnBatch(self, packets):
+        now = time.perf_counter()
+        if self.first is None:
+            self.first = now
+        self.last = now
+        self.count += sum(1 for packet in packets if packet[1] == QSpyRecords.QS_TEXT)
+
+    def wait(self, count):
+        """ Waits until count records arrived or none arrived for IDLE_SEC """
+        seen = -1
+        while self.count < count and self.count != seen:
+            seen = self.count
+            time.sleep(IDLE_SEC)
+
+    def result(self, sent):
+        elapsed = (self.last - self.first) if self.count > 1 else 0.0
+        return {'sent': sent, 'received': self.count, 'lost': sent - self.count,
+                'seconds': elapsed,
+                'records_per_sec': (self.count - 1) / elapsed if elapsed > 0 else None}
+
+
+def bench_rx(count, zero_copy=False, batch=False):
+    """ Records per second through the qspy receive thread """
+    stand_in = qspy_stand_in()
+    stand_in.start()
+    counter = record_counter()
+    link = qspy()
+    link.attach(counter, host='127.0.0.1', port=stand_in.port, zero_copy=zero_copy, batch=batch)
+    try:
+        time.sleep(0.100)
+        stand_in.flood(count, progress=lambda: counter.count)
+        counter.wait(count)
+    finally:
+        link.detach()
+        stand_in.close()
+    return counter.result(count)
+
+
+def bench_rx_async(count):
+    """ Records per second through the asyncio front end """
+    stand_in = qspy_stand_in()
+    stand_in.start()
+    counter = record_counter()
+
+    async def run():
+        link = qspy_async()
+        await link.attach(counter, host='127.0.0.1', port=stand_in.port)
+        loop = asyncio.get_event_loop()
+        flood = loop.run_in_executor(None, lambda: stand_in.flood(count, progress=lambda: counter.count))
+        seen = -1
+        while counter.count < count and counter.count != seen:
+            seen = counter.count
+            await asyncio.sleep(IDLE_SEC)
+        await flood
+        link.detach()
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
+    stand_in.close()
+    return counter.result(count)
+
+
+def percentiles(samples):
+    """ Summary of a list of seconds """
+    ordered = sorted(samples)
+    return {'count': len(ordered),
+            'mean': sum(ordered) / len(ordered),
+            'p50': ordered[len(ordered) // 2],
+            'p99': ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))],
+            'max': ordered[-1]}
+
+
+def bench_expect(context, stand_in, count):
+    """ Lines per second matched by expect() and expect_sequence() from a full text queue """
+    line = '0000001234 Bench===> Obj=l_bench,Sig=BENCH_SIG,State=s'
+    match = '%timestamp Bench===> Obj=l_bench,Sig=BENCH_SIG,State=s'
+    result = {}
+    for name in ('expect', 'expect_sequence'):
+        stand_in.flood(count, line, progress=lambda: len(context.text_queue))
+        seen = -1
+        while len(context.text_queue) < count and len(context.text_queue) != seen:
+            seen = len(context.text_queue)
+            time.sleep(0.050)
+        queued = len(context.text_queue)
+
+        start = time.perf_counter()
+        if name == 'expect':
+            for _ in range(queued):
+                context.expect(match)
+        else:
+            context.expect_sequence([match] * queued)
+        elapsed = time.perf_counter() - start
+        result[name] = {'lines': queued, 'seconds': elapsed,
+                        'lines_per_sec': queued / elapsed if elapsed > 0 else None}
+    return result
+
+
+def bench_commands(context, count):
+    """ Round trip of lock-step commands and throughput of pipelined ones """
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        context.tick()
+        samples.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with context.pipeline():
+        for _ in range(count):
+            context.tick()
+    elapsed = time.perf_counter() - start
+    return {'lock_step_rtt': percentiles(samples),
+            'pipelined': {'commands': count, 'seconds': elapsed,
+                          'commands_per_sec': count / elapsed if elapsed > 0 else None}}
+
+
+def bench_resets(context, count):
+    """ Time of a complete reset_target() cycle """
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        context.reset_target()
+        samples.append(time.perf_counter() - start)
+    return percentiles(samples)
+
+
+def run_benchmarks(records=20000, lines=2000, commands=500, resets=50):
+    """ Runs every benchmark
+
+    Returns:
+      dict of results, see main()
+    """
+    results = {'rx': {'thread': bench_rx(records),
+                      'zero_copy': bench_rx(records, zero_copy=True),
+                      'batch': bench_rx(records, zero_copy=True, batch=True),
+                      'async': bench_rx_async(records)}}
+
+    # qutest against the stand-in, without touching the user's cache
+    stand_in = qspy_stand_in()
+    stand_in.start()
+    config = qutest_config(AUTOSTART_QSPY=False, USE_LOCAL_TARGET=False, CACHE_DIR=None,
+                           QSPY_HOST='127.0.0.1', QSPY_UDP_PORT=stand_in.port, QSPY_LOCAL_UDP_PORT=None)
+    config.TEXT_BUFFER_SIZE = max(config.TEXT_BUFFER_SIZE, lines)
+
+    context = qutest_context(config)
+    context.session_setup()
+    try:
+        context.reset_target()
+        results['expect'] = bench_expect(context, stand_in, lines)
+        results['commands'] = bench_commands(context, commands)
+        results['reset'] = bench_resets(context, resets)
+    finally:
+        context.session_teardown()
+        stand_in.close()
+    results['detach_join_seconds'] = context.qspy.join_time
+    return results
+
+
+def main():
+    """ Entry point for qspypy_benchmark, prints or saves the results as JSON """
+    parser = argparse.ArgumentParser(
+        description='Measures qspypy overhead against a local QSPY/target stand-in')
+    parser.add_argument('--records', type=int, default=20000,
+                        help='records flooded per receive benchmark (default 20000)')
+    parser.add_argument('--lines', type=int, default=2000,
+                        help='lines matched per expect benchmark (default 2000)')
+    parser.add_argument('--commands', type=int, default=500,
+                        help='commands per command benchmark (default 500)')
+    parser.add_argument('--resets', type=int, default=50,
+                        help='target resets for the reset benchmark (default 50)')
+    parser.add_argument('--output', help='file to write the JSON results to (default stdout)')
+    args = parser.parse_args()
+
+    report = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'parameters': {'records': args.records, 'lines': args.lines,
+                             'commands': args.commands, 'resets': args.resets},
+              'results': run_benchmarks(args.records, args.lines, args.commands, args.resets)}
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+
+
+if __name__ == "__main__":
+    main()
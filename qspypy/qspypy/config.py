@@ -25,6 +25,8 @@
 # via another test start script
 #
 
+import os
+
 
 #### QSpy settings  ####
 # Set to true have QSpy automatically start/stop at the beginning/end of a test session
@@ -39,6 +41,9 @@ QSPY_COM_PORT = 'COM1'
 # MODIFY FOR YOUR REMOTE TARGET
 QSPY_BAUD_RATE = 115200
 
+# TCP port qspy listens on for local targets, used when AUTO_START_QSPY is true
+QSPY_TCP_PORT = 6601
+
 # The UDP port to connect to qpsy on
 QSPY_UDP_PORT = 7701
 
@@ -49,12 +54,41 @@ QSPY_LOCAL_UDP_PORT = None
 # The host machine that qspy is on
 QSPY_HOST = 'localhost'
 
+# How long to wait at the end of a session for qspy to answer the DETACH,
+# 0 to detach without waiting (not every qspy version answers it)
+QSPY_DETACH_CONFIRM_SEC = 0.0
+
+# Receive qspy packets into a reused buffer instead of allocating one per datagram
+QSPY_RX_ZERO_COPY = False
+
+# Drain all pending qspy datagrams per wakeup and handle them as one batch
+QSPY_RX_BATCH = False
+
+# Most received text lines held for expect(), lines beyond this are dropped
+# and the next expect() fails reporting the overflow
+TEXT_BUFFER_SIZE = 4096
+
+# Which line is dropped when the text buffer is full, 'drop_oldest' or 'drop_newest'
+TEXT_BUFFER_OVERFLOW = 'drop_oldest'
+
+# Index the target dictionaries locally so named signals, objects and functions
+# are sent straight to the target instead of being resolved by qspy.  qutest
+# then attaches to the binary channel as well, qspy only forwards the
+# dictionary records there
+LOCAL_DICTIONARY = False
+
+# Directory where qspypy keeps what it learns for later sessions: the local
+# dictionary per target build, the expect latency profile, the qutest_shard
+# test durations and the reset scheduler history. None (default) keeps nothing
+CACHE_DIR = None
+
 
 ###### Local host settings ######
 # Set to true to launch and connect to a local target
 USE_LOCAL_TARGET = False
 
-# Set to the IP address of where the QSpy resides (normally the local host)
+# Set to the IP address of where the QSpy resides (normally the local host),
+# optionally followed by :port when QSPY_TCP_PORT is not the default
 LOCAL_TARGET_QSPY_HOST = 'localhost'
 
 # Set this to the target executible name (e.g. test_dpp), target must be on system path
@@ -63,16 +97,104 @@ LOCAL_TARGET_EXECUTABLE = 'test_dpp'
 # Set this to true to have the target start in a console
 LOCAL_TARGET_USES_CONSOLE = False
 
+# Number of spare local target processes kept started and waiting at the
+# QSPY connection, so a reset swaps one in instead of starting a new one
+# (0 starts a fresh target on every reset)
+LOCAL_TARGET_POOL_SIZE = 0
+
 
 ###### Misc. settings ##########
 # How long to wait for expect calls to return (was TIMEOUT_MS in qutest.tcl)
 EXPECT_TIMEOUT_SEC = 0.500
 
+# Send stimulus commands back-to-back and match their Trg-Ack lines as they
+# arrive instead of waiting for each one, use qutest.pipeline() to pipeline
+# only part of a test
+PIPELINE_COMMANDS = False
+
+# Fail a test on received lines that no expect() consumed, checked before each
+# command sent to the target and at teardown
+EXPECT_STRICT = False
+
+# Derive each expect timeout from the waits recorded for its match string in
+# this and earlier sessions (saved in CACHE_DIR), EXPECT_TIMEOUT_SEC
+# stays the upper bound
+ADAPTIVE_EXPECT_TIMEOUT = False
+
+# Percentile of the recorded waits an adaptive expect timeout covers
+EXPECT_TIMEOUT_PERCENTILE = 99.0
+
+# Seconds added to the percentile for an adaptive expect timeout
+EXPECT_TIMEOUT_MARGIN_SEC = 0.050
+
 # Reset the target on every test setUp call that uses the qutest fixture
 RESET_TARGET_ON_SETUP = True
 
+# Skip the reset of a qutest test when the target is still as the last reset
+# left it and order each module's tests to make that happen more often, needs
+# the qspypy.qutest_scheduler plugin (loaded by qutest)
+MINIMIZE_RESETS = False
+
 # How long we wait for the target to come up and send the target info record
 TARGET_START_TIMEOUT_SEC = 1.000
 
 # How long we wait for the QSPY to come up
 QSPY_ATTACH_TIMEOUT_SEC = 1.0
+
+
+###### Environment overrides ######
+# Any setting above can be set with a QSPYPY_<NAME> environment variable
+# (e.g. QSPYPY_QSPY_UDP_PORT=7702), qutest_shard uses this to give each of its
+# workers its own QSPY, target and ports
+ENVIRONMENT_PREFIX = 'QSPYPY_'
+
+def environment_value(text, default):
+    """ Converts an environment variable to the type of the setting's default """
+    if text == 'None':
+        return None
+    if isinstance(default, bool):
+        return text.strip().lower() in ('1', 'true', 'yes', 'on')
+    if isinstance(default, int):
+        return int(text)
+    if isinstance(default, float):
+        return float(text)
+    if default is None and text.isdigit():
+        return int(text)
+    return text
+
+for _name, _default in list(globals().items()):
+    if _name.isupper() and ENVIRONMENT_PREFIX + _name in os.environ:
+        globals()[_name] = environment_value(os.environ[ENVIRONMENT_PREFIX + _name], _default)
+
+
+###### Per context settings ######
+def setting_names():
+    """ Returns the names of the settings in this module """
+    return [name for name in globals() if name.isupper() and name != 'ENVIRONMENT_PREFIX']
+
+class qutest_config():
+    """ The settings of one qutest_context.
+
+    Starts from the module settings above (as changed by conftest.py or a
+    start script), overlaid by the QSPYPY_<NAME> environment variables and
+    then by the keyword overrides, e.g. qutest_config(QSPY_UDP_PORT=7702).
+    Contexts with their own qutest_config can talk to different QSPY
+    instances and targets in one process.
+    """
+
+    def __init__(self, **overrides):
+        settings = globals()
+        for name in setting_names():
+            value = settings[name]
+            if ENVIRONMENT_PREFIX + name in os.environ:
+                value = environment_value(os.environ[ENVIRONMENT_PREFIX + name], value)
+            setattr(self, name, value)
+        self.update(**overrides)
+
+    def update(self, **overrides):
+        """ Changes settings, raises TypeError for names that are not settings """
+        names = setting_names()
+        for name, value in overrides.items():
+            if name not in names:
+                raise TypeError("Unknown qspypy setting '{0}'".format(name))
+            setattr(self, name, value)
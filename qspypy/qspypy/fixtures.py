@@ -26,15 +26,47 @@
 #
 import pytest
 from qspypy.qutest import qutest_context
-import qspypy.config as CONFIG
+from qspypy.config import qutest_config
+
+
+class session_summary():
+    """ pytest plugin adding the qutest session results to the terminal summary """
+
+    def __init__(self, context):
+        self.context = context
+
+    def pytest_terminal_summary(self, terminalreporter):
+        lines = self.context.session_summary()
+        if lines:
+            terminalreporter.section('qspypy')
+            for line in lines:
+                terminalreporter.write_line(line)
+
+
+class session_config():
+    """ pytest plugin handing the settings from the qutest command line to the session """
+
+    def __init__(self, overrides):
+        self.overrides = overrides
 
 
 @pytest.fixture(scope='session')
-def session():
+def session(request):
     """ test fixture for a complete session (all test files)"""
 
+    # The module settings (as changed by conftest.py) with the overrides
+    # from the qutest command line
+    overrides = {}
+    for plugin in request.config.pluginmanager.get_plugins():
+        if isinstance(plugin, session_config):
+            overrides = plugin.overrides
+
     # Create the one and only qutest_context used through out the session
-    context = qutest_context()
+    context = qutest_context(qutest_config(**overrides))
+    scheduler = request.config.pluginmanager.get_plugin('qspypy_reset_scheduler')
+    if scheduler is not None and scheduler.enabled:
+        scheduler.set_context(context)
+    request.config.pluginmanager.register(session_summary(context), 'qspypy_session_summary')
 
     # Do the context setup
     context.session_setup()
@@ -70,15 +102,19 @@ def module(session, request):
 
 
 @pytest.fixture
-def reset(module):
+def reset(module, request):
     """ Fixture used for resetting the target, Internal use only"""
-    if CONFIG.RESET_TARGET_ON_SETUP:
-        module.call_on_reset()
+    module.rx_snapshot()
+    if module.config.RESET_TARGET_ON_SETUP:
+        if module.scheduler is not None:
+            module.scheduler.reset(module, request.node)
+        else:
+            module.call_on_reset()
     return module
 
 
 @pytest.fixture()
-def qutest(reset):
+def qutest(reset, request):
     """ Default test fixture for each test function.
 
     This will reset the target before each test unless
@@ -86,24 +122,33 @@ def qutest(reset):
     """
 
     # Setup
+    reset.test_started()
     reset.call_on_setup()
 
     # Run Test
     yield reset
 
     # Teardown
-    reset.call_on_teardown()
+    try:
+        reset.call_on_teardown()
+    finally:
+        request.node.add_report_section('teardown', 'qspy rx', reset.rx_report())
 
 
 @pytest.fixture()
-def qutest_noreset(session):
+def qutest_noreset(session, request):
     """ Test fixture for each test function that does NOT reset the target. """
 
     # Setup
+    session.rx_snapshot()
+    session.test_started()
     session.call_on_setup()
 
     # Run Test
     yield session
 
     # Teardown
-    session.call_on_teardown()
+    try:
+        session.call_on_teardown()
+    finally:
+        request.node.add_report_section('teardown', 'qspy rx', session.rx_report())
@@ -21,10 +21,12 @@
 # SOFTWARE.
 
 from enum import IntFlag, IntEnum
+import selectors
 import socket
 import struct
 import time
 import threading
+from collections import deque
 
 
 # Enumeration for packet IDs that are interpreted by QSPY
@@ -237,6 +239,22 @@ theFmt = {
 }
 
 
+# Largest datagram read from QSPY
+RX_PACKET_SIZE = 1024
+
+# Most datagrams drained from the socket per wakeup in batch receive mode
+RX_BATCH_SIZE = 64
+
+# Longest time the batch receive loop waits before rechecking that it is alive
+RX_POLL_SEC = 0.100
+
+# Number of sequence gaps remembered for the rx telemetry
+RX_LOSS_HISTORY = 256
+
+# Sequence gaps closer together than this are reported as one loss burst
+RX_LOSS_BURST_SEC = 0.050
+
+
 # Special priority values used to send commands
 class PRIO_COMMAND(IntEnum):
     PUBLISH = 0,         # Publish event
@@ -246,119 +264,445 @@ class PRIO_COMMAND(IntEnum):
     POST = 253           # post event to the Current Object (AO)
 
 
-class qspy(threading.Thread):
+# Largest packet sent to QSPY without growing the transmit buffer
+TX_PACKET_SIZE = 1024
+
+# Most distinct events kept encoded by sendEvent
+EVENT_CACHE_SIZE = 64
+
+
+class packet_layouts():
+    """ Packet layouts for the qspy send methods compiled from theFmt.
+
+    The layouts only change with theFmt, use set_fmt() to change it or call
+    refresh_fmt() after modifying theFmt directly (qspy.attach() does this).
+    """
+
+    def __init__(self):
+        self.formats = None
+        self.compile()
+
+    def refresh(self):
+        """ Recompiles the layouts if theFmt changed since the last compile """
+        if self.formats != theFmt:
+            self.compile()
+
+    def compile(self):
+        """ Builds every packet layout from the current theFmt """
+        self.formats = dict(theFmt)
+        # Bodies sent as encoded, keyed by sendEvent arguments
+        self.events = {}
+
+        self.attach = struct.Struct('< B B')
+        self.obj = struct.Struct('< B B ' + theFmt['objPtr'])
+        self.glb_filter = struct.Struct('< B B L L L L')
+        self.fill = {1: struct.Struct('< B H B B B'),
+                     2: struct.Struct('< B H B B H'),
+                     4: struct.Struct('< B H B B I')}
+        self.peek = struct.Struct('< B H B B')
+        self.command = struct.Struct('< B B I I I')
+        self.test_probe = struct.Struct('< B I' + theFmt['funPtr'])
+        self.tick = struct.Struct('< B B')
+        self.event = struct.Struct('< B B ' + theFmt['sig'] + 'h')
+
+        # Packets without parameters
+        self.detach = bytes([QSPY.DETACH])
+        self.save_dict = bytes([QSPY.SAVE_DICT])
+        self.reset = bytes([QS_RX.RESET])
+        self.resume = bytes([QS_RX.CONTINUE])
+        self.setup = bytes([QS_RX.TEST_SETUP])
+        self.teardown = bytes([QS_RX.TEST_TEARDOWN])
+
+    def encodeEvent(self, ao_priority, signal, parameters, signal_name):
+        """ Encodes and caches the body of an event packet
+
+        Args:
+            ao_priority : ao priority or one of the PRIO_COMMAND enums
+            signal : integer signal value, or the name when signal_name is given
+            parameters : bytes of payload or None
+            signal_name : None to send to the target, or the zero terminated
+                          name for QSPY to resolve
+        """
+        length = 0 if parameters is None else len(parameters)
+        if signal_name is None:
+            body = bytearray(self.event.pack(QS_RX.EVENT, ao_priority, signal, length))
+        else:
+            body = bytearray(self.event.pack(QSPY.SEND_EVENT, ao_priority, 0, length))
+        if parameters is not None:
+            body.extend(parameters)
+        if signal_name is not None:
+            body.extend(signal_name)
+        body = bytes(body)
+
+        if len(self.events) >= EVENT_CACHE_SIZE:
+            del self.events[next(iter(self.events))]
+        self.events[(int(ao_priority), signal, parameters)] = body
+        return body
+
+
+# Layouts used by all qspy instances
+layouts = packet_layouts()
+
+
+def set_fmt(**formats):
+    """ Changes port specific formats in theFmt and recompiles the packet layouts
+
+    Example: set_fmt(objPtr='Q', funPtr='Q') for a 64 bit target
+    """
+    theFmt.update(formats)
+    refresh_fmt()
+
+
+def refresh_fmt():
+    """ Recompiles the packet layouts and the binary decoder if theFmt changed """
+    layouts.refresh()
+    # qspy_binary imports this module, so it can only be imported here
+    from qspypy.qspy_binary import decoder
+    decoder.refresh()
+
+
+class qs_text_record():
+    """ A received QS_TEXT packet kept as bytes, the line is decoded on first use
+
+    Attributes:
+      data : the packet bytes, the line starts at LINE_OFFSET
+    """
+    __slots__ = ('data', 'decoded')
+
+    # Offset of the line after the sequence, QS_TEXT and record ID bytes
+    LINE_OFFSET = 3
+
+    def __init__(self, packet):
+        self.data = bytes(packet)
+        self.decoded = None
+
+    @property
+    def record_id(self):
+        """ ID of the record QSPY formatted the line from """
+        return self.data[2]
+
+    @property
+    def record(self):
+        """ QSpyRecords member of the record QSPY formatted the line from """
+        return QSpyRecords(self.data[2])
+
+    @property
+    def line(self):
+        """ The decoded line """
+        if self.decoded is None:
+            self.decoded = str(self.data[3:], 'utf-8')
+        return self.decoded
+
+    def __bytes__(self):
+        return self.data
+
+    def __repr__(self):
+        return 'qs_text_record({0!r})'.format(self.data)
+
+
+def record_name(recordID):
+    """ Returns the QSpyRecords or QSPY name of a record/packet ID """
+    try:
+        if recordID < 128:
+            return QSpyRecords(recordID).name
+        return QSPY(recordID).name
+    except ValueError:
+        return str(recordID)
+
+
+def rx_stats_delta(before, after):
+    """ Returns the rxStats() telemetry accumulated between two snapshots """
+    delta = {}
+    for key, value in after.items():
+        if key == 'records':
+            delta[key] = {name: count - before[key].get(name, 0)
+                          for name, count in value.items()
+                          if count != before[key].get(name, 0)}
+        elif key == 'bursts':
+            delta[key] = [burst for burst in value if burst[1] >= before['time']]
+        else:
+            delta[key] = value - before[key]
+    return delta
+
+
+def format_rx_stats(stats):
+    """ Formats rxStats() or rx_stats_delta() telemetry as readable lines """
+    lines = ['{0} datagrams, {1} bytes in {2:.3f}s, {3} unhandled'.format(
+        stats['datagrams'], stats['bytes'], stats['time'], stats['unhandled'])]
+    lines.append('sequence errors: records {0} ({1} lost), packets {2} ({3} lost)'.format(
+        stats['record_errors'], stats['records_lost'],
+        stats['packet_errors'], stats['packets_lost']))
+    for start, end, records_lost, packets_lost in stats['bursts']:
+        lines.append('loss burst at {0:.3f}s-{1:.3f}s: {2} records, {3} packets'.format(
+            start, end, records_lost, packets_lost))
+    for name, count in sorted(stats['records'].items(), key=lambda item: -item[1]):
+        lines.append('  {0:<24} {1}'.format(name, count))
+    return '\n'.join(lines)
+
+
+class qspy_base():
+    """ QSPY front end protocol shared by the qspy thread and other transports.
+
+    Derived classes provide the transport by implementing transmit() and
+    feeding every received datagram to process_packet().
+    """
 
     def __init__(self):
         super().__init__()
         self.tx_packet_seq = 0
-        self.socket = None
-        self.alive = threading.Event()
+        self.tx_buffer = bytearray(TX_PACKET_SIZE)
+        self.tx_view = memoryview(self.tx_buffer)
+        self.client = None
+        self.handlers = None
+        self.batch_handler = None
+        self.dictionary = None
         self.rx_packet_seq = 0
         self.rx_packet_errors = 0
         self.rx_record_seq = 0
         self.rx_record_errors = 0
+        self.rx_unhandled = 0
+        # rx telemetry, see rxStats()
+        self.rx_start = time.monotonic()
+        self.rx_bytes = 0
+        self.rx_counts = [0] * 256
+        self.rx_records_lost = 0
+        self.rx_packets_lost = 0
+        self.rx_losses = deque(maxlen=RX_LOSS_HISTORY)
+
+    def process_packet(self, packet):
+        """ Checks the sequence number of a received packet and dispatches it
 
-    def __del__(self):
-        if self.socket is not None:
-            self.socket.close
+        Arguments:
+        packet -- the received datagram (bytes, bytearray or memoryview)
+        """
+        if len(packet) < 2:
+            return
+
+        rx_sequence = packet[0]
+        recordID = packet[1]
+        self.rx_bytes += len(packet)
+        self.rx_counts[recordID] += 1
+
+        if recordID < 128:
+            if self.rx_record_seq != rx_sequence:
+                self.lostRecords((rx_sequence - self.rx_record_seq) & 0xFF)
+                self.rx_record_seq = rx_sequence  # resync
+            self.rx_record_seq += 1
+            self.rx_record_seq &= 0xFF
+        else:
+            if self.rx_packet_seq != rx_sequence:
+                self.lostPackets((rx_sequence - self.rx_packet_seq) & 0xFF)
+                self.rx_packet_seq = rx_sequence  # resync
+            self.rx_packet_seq += 1
+            self.rx_packet_seq &= 0xFF
 
-    # Socket receive thread
-    def run(self):
-        while self.alive.isSet():
-            try:
-                packet = self.socket.recv(1024)
-                if len(packet) < 2:
-                    continue
+        #print("Seq:{0}, {1}({2})".format(rx_sequence, recordID, packet.hex()))
 
-                rx_sequence = packet[0]
-                recordID = packet[1]
-
-                if recordID < 128:
-                    method_name = "OnRecord_" + QSpyRecords(recordID).name
-                    if self.rx_record_seq != rx_sequence:
-                        print("Rx Record sequence error!")
-                        self.rx_record_errors += 1
-                        self.rx_record_seq = rx_sequence  # resync
-                    self.rx_record_seq += 1
-                    self.rx_record_seq &= 0xFF
-                else:
-                    method_name = "OnPacket_" + QSPY(recordID).name
-                    if self.rx_packet_seq != rx_sequence:
-                        print("Rx Packet sequence error!")
-                        self.rx_packet_errors += 1
-                        self.rx_packet_seq = rx_sequence  # resync
-                    self.rx_packet_seq += 1
-                    self.rx_packet_seq &= 0xFF
+        # Call client callback with packet
+        self.handlers[recordID](packet)
 
-                #print("Seq:{0}, {1}({2})".format(rx_sequence, method_name, packet.hex()))
+    def process_batch(self, packets):
+        """ Checks the sequence numbers of a batch of received packets and dispatches them
 
-                try:
-                    method = getattr(self.client, method_name)
-                    # Call client callback with packet
-                    method(packet)
+        The batch is handed to client.OnBatch(packets) in one call when the
+        client implements it, otherwise each packet goes to its handler.
 
-                except AttributeError:
-                    raise NotImplementedError("Class `{}` does not implement `{}`".format(
-                        self.client.__class__.__name__, method_name))
+        Arguments:
+        packets -- list of received datagrams (bytes, bytearray or memoryview)
+        """
+        record_seq = self.rx_record_seq
+        packet_seq = self.rx_packet_seq
+        rx_bytes = 0
+        counts = self.rx_counts
+
+        # OnBatch gets the packets without going through the handler table
+        on_batch = self.batch_handler is not None
+
+        batch = []
+        for packet in packets:
+            if len(packet) < 2:
+                continue
+            rx_sequence = packet[0]
+            recordID = packet[1]
+            rx_bytes += len(packet)
+            counts[recordID] += 1
+            if recordID < 128:
+                if record_seq != rx_sequence:
+                    self.lostRecords((rx_sequence - record_seq) & 0xFF)
+                record_seq = (rx_sequence + 1) & 0xFF
+            else:
+                if packet_seq != rx_sequence:
+                    self.lostPackets((rx_sequence - packet_seq) & 0xFF)
+                packet_seq = (rx_sequence + 1) & 0xFF
+                if on_batch and recordID == QSPY.DETACH:
+                    self.detachReceived()
+            batch.append(packet)
+
+        self.rx_record_seq = record_seq
+        self.rx_packet_seq = packet_seq
+        self.rx_bytes += rx_bytes
+
+        if self.batch_handler is not None:
+            if self.dictionary is not None:
+                for packet in batch:
+                    self.dictionary.add_packet(packet)
+            self.batch_handler(batch)
+        else:
+            handlers = self.handlers
+            for packet in batch:
+                handlers[packet[1]](packet)
 
-            except IOError as e:
-                # We expect this for now until we refactor the detach()
-                #print("QSpy Socket error:", str(e) )
-                e
-                pass
+    def detachReceived(self):
+        """ Called when QSPY answers a DETACH, before the client sees the packet """
+        pass
 
-    @classmethod
-    def parse_QS_TEXT(cls, packet):
-        """ Returns a tuple of (record, line) of types QSpyRecords, string respectively
+    def lostRecords(self, gap):
+        """ Accounts for a gap in the record sequence numbers
+
+        Arguments:
+        gap -- number of records missing, modulo 256 as the sequence is 8 bits
         """
-        assert QSpyRecords(
-            packet[1]) == QSpyRecords.QS_TEXT, "Wronge record type for parser"
-        return (QSpyRecords(packet[2]), packet[3:].decode("utf-8"))
+        print("Rx Record sequence error! {0} lost".format(gap))
+        self.rx_record_errors += 1
+        self.rx_records_lost += gap
+        self.rx_losses.append((time.monotonic(), gap, 0))
 
-    def attach(self, client, host='localhost', port=7701, channels=QS_CHANNEL.TEXT, local_port=None):
-        """ Attach to the QSpy backend
+    def lostPackets(self, gap):
+        """ Accounts for a gap in the QSPY packet sequence numbers
 
-        Keyword arguments:
-        host -- host IP address of QSpy (default 'localhost')
-        port -- socket port of QSpy (default 7701)
-        channels -- what channels to attach to (default QPChannels.TEXT)
-        local_port -- the local/client port to use (default None for automatic)
+        Arguments:
+        gap -- number of packets missing, modulo 256 as the sequence is 8 bits
+        """
+        print("Rx Packet sequence error! {0} lost".format(gap))
+        self.rx_packet_errors += 1
+        self.rx_packets_lost += gap
+        self.rx_losses.append((time.monotonic(), 0, gap))
+
+    def rxStats(self):
+        """ Returns a snapshot of the receive telemetry
+
+        Returns:
+          A dict with the seconds since the front end was created ('time'),
+          'bytes' and 'datagrams' received, 'records' counts by record or
+          packet name, 'unhandled', the sequence error and lost counts for
+          records and packets, and 'bursts' - a list of
+          (start, end, records_lost, packets_lost) with times in seconds
+          like 'time', merging gaps closer than RX_LOSS_BURST_SEC.
+        """
+        counts = list(self.rx_counts)
+        records = {}
+        for recordID, count in enumerate(counts):
+            if count:
+                records[record_name(recordID)] = count
+
+        bursts = []
+        for when, records_lost, packets_lost in list(self.rx_losses):
+            when -= self.rx_start
+            if bursts and when - bursts[-1][1] <= RX_LOSS_BURST_SEC:
+                start, _, burst_records, burst_packets = bursts[-1]
+                bursts[-1] = (start, when, burst_records + records_lost,
+                              burst_packets + packets_lost)
+            else:
+                bursts.append((when, when, records_lost, packets_lost))
+
+        return {'time': time.monotonic() - self.rx_start,
+                'bytes': self.rx_bytes,
+                'datagrams': sum(counts),
+                'records': records,
+                'unhandled': self.rx_unhandled,
+                'record_errors': self.rx_record_errors,
+                'records_lost': self.rx_records_lost,
+                'packet_errors': self.rx_packet_errors,
+                'packets_lost': self.rx_packets_lost,
+                'bursts': bursts}
+
+    def build_handlers(self, client):
+        """ Builds the table of client callbacks indexed by record/packet ID
+
+        Every QSpyRecords member is mapped to client.OnRecord_<name> and every
+        QSPY member to client.OnPacket_<name>.  IDs the client does not handle
+        (including IDs unknown to this module) go to client.OnUnhandled if
+        defined, otherwise to onUnhandled() which just counts them.
+
+        Returns:
+          A 256 entry list of callables taking the raw packet
         """
+        fallback = getattr(client, "OnUnhandled", self.onUnhandled)
+        handlers = [fallback] * 256
 
-        # Store client for callback
-        self.client = client
+        for record in QSpyRecords:
+            handlers[record.value] = getattr(
+                client, "OnRecord_" + record.name, fallback)
 
-        # Store address info
-        self.host = host
-        self.port = port
-        self.channels = channels
-        self.local_port = local_port
+        for packet_id in QSPY:
+            handlers[packet_id.value] = getattr(
+                client, "OnPacket_" + packet_id.name, fallback)
 
-        # Create socket and connect
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        if local_port is not None:
-            self.socket.bind(('', local_port))
-        self.socket.connect((host, port))
+        return handlers
 
-        # Start receive thread
-        self.alive.set()
-        self.start()
+    def setDictionary(self, dictionary):
+        """ Installs a dictionary index that is fed from the received records
 
-        self.sendAttach(channels)
+        Must be called after the client handlers are built (i.e. by attach).
+        QSPY only forwards the dictionary records on QS_CHANNEL.BINARY.
+        With a dictionary, send methods given a name send the binary QS_RX
+        packet directly when the name resolves instead of asking QSPY.
 
-    def detach(self):
-        self.alive.clear()
-        self.sendPacket(struct.pack('< B', QSPY.DETACH.value))
-        time.sleep(0.300)
-        self.socket.shutdown(socket.SHUT_RDWR)
-        self.socket.close()
-        self.socket = None
-        self.client = None
-        threading.Thread.join(self)
+        Arguments:
+        dictionary -- a qspy_dict.qs_dictionary or None to remove it
+        """
+        self.dictionary = dictionary
+        if dictionary is None:
+            return
+
+        def tap(handler, add=dictionary.add_packet):
+            def dictionary_handler(packet):
+                add(packet)
+                handler(packet)
+            return dictionary_handler
+
+        for record in (QSpyRecords.QS_SIG_DICT, QSpyRecords.QS_OBJ_DICT,
+                       QSpyRecords.QS_FUN_DICT, QSpyRecords.QS_USR_DICT):
+            self.handlers[record] = tap(self.handlers[record])
+
+    def resolve(self, kind, key):
+        """ Resolves a dictionary name with the dictionary index
+
+        Arguments:
+        kind -- 'signal', 'object', 'function' or 'user'
+        key -- dictionary name or integer value
+
+        Returns:
+          the integer value, or key unchanged when it is already an integer,
+          there is no dictionary index or the name is not in it
+        """
+        if self.dictionary is None or isinstance(key, int):
+            return key
+        value = getattr(self.dictionary, kind)(key)
+        return key if value is None else value
+
+    def onUnhandled(self, packet):
+        """ Default handler for records and packets the client does not implement """
+        self.rx_unhandled += 1
+
+    @classmethod
+    def parse_QS_TEXT(cls, packet):
+        """ Returns a tuple of (record, line) of types QSpyRecords, string respectively
+
+        The packet may be bytes, bytearray or a memoryview from a zero copy receive
+        """
+        if isinstance(packet, qs_text_record):
+            return (packet.record, packet.line)
+        assert QSpyRecords(
+            packet[1]) == QSpyRecords.QS_TEXT, "Wronge record type for parser"
+        return (QSpyRecords(packet[2]), str(packet[3:], "utf-8"))
 
     def sendAttach(self, channels):
-        self.sendPacket(struct.pack(
-            '< B B', QSPY.ATTACH.value, channels.value))
+        layouts.attach.pack_into(self.tx_buffer, 1, QSPY.ATTACH, channels)
+        self.sendBuffer(1 + layouts.attach.size)
+
+    def sendDetach(self):
+        self.sendBody(layouts.detach)
 
     def sendLocalFilter(self, object_kind, object_id):
         """ Sends a local filter
@@ -369,19 +713,8 @@ class qspy(threading.Thread):
         """
         assert isinstance(object_kind, QS_OBJ_KIND)
 
-        format_string = '< B B ' + theFmt['objPtr']
-
-        if isinstance(object_id, int):
-            # Send directly to Target
-            packet = struct.pack(
-                format_string, QS_RX.LOC_FILTER, object_kind.value, object_id)
-        else:
-            # Have QSpy interpret object_id string and send filter
-            packet = bytearray(struct.pack(
-                format_string, QSPY.SEND_LOC_FILTER, object_kind.value, 0))
-            packet.extend(qspy.string_to_binary(object_id))
-
-        self.sendPacket(packet)
+        object_id = self.resolve('object', object_id)
+        self.sendObject(QS_RX.LOC_FILTER, QSPY.SEND_LOC_FILTER, object_kind, object_id)
 
     def sendGlobalFilters(self, *args):
 
@@ -436,128 +769,125 @@ class qspy(threading.Thread):
             else:
                 assert 0, 'invalid filter group'
 
-        self.sendPacket(struct.pack(
-            '< B B L L L L', QS_RX.GLB_FILTER,  16, filter0, filter1, filter2, filter3))
+        layouts.glb_filter.pack_into(self.tx_buffer, 1, QS_RX.GLB_FILTER, 16,
+                                     filter0, filter1, filter2, filter3)
+        self.sendBuffer(1 + layouts.glb_filter.size)
 
     def sendFill(self, offset, size, num, item):
         """ Sends fill packet """
 
-        if size == 1:
-            item_fmt = 'B'
-        elif size == 2:
-            item_fmt = 'H'
-        elif size == 4:
-            item_fmt = 'I'
-        else:
-            assert False, "size for sendFill must be 1, 2, or 4!"
-
-        format_string = '< B H B B ' + item_fmt
-        packet = struct.pack(format_string, QS_RX.FILL, offset, size, num, item)
-        self.sendPacket(packet)
+        assert size in layouts.fill, "size for sendFill must be 1, 2, or 4!"
+        layout = layouts.fill[size]
+        layout.pack_into(self.tx_buffer, 1, QS_RX.FILL, offset, size, num, item)
+        self.sendBuffer(1 + layout.size)
 
     def sendPeek(self, offset, size, num):
         """ Sends poke packet """
 
-        format_string = '< B H B B' 
-        packet = struct.pack(format_string, QS_RX.PEEK, offset, size, num)
-        self.sendPacket(packet)
+        layouts.peek.pack_into(self.tx_buffer, 1, QS_RX.PEEK, offset, size, num)
+        self.sendBuffer(1 + layouts.peek.size)
     
     def sendPoke(self, offset, size, num, data):
         """ Sends peek packet """
 
-        format_string = '< B H B B ' 
-        packet = bytearray(struct.pack(format_string, QS_RX.POKE, offset, size, num))
-        packet.extend(data)
-        self.sendPacket(packet)
+        layouts.peek.pack_into(self.tx_buffer, 1, QS_RX.POKE, offset, size, num)
+        self.sendBuffer(self.putBuffer(1 + layouts.peek.size, data))
 
     def sendCommand(self, command_id, param1=0, param2=0, param3=0):
         """ Sends command packet """
 
-        format_string = '< B B I I I'
+        command_id = self.resolve('user', command_id)
+
         if isinstance(command_id, int):
-            packet = struct.pack(format_string, QS_RX.COMMAND,
-                                 command_id, param1, param2, param3)
+            layouts.command.pack_into(self.tx_buffer, 1, QS_RX.COMMAND,
+                                      command_id, param1, param2, param3)
+            self.sendBuffer(1 + layouts.command.size)
         else:
-            packet = bytearray(struct.pack(
-                format_string, QSPY.SEND_COMMAND, 0, param1, param2, param3))
+            layouts.command.pack_into(self.tx_buffer, 1, QSPY.SEND_COMMAND,
+                                      0, param1, param2, param3)
             # Add string command ID to end
-            packet.extend(qspy.string_to_binary(command_id))
-        self.sendPacket(packet)
+            self.sendBuffer(self.putBuffer(1 + layouts.command.size,
+                                           self.string_to_binary(command_id)))
 
     def sendCurrentObject(self, object_kind, object_id):
 
-        format_string = '< B B ' + theFmt['objPtr']
+        object_id = self.resolve('object', object_id)
+        self.sendObject(QS_RX.CURR_OBJ, QSPY.SEND_CURR_OBJ, object_kind, object_id)
+
+    def sendObject(self, target_id, qspy_id, object_kind, object_id):
+        """ Sends a packet addressing an object, directly to the target for an
+        integer object_id or via QSPY for an object name """
+
         # Build packet according to object_id type
         if isinstance(object_id, int):
-            packet = struct.pack(format_string, QS_RX.CURR_OBJ,
-                                 object_kind.value, object_id)
+            # Send directly to Target
+            layouts.obj.pack_into(self.tx_buffer, 1, target_id, object_kind, object_id)
+            self.sendBuffer(1 + layouts.obj.size)
         else:
-            packet = bytearray(struct.pack(
-                format_string, QSPY.SEND_CURR_OBJ, object_kind.value, 0))
-            # add string object ID to end
-            packet.extend(qspy.string_to_binary(object_id))
-        self.sendPacket(packet)
+            # Have QSpy interpret object_id string, add string object ID to end
+            layouts.obj.pack_into(self.tx_buffer, 1, qspy_id, object_kind, 0)
+            self.sendBuffer(self.putBuffer(1 + layouts.obj.size,
+                                           self.string_to_binary(object_id)))
 
     def sendTestProbe(self, function, data):
-        format_string = '< B I' + theFmt['funPtr']
+        function = self.resolve('function', function)
 
         if isinstance(function, int):
             # Send directly to target
-            packet = struct.pack(
-                format_string, QS_RX.TEST_PROBE, data, function)
+            layouts.test_probe.pack_into(self.tx_buffer, 1, QS_RX.TEST_PROBE, data, function)
+            self.sendBuffer(1 + layouts.test_probe.size)
         else:
             # Send to QSPY to provide 'function' from Fun Dictionary
-            packet = bytearray(struct.pack(
-                format_string, QSPY.SEND_TEST_PROBE, data, 0))
+            layouts.test_probe.pack_into(self.tx_buffer, 1, QSPY.SEND_TEST_PROBE, data, 0)
             # add string function name to end
-            packet.extend(qspy.string_to_binary(function))
-
-        self.sendPacket(packet)
+            self.sendBuffer(self.putBuffer(1 + layouts.test_probe.size,
+                                           self.string_to_binary(function)))
 
     def sendTick(self, rate):
-        packet = struct.pack('< BB', QS_RX.TICK, rate)
-        self.sendPacket(packet)
+        layouts.tick.pack_into(self.tx_buffer, 1, QS_RX.TICK, rate)
+        self.sendBuffer(1 + layouts.tick.size)
 
     def sendEvent(self, ao_priority, signal, parameters=None):
         """ Sends and event to an active object
 
+        Identical events (same priority, signal and payload) are encoded once
+        and then sent from layouts.events.
+
         Args:
             ao_priority : ao priority or one of the PRIO_COMMAND enums
             signal : signal string or value
             parameters : (optional) bytes or bytesarray of payload
         """
-        format_string = '< B B ' + theFmt['sig'] + 'h'
-
+        signal = self.resolve('signal', signal)
         if parameters is not None:
-            length = len(parameters)
-        else:
-            length = 0
+            parameters = bytes(parameters)
 
-        if isinstance(signal, int):
-            packet = bytearray(struct.pack(
-                format_string, QS_RX.EVENT, ao_priority, signal, length))
-            if parameters is not None:
-                packet.extend(parameters)
-        else:
-            packet = bytearray(struct.pack(
-                format_string, QSPY.SEND_EVENT, ao_priority, 0, length))
-            if parameters is not None:
-                packet.extend(parameters)
-            packet.extend(qspy.string_to_binary(signal))
+        key = (int(ao_priority), signal, parameters)
+        body = layouts.events.get(key)
+        if body is None:
+            body = layouts.encodeEvent(ao_priority, signal, parameters,
+                                       None if isinstance(signal, int) else self.string_to_binary(signal))
+        self.sendBody(body)
 
-        self.sendPacket(packet)
+    def sendSaveDict(self):
+        """ Asks QSPY to save its dictionaries to a file """
+        self.sendBody(layouts.save_dict)
 
     def sendReset(self):
-        self.sendPacket(struct.pack('< B', QS_RX.RESET))
+        self.sendBody(layouts.reset)
 
     def sendContinue(self):
-        self.sendPacket(struct.pack('< B', QS_RX.CONTINUE))
+        self.sendBody(layouts.resume)
 
     def sendSetup(self):
-        self.sendPacket(struct.pack('< B', QS_RX.TEST_SETUP))
+        self.sendBody(layouts.setup)
 
     def sendTeardown(self):
-        self.sendPacket(struct.pack('< B', QS_RX.TEST_TEARDOWN))
+        self.sendBody(layouts.teardown)
+
+    def transmit(self, data):
+        """ Sends a complete datagram to QSPY, implemented by the transport """
+        raise NotImplementedError
 
     def sendPacket(self, packet):
         """ sends a packet
@@ -565,11 +895,35 @@ class qspy(threading.Thread):
         Arguments:
         packet -- packet to send either a bytes() or bytearray() object
         """
+        self.sendBody(packet)
+
+    def sendBody(self, body):
+        """ Sends an encoded packet body (everything after the sequence number) """
+        self.sendBuffer(self.putBuffer(1, body))
 
-        tx_packet = bytearray({self.tx_packet_seq})
-        tx_packet.extend(packet)
+    def putBuffer(self, offset, data):
+        """ Copies data into the transmit buffer at offset, growing it if needed
 
-        self.socket.send(tx_packet)
+        Returns:
+          The offset of the end of data
+        """
+        end = offset + len(data)
+        if end > len(self.tx_buffer):
+            tx_buffer = bytearray(max(end, 2 * len(self.tx_buffer)))
+            tx_buffer[:offset] = self.tx_view[:offset]
+            self.tx_buffer = tx_buffer
+            self.tx_view = memoryview(tx_buffer)
+        self.tx_buffer[offset:end] = data
+        return end
+
+    def sendBuffer(self, length):
+        """ Sends the first length bytes of the transmit buffer
+
+        The packet body must already be in tx_buffer[1:length], the
+        sequence number is written into byte 0.
+        """
+        self.tx_buffer[0] = self.tx_packet_seq
+        self.transmit(self.tx_view[:length])
 
         self.tx_packet_seq += 1
         self.tx_packet_seq &= 0xFF
@@ -581,3 +935,208 @@ class qspy(threading.Thread):
         format_string = '{0}sB'.format(len(packed_string) + 1)
         # Null terminate and return
         return(struct.pack(format_string, packed_string, 0))
+
+
+class qspy(qspy_base, threading.Thread):
+    """ QSPY front end running a blocking UDP socket in its own receive thread """
+
+    def __init__(self):
+        super().__init__()
+        self.socket = None
+        self.alive = threading.Event()
+        self.zero_copy = False
+        self.batch = False
+        # Socket pair used by detach() to wake the batch receive loop
+        self.wake_reader = None
+        self.wake_writer = None
+        self.detached = threading.Event()
+        self.detach_confirmed = None
+        self.join_time = None
+
+    def __del__(self):
+        if self.socket is not None:
+            self.socket.close
+
+    # Socket receive thread
+    def run(self):
+        if self.batch:
+            self.run_batched()
+            return
+
+        process_packet = self.process_packet
+        if self.zero_copy:
+            # One preallocated buffer, handlers get memoryview slices of it
+            rx_buffer = bytearray(RX_PACKET_SIZE)
+            rx_view = memoryview(rx_buffer)
+
+        while self.alive.isSet():
+            try:
+                if self.zero_copy:
+                    length = self.socket.recv_into(rx_buffer)
+                    process_packet(rx_view[:length])
+                else:
+                    process_packet(self.socket.recv(RX_PACKET_SIZE))
+
+            except IOError as e:
+                # We expect this for now until we refactor the detach()
+                #print("QSpy Socket error:", str(e) )
+                e
+                pass
+
+    def run_batched(self):
+        """ Receive loop that waits for the socket to be readable and then
+        drains every queued datagram before handing them over as one batch.
+        """
+        if self.zero_copy:
+            rx_buffers = [bytearray(RX_PACKET_SIZE) for _ in range(RX_BATCH_SIZE)]
+            rx_views = [memoryview(rx_buffer) for rx_buffer in rx_buffers]
+
+        self.socket.setblocking(False)
+        selector = selectors.DefaultSelector()
+        selector.register(self.socket, selectors.EVENT_READ)
+        selector.register(self.wake_reader, selectors.EVENT_READ)
+
+        while self.alive.isSet():
+            try:
+                if not selector.select(RX_POLL_SEC) or not self.alive.isSet():
+                    continue
+                packets = []
+                try:
+                    while len(packets) < RX_BATCH_SIZE:
+                        if self.zero_copy:
+                            index = len(packets)
+                            length = self.socket.recv_into(rx_buffers[index])
+                            packets.append(rx_views[index][:length])
+                        else:
+                            packets.append(self.socket.recv(RX_PACKET_SIZE))
+                except BlockingIOError:
+                    pass
+                if packets:
+                    self.process_batch(packets)
+
+            except (IOError, ValueError) as e:
+                # Socket errors and the socket closing under us in detach()
+                e
+                pass
+
+        selector.close()
+
+    def attach(self, client, host='localhost', port=7701, channels=QS_CHANNEL.TEXT, local_port=None,
+               zero_copy=False, batch=False, dictionary=None, config=None):
+        """ Attach to the QSpy backend
+
+        Keyword arguments:
+        host -- host IP address of QSpy (default 'localhost')
+        port -- socket port of QSpy (default 7701)
+        channels -- what channels to attach to (default QPChannels.TEXT)
+        local_port -- the local/client port to use (default None for automatic)
+        zero_copy -- receive into a reused buffer and pass memoryview packets to
+                     the client callbacks (default False).  Packets are only valid
+                     during the callback, clients must copy (e.g. bytes(packet))
+                     anything they keep.
+        batch -- drain all pending datagrams on each wakeup and pass them to
+                 client.OnBatch(packets) when defined (default False)
+        dictionary -- qspy_dict.qs_dictionary to fill from the dictionary
+                      records and use for resolving names (default None)
+        config -- config.qutest_config whose QSPY_HOST, QSPY_UDP_PORT,
+                  QSPY_LOCAL_UDP_PORT, QSPY_RX_ZERO_COPY and QSPY_RX_BATCH
+                  replace host, port, local_port, zero_copy and batch (default None)
+        """
+
+        if config is not None:
+            host, port, local_port = config.QSPY_HOST, config.QSPY_UDP_PORT, config.QSPY_LOCAL_UDP_PORT
+            zero_copy, batch = config.QSPY_RX_ZERO_COPY, config.QSPY_RX_BATCH
+
+        # Pick up any change made to theFmt since the packets were compiled
+        refresh_fmt()
+
+        # Store client and its callbacks
+        self.client = client
+        self.handlers = self.build_handlers(client)
+        self.handlers[QSPY.DETACH] = self.onDetach(self.handlers[QSPY.DETACH])
+        self.batch_handler = getattr(client, "OnBatch", None)
+        self.setDictionary(dictionary)
+
+        # Store address info
+        self.host = host
+        self.port = port
+        self.channels = channels
+        self.local_port = local_port
+        self.zero_copy = zero_copy
+        self.batch = batch
+
+        # Create socket and connect
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if local_port is not None:
+            self.socket.bind(('', local_port))
+        self.socket.connect((host, port))
+        if batch:
+            self.wake_reader, self.wake_writer = socket.socketpair()
+
+        # Start receive thread
+        self.alive.set()
+        self.start()
+
+        self.sendAttach(channels)
+
+    def onDetach(self, handler):
+        """ Wraps the client DETACH handler to flag that QSPY answered the DETACH """
+        def detach_handler(packet):
+            self.detachReceived()
+            handler(packet)
+        return detach_handler
+
+    def detachReceived(self):
+        self.detached.set()
+
+    def detach(self, confirm_timeout=0.0):
+        """ Detaches from QSpy and stops the receive thread
+
+        The receive thread is woken at once (through the wake socket pair in
+        batch mode, by shutting down the socket otherwise) and joined, the
+        time it took is kept in join_time.
+
+        Keyword arguments:
+        confirm_timeout -- seconds to wait for QSpy to answer the DETACH
+                           before stopping (default 0.0 for not waiting).
+                           Not every QSpy version answers it.
+
+        Returns:
+          True if QSpy answered the DETACH, False if it did not within
+          confirm_timeout and None when not waiting for it
+        """
+        self.detached.clear()
+        self.sendDetach()
+        if confirm_timeout > 0:
+            self.detach_confirmed = self.detached.wait(confirm_timeout)
+        else:
+            self.detach_confirmed = None
+
+        start = time.monotonic()
+        self.alive.clear()
+        try:
+            if self.wake_writer is not None:
+                self.wake_writer.send(b'\0')
+            else:
+                # A blocking recv returns (or raises) once the socket is shut down
+                self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        threading.Thread.join(self, RX_POLL_SEC)
+
+        self.socket.close()
+        self.socket = None
+        if self.wake_writer is not None:
+            self.wake_reader.close()
+            self.wake_writer.close()
+            self.wake_reader = None
+            self.wake_writer = None
+        self.client = None
+        # Platforms where shutdown does not wake recv are woken by the close
+        threading.Thread.join(self)
+        self.join_time = time.monotonic() - start
+        return self.detach_confirmed
+
+    def transmit(self, data):
+        """ Sends a complete datagram to QSPY """
+        self.socket.send(data)
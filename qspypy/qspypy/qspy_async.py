@@ -0,0 +1,139 @@
+# MIT License
+#
+# Copyright (c) 2018 Lotus Engineering, LLC
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+#
+# asyncio implementation of the qspy front end, one event loop can drive
+# several QSPY attachments without a receive thread per attachment
+#
+
+import asyncio
+
+from qspypy.qspy import qspy_base, refresh_fmt, QSPY, QS_CHANNEL
+
+
+class qspy_async(qspy_base, asyncio.DatagramProtocol):
+    """ QSPY front end running as an asyncio datagram protocol.
+
+    Provides the same send* methods as qspy.  Received records and packets
+    are either dispatched to the client callbacks (OnRecord_*/OnPacket_*)
+    or, without a client, queued for async iteration:
+
+        link = qspy_async()
+        await link.attach(port=7701)
+        link.sendTick(0)
+        async for packet in link:
+            ...
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.transport = None
+        self.records = None
+        self.attached = None
+
+    async def attach(self, client=None, host='localhost', port=7701, channels=QS_CHANNEL.TEXT,
+                     local_port=None, timeout=1.0, dictionary=None):
+        """ Attach to the QSpy backend and wait for it to answer
+
+        Keyword arguments:
+        client -- object with OnRecord_*/OnPacket_* callbacks (default None,
+                  all packets are queued for async iteration instead)
+        host -- host IP address of QSpy (default 'localhost')
+        port -- socket port of QSpy (default 7701)
+        channels -- what channels to attach to (default QPChannels.TEXT)
+        local_port -- the local/client port to use (default None for automatic)
+        timeout -- seconds to wait for the attach reply (default 1.0)
+        dictionary -- qspy_dict.qs_dictionary to fill from the dictionary
+                      records and use for resolving names (default None)
+        """
+        loop = asyncio.get_running_loop()
+        refresh_fmt()
+
+        self.client = client
+        self.handlers = self.build_handlers(self if client is None else client)
+        self.handlers[QSPY.ATTACH] = self.onAttach
+        self.setDictionary(dictionary)
+        self.records = asyncio.Queue()
+        self.attached = loop.create_future()
+
+        local_addr = ('', local_port) if local_port is not None else None
+        await loop.create_datagram_endpoint(lambda: self, local_addr=local_addr,
+                                            remote_addr=(host, port))
+
+        self.sendAttach(channels)
+        try:
+            await asyncio.wait_for(asyncio.shield(self.attached), timeout)
+        except BaseException:
+            # Timed out or cancelled, nothing will use the socket
+            self.transport.close()
+            self.transport = None
+            raise
+
+    def detach(self):
+        """ Detach from QSpy and end any async iteration """
+        if self.transport is not None:
+            self.sendDetach()
+            self.transport.close()
+            self.transport = None
+        if self.records is not None:
+            self.records.put_nowait(None)
+        self.client = None
+
+    def transmit(self, data):
+        """ Sends a complete datagram to QSPY """
+        self.transport.sendto(bytes(data))
+
+    def onAttach(self, packet):
+        if not self.attached.done():
+            self.attached.set_result(True)
+        if self.client is not None and hasattr(self.client, "OnPacket_ATTACH"):
+            self.client.OnPacket_ATTACH(packet)
+
+    def OnUnhandled(self, packet):
+        """ Queues packets for async iteration when there is no client """
+        self.records.put_nowait(bytes(packet))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        packet = await self.records.get()
+        if packet is None:
+            raise StopAsyncIteration
+        return packet
+
+    ################### asyncio.DatagramProtocol #######################
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.process_packet(data)
+
+    def error_received(self, exc):
+        # Sending before QSpy is listening reports connection refused, ignore
+        pass
+
+    def connection_lost(self, exc):
+        if self.records is not None:
+            self.records.put_nowait(None)
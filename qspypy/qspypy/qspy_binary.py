@@ -0,0 +1,370 @@
+# MIT License
+#
+# Copyright (c) 2018 Lotus Engineering, LLC
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+#
+# Decoder for the records of the QS binary channel (QS_CHANNEL.BINARY).
+#
+# Each record layout is described with theFmt keys (objPtr, sig, ...) or
+# fixed size fields (u8, u16, u32) and compiled once into a struct.Struct.
+# Decoded records are namedtuples, one class per QSpyRecords member.
+#
+
+from collections import namedtuple
+import struct
+
+from qspypy.qspy import QSpyRecords, theFmt
+
+
+# Fixed size fields that do not depend on the target port
+FIXED_FMT = {
+    'u8': 'B',
+    'u16': 'H',
+    'u32': 'I',
+}
+
+# Variable length data that ends a record
+TAIL_STR = 'str'      # zero terminated UTF-8 string
+TAIL_BYTES = 'bytes'  # rest of the record as bytes
+TAIL_TEXT = 'text'    # rest of the record as UTF-8 text (QS_TEXT channel)
+
+_R = QSpyRecords
+
+# Record layouts as ((field, format key), ...), tail kind or None
+RECORD_LAYOUTS = {
+    _R.QS_TEXT: ((('rec', 'u8'),), ('line', TAIL_TEXT)),
+
+    # SM records
+    _R.QS_QEP_STATE_ENTRY: ((('obj', 'objPtr'), ('state', 'funPtr')), None),
+    _R.QS_QEP_STATE_EXIT: ((('obj', 'objPtr'), ('state', 'funPtr')), None),
+    _R.QS_QEP_STATE_INIT: ((('obj', 'objPtr'), ('source', 'funPtr'), ('target', 'funPtr')), None),
+    _R.QS_QEP_INIT_TRAN: ((('tstamp', 'tstamp'), ('obj', 'objPtr'), ('state', 'funPtr')), None),
+    _R.QS_QEP_INTERN_TRAN: ((('tstamp', 'tstamp'), ('sig', 'sig'), ('obj', 'objPtr'),
+                             ('state', 'funPtr')), None),
+    _R.QS_QEP_TRAN: ((('tstamp', 'tstamp'), ('sig', 'sig'), ('obj', 'objPtr'),
+                      ('source', 'funPtr'), ('target', 'funPtr')), None),
+    _R.QS_QEP_IGNORED: ((('tstamp', 'tstamp'), ('sig', 'sig'), ('obj', 'objPtr'),
+                         ('state', 'funPtr')), None),
+    _R.QS_QEP_DISPATCH: ((('tstamp', 'tstamp'), ('sig', 'sig'), ('obj', 'objPtr'),
+                          ('state', 'funPtr')), None),
+    _R.QS_QEP_UNHANDLED: ((('sig', 'sig'), ('obj', 'objPtr'), ('state', 'funPtr')), None),
+
+    # AO records
+    _R.QS_QF_ACTIVE_DEFER: ((('tstamp', 'tstamp'), ('obj', 'objPtr'), ('queue', 'objPtr'),
+                             ('sig', 'sig'), ('pool_id', 'u8'), ('ref_ctr', 'u8')), None),
+    _R.QS_QF_ACTIVE_RECALL: ((('tstamp', 'tstamp'), ('obj', 'objPtr'), ('queue', 'objPtr'),
+                              ('sig', 'sig'), ('pool_id', 'u8'), ('ref_ctr', 'u8')), None),
+    _R.QS_QF_ACTIVE_SUBSCRIBE: ((('tstamp', 'tstamp'), ('sig', 'sig'), ('obj', 'objPtr')), None),
+    _R.QS_QF_ACTIVE_UNSUBSCRIBE: ((('tstamp', 'tstamp'), ('sig', 'sig'), ('obj', 'objPtr')), None),
+    _R.QS_QF_ACTIVE_POST_FIFO: ((('tstamp', 'tstamp'), ('sender', 'objPtr'), ('sig', 'sig'),
+                                 ('obj', 'objPtr'), ('pool_id', 'u8'), ('ref_ctr', 'u8'),
+                                 ('free', 'queueCtr'), ('min', 'queueCtr')), None),
+    _R.QS_QF_ACTIVE_POST_LIFO: ((('tstamp', 'tstamp'), ('sig', 'sig'), ('obj', 'objPtr'),
+                                 ('pool_id', 'u8'), ('ref_ctr', 'u8'),
+                                 ('free', 'queueCtr'), ('min', 'queueCtr')), None),
+    _R.QS_QF_ACTIVE_GET: ((('tstamp', 'tstamp'), ('sig', 'sig'), ('obj', 'objPtr'),
+                           ('pool_id', 'u8'), ('ref_ctr', 'u8'), ('free', 'queueCtr')), None),
+    _R.QS_QF_ACTIVE_GET_LAST: ((('tstamp', 'tstamp'), ('sig', 'sig'), ('obj', 'objPtr'),
+                                ('pool_id', 'u8'), ('ref_ctr', 'u8')), None),
+    _R.QS_QF_ACTIVE_RECALL_ATTEMPT: ((('tstamp', 'tstamp'), ('obj', 'objPtr'),
+                                      ('queue', 'objPtr')), None),
+
+    # EQ records
+    _R.QS_QF_EQUEUE_POST_FIFO: ((('tstamp', 'tstamp'), ('sig', 'sig'), ('obj', 'objPtr'),
+                                 ('pool_id', 'u8'), ('ref_ctr', 'u8'),
+                                 ('free', 'queueCtr'), ('min', 'queueCtr')), None),
+    _R.QS_QF_EQUEUE_POST_LIFO: ((('tstamp', 'tstamp'), ('sig', 'sig'), ('obj', 'objPtr'),
+                                 ('pool_id', 'u8'), ('ref_ctr', 'u8'),
+                                 ('free', 'queueCtr'), ('min', 'queueCtr')), None),
+    _R.QS_QF_EQUEUE_GET: ((('tstamp', 'tstamp'), ('sig', 'sig'), ('obj', 'objPtr'),
+                           ('pool_id', 'u8'), ('ref_ctr', 'u8'), ('free', 'queueCtr')), None),
+    _R.QS_QF_EQUEUE_GET_LAST: ((('tstamp', 'tstamp'), ('sig', 'sig'), ('obj', 'objPtr'),
+                                ('pool_id', 'u8'), ('ref_ctr', 'u8')), None),
+    _R.QS_QF_RESERVED2: ((), ('data', TAIL_BYTES)),
+
+    # MP records
+    _R.QS_QF_MPOOL_GET: ((('tstamp', 'tstamp'), ('obj', 'objPtr'), ('free', 'poolCtr'),
+                          ('min', 'poolCtr')), None),
+    _R.QS_QF_MPOOL_PUT: ((('tstamp', 'tstamp'), ('obj', 'objPtr'), ('free', 'poolCtr')), None),
+
+    # QF records
+    _R.QS_QF_PUBLISH: ((('tstamp', 'tstamp'), ('sender', 'objPtr'), ('sig', 'sig'),
+                        ('pool_id', 'u8'), ('ref_ctr', 'u8')), None),
+    _R.QS_QF_NEW_REF: ((('tstamp', 'tstamp'), ('sig', 'sig'), ('pool_id', 'u8'),
+                        ('ref_ctr', 'u8')), None),
+    _R.QS_QF_NEW: ((('tstamp', 'tstamp'), ('size', 'evtSize'), ('sig', 'sig')), None),
+    _R.QS_QF_GC_ATTEMPT: ((('tstamp', 'tstamp'), ('sig', 'sig'), ('pool_id', 'u8'),
+                           ('ref_ctr', 'u8')), None),
+    _R.QS_QF_GC: ((('tstamp', 'tstamp'), ('sig', 'sig'), ('pool_id', 'u8'),
+                   ('ref_ctr', 'u8')), None),
+    _R.QS_QF_TICK: ((('ctr', 'tevtCtr'), ('rate', 'u8')), None),
+
+    # TE records
+    _R.QS_QF_TIMEEVT_ARM: ((('tstamp', 'tstamp'), ('obj', 'objPtr'), ('act', 'objPtr'),
+                            ('ctr', 'tevtCtr'), ('interval', 'tevtCtr'), ('rate', 'u8')), None),
+    _R.QS_QF_TIMEEVT_AUTO_DISARM: ((('obj', 'objPtr'), ('act', 'objPtr'), ('sig', 'sig'),
+                                    ('interval', 'tevtCtr'), ('rate', 'u8')), None),
+    _R.QS_QF_TIMEEVT_DISARM_ATTEMPT: ((('tstamp', 'tstamp'), ('obj', 'objPtr'), ('act', 'objPtr'),
+                                       ('sig', 'sig'), ('interval', 'tevtCtr'),
+                                       ('rate', 'u8')), None),
+    _R.QS_QF_TIMEEVT_DISARM: ((('tstamp', 'tstamp'), ('obj', 'objPtr'), ('act', 'objPtr'),
+                               ('sig', 'sig'), ('ctr', 'tevtCtr'), ('interval', 'tevtCtr'),
+                               ('rate', 'u8')), None),
+    _R.QS_QF_TIMEEVT_REARM: ((('tstamp', 'tstamp'), ('obj', 'objPtr'), ('act', 'objPtr'),
+                              ('sig', 'sig'), ('ctr', 'tevtCtr'), ('interval', 'tevtCtr'),
+                              ('rate', 'u8'), ('was_armed', 'u8')), None),
+    _R.QS_QF_TIMEEVT_POST: ((('tstamp', 'tstamp'), ('obj', 'objPtr'), ('sig', 'sig'),
+                             ('act', 'objPtr'), ('rate', 'u8')), None),
+
+    # QF records
+    _R.QS_QF_DELETE_REF: ((('tstamp', 'tstamp'), ('sig', 'sig'), ('pool_id', 'u8'),
+                           ('ref_ctr', 'u8')), None),
+    _R.QS_QF_CRIT_ENTRY: ((('tstamp', 'tstamp'), ('nesting', 'u8')), None),
+    _R.QS_QF_CRIT_EXIT: ((('tstamp', 'tstamp'), ('nesting', 'u8')), None),
+    _R.QS_QF_ISR_ENTRY: ((('tstamp', 'tstamp'), ('nesting', 'u8'), ('prio', 'u8')), None),
+    _R.QS_QF_ISR_EXIT: ((('tstamp', 'tstamp'), ('nesting', 'u8'), ('prio', 'u8')), None),
+    _R.QS_QF_INT_DISABLE: ((('tstamp', 'tstamp'), ('prio', 'u8'), ('nesting', 'u8')), None),
+    _R.QS_QF_INT_ENABLE: ((('tstamp', 'tstamp'), ('prio', 'u8'), ('nesting', 'u8')), None),
+
+    # AO, EQ and MP attempt records
+    _R.QS_QF_ACTIVE_POST_ATTEMPT: ((('tstamp', 'tstamp'), ('sender', 'objPtr'), ('sig', 'sig'),
+                                    ('obj', 'objPtr'), ('pool_id', 'u8'), ('ref_ctr', 'u8'),
+                                    ('free', 'queueCtr'), ('margin', 'queueCtr')), None),
+    _R.QS_QF_EQUEUE_POST_ATTEMPT: ((('tstamp', 'tstamp'), ('sig', 'sig'), ('obj', 'objPtr'),
+                                    ('pool_id', 'u8'), ('ref_ctr', 'u8'),
+                                    ('free', 'queueCtr'), ('margin', 'queueCtr')), None),
+    _R.QS_QF_MPOOL_GET_ATTEMPT: ((('tstamp', 'tstamp'), ('obj', 'objPtr'), ('free', 'poolCtr'),
+                                  ('margin', 'poolCtr')), None),
+
+    # SC records
+    _R.QS_MUTEX_LOCK: ((('tstamp', 'tstamp'), ('prio', 'u8'), ('ceiling', 'u8')), None),
+    _R.QS_MUTEX_UNLOCK: ((('tstamp', 'tstamp'), ('prio', 'u8'), ('ceiling', 'u8')), None),
+    _R.QS_SCHED_LOCK: ((('tstamp', 'tstamp'), ('prev_ceiling', 'u8'), ('ceiling', 'u8')), None),
+    _R.QS_SCHED_UNLOCK: ((('tstamp', 'tstamp'), ('prev_ceiling', 'u8'), ('ceiling', 'u8')), None),
+    _R.QS_SCHED_NEXT: ((('tstamp', 'tstamp'), ('prio', 'u8'), ('prev_prio', 'u8')), None),
+    _R.QS_SCHED_IDLE: ((('tstamp', 'tstamp'), ('prev_prio', 'u8')), None),
+    _R.QS_SCHED_RESUME: ((('tstamp', 'tstamp'), ('prio', 'u8'), ('prev_prio', 'u8')), None),
+
+    # QEP records
+    _R.QS_QEP_TRAN_HIST: ((('obj', 'objPtr'), ('source', 'funPtr'), ('target', 'funPtr')), None),
+    _R.QS_QEP_TRAN_EP: ((('obj', 'objPtr'), ('source', 'funPtr'), ('target', 'funPtr')), None),
+    _R.QS_QEP_TRAN_XP: ((('obj', 'objPtr'), ('source', 'funPtr'), ('target', 'funPtr')), None),
+
+    # Miscellaneous records
+    _R.QS_TEST_PAUSED: ((), None),
+    _R.QS_TEST_PROBE_GET: ((('tstamp', 'tstamp'), ('api', 'funPtr'), ('data', 'u32')), None),
+    _R.QS_SIG_DICT: ((('sig', 'sig'), ('obj', 'objPtr')), ('name', TAIL_STR)),
+    _R.QS_OBJ_DICT: ((('obj', 'objPtr'),), ('name', TAIL_STR)),
+    _R.QS_FUN_DICT: ((('fun', 'funPtr'),), ('name', TAIL_STR)),
+    _R.QS_USR_DICT: ((('rec', 'u8'),), ('name', TAIL_STR)),
+    _R.QS_TARGET_INFO: ((('is_reset', 'u8'), ('version', 'u16'),
+                         ('sig_evt_size', 'u8'), ('eqc_mpc_size', 'u8'), ('mps_obj_size', 'u8'),
+                         ('fun_tstamp_size', 'u8'), ('tec_size', 'u8'), ('max_active', 'u8'),
+                         ('max_epool_tick_rate', 'u8'),
+                         ('second', 'u8'), ('minute', 'u8'), ('hour', 'u8'),
+                         ('day', 'u8'), ('month', 'u8'), ('year', 'u8')), None),
+    _R.QS_TARGET_DONE: ((('tstamp', 'tstamp'), ('rec', 'u8')), None),
+    _R.QS_RX_STATUS: ((('status', 'u8'),), None),
+    _R.QS_MSC_RESERVED1: ((), ('data', TAIL_BYTES)),
+    _R.QS_PEEK_DATA: ((('tstamp', 'tstamp'), ('offset', 'u16'), ('size', 'u8'), ('num', 'u8')),
+                      ('data', TAIL_BYTES)),
+    _R.QS_ASSERT_FAIL: ((('tstamp', 'tstamp'), ('line', 'u16')), ('module', TAIL_STR)),
+}
+
+# Application-specific records carry formatted data after the time stamp
+USER_LAYOUT = ((('tstamp', 'tstamp'),), ('data', TAIL_BYTES))
+
+# Records with an ID that has no QSpyRecords member
+qs_unknown = namedtuple('qs_unknown', ['rec', 'data'])
+
+
+class USER_FMT():
+    """ Format codes that prefix each field of an application-specific record """
+    I8 = 0
+    U8 = 1
+    I16 = 2
+    U16 = 3
+    I32 = 4
+    U32 = 5
+    F32 = 6
+    F64 = 7
+    STR = 8
+    MEM = 9
+    SIG = 10
+    OBJ = 11
+    FUN = 12
+    I64 = 13
+    U64 = 14
+    U32_HEX = 15
+
+
+class qs_decoder():
+    """ Decodes binary channel packets into namedtuple records.
+
+    The layouts are compiled from theFmt when the decoder is created; call
+    refresh() (or qspy.set_fmt() for the module decoder) after changing theFmt.
+    """
+
+    def __init__(self, formats=None):
+        self.table = None
+        self.formats = None
+        self.record_types = {}
+        # Decoders given their own formats do not follow theFmt
+        self.follows_fmt = formats is None
+        self.compile(formats)
+
+    def refresh(self):
+        """ Recompiles the layouts if theFmt changed since the last compile """
+        if self.follows_fmt and self.formats != theFmt:
+            self.compile()
+
+    def compile(self, formats=None):
+        """ Builds the 256 entry table of (Struct, record type, tail kind)
+
+        Args:
+          formats : dictionary like theFmt (default None uses theFmt)
+        """
+        if formats is None:
+            formats = theFmt
+        self.formats = dict(formats)
+
+        table = [None] * 256
+        for record in QSpyRecords:
+            fields, tail = RECORD_LAYOUTS.get(record, USER_LAYOUT)
+            layout = struct.Struct(
+                '<' + ''.join(self.field_format(fmt) for _, fmt in fields))
+            names = [name for name, _ in fields]
+            if tail is not None:
+                names.append(tail[0])
+                tail = tail[1]
+
+            # One compact record type per record ID, reused across compiles
+            record_type = self.record_types.get(record)
+            if record_type is None or record_type._fields != tuple(names):
+                record_type = type(record.name, (namedtuple(record.name, names),),
+                                   {'__slots__': (), 'record': record})
+                self.record_types[record] = record_type
+
+            table[record.value] = (layout, record_type, tail)
+        self.table = table
+
+    def field_format(self, fmt):
+        """ Returns the struct format character for a layout format key """
+        if fmt in FIXED_FMT:
+            return FIXED_FMT[fmt]
+        return self.formats[fmt]
+
+    def decode(self, packet):
+        """ Decodes one packet from the binary channel
+
+        Args:
+          packet : received datagram [sequence, record ID, payload...]
+
+        Returns:
+          A namedtuple whose type has a 'record' QSpyRecords attribute, or a
+          qs_unknown for record IDs that are not in QSpyRecords
+        """
+        entry = self.table[packet[1]]
+        if entry is None:
+            return qs_unknown(packet[1], bytes(packet[2:]))
+
+        layout, record_type, tail = entry
+        values = layout.unpack_from(packet, 2)
+        if tail is None:
+            return record_type._make(values)
+
+        rest = bytes(packet[2 + layout.size:])
+        if tail == TAIL_STR:
+            rest = rest.split(b'\0', 1)[0].decode('utf-8')
+        elif tail == TAIL_TEXT:
+            rest = rest.decode('utf-8')
+        return record_type(*values, rest)
+
+    def user_fields(self, data):
+        """ Splits the formatted data of an application-specific record
+
+        Args:
+          data : the 'data' field of a decoded user record
+
+        Returns:
+          A list of (USER_FMT code, value) tuples
+        """
+        formats = self.formats
+        fields = []
+        offset = 0
+        while offset < len(data):
+            code = data[offset] & 0x0F
+            offset += 1
+            if code == USER_FMT.STR:
+                end = data.index(b'\0', offset)
+                value = data[offset:end].decode('utf-8')
+                offset = end + 1
+            elif code == USER_FMT.MEM:
+                length = data[offset]
+                value = bytes(data[offset + 1:offset + 1 + length])
+                offset += 1 + length
+            elif code == USER_FMT.SIG:
+                fmt = '<' + formats['sig'] + formats['objPtr']
+                value = struct.unpack_from(fmt, data, offset)
+                offset += struct.calcsize(fmt)
+            else:
+                fmt = '<' + {USER_FMT.I8: 'b', USER_FMT.U8: 'B', USER_FMT.I16: 'h',
+                             USER_FMT.U16: 'H', USER_FMT.I32: 'i', USER_FMT.U32: 'I',
+                             USER_FMT.F32: 'f', USER_FMT.F64: 'd', USER_FMT.OBJ: formats['objPtr'],
+                             USER_FMT.FUN: formats['funPtr'], USER_FMT.I64: 'q',
+                             USER_FMT.U64: 'Q', USER_FMT.U32_HEX: 'I'}[code]
+                value, = struct.unpack_from(fmt, data, offset)
+                offset += struct.calcsize(fmt)
+            fields.append((code, value))
+        return fields
+
+
+def formats_from_target_info(info):
+    """ Derives theFmt entries from the object sizes reported in QS_TARGET_INFO
+
+    Args:
+      info : decoded QS_TARGET_INFO record
+
+    Returns:
+      A dictionary with the same keys as theFmt
+    """
+    size_fmt = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+    return {
+        'objPtr': size_fmt[info.mps_obj_size >> 4],
+        'funPtr': size_fmt[info.fun_tstamp_size & 0x0F],
+        'tstamp': size_fmt[info.fun_tstamp_size >> 4],
+        'sig': size_fmt[info.sig_evt_size & 0x0F],
+        'evtSize': size_fmt[info.sig_evt_size >> 4],
+        'queueCtr': size_fmt[info.eqc_mpc_size & 0x0F],
+        'poolCtr': size_fmt[info.eqc_mpc_size >> 4],
+        'poolBlk': size_fmt[info.mps_obj_size & 0x0F],
+        'tevtCtr': size_fmt[info.tec_size & 0x0F],
+    }
+
+
+# Decoder for the current theFmt
+decoder = qs_decoder()
+
+
+def decode(packet):
+    """ Decodes one binary channel packet with the module decoder """
+    return decoder.decode(packet)
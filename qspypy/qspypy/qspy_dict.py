@@ -0,0 +1,193 @@
+# MIT License
+#
+# Copyright (c) 2018 Lotus Engineering, LLC
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+#
+# Client side index of the target dictionaries (signals, objects, functions
+# and user records) so the qspy send methods can resolve names themselves
+# instead of asking QSPY to do it.
+#
+
+import json
+import os
+import struct
+
+from qspypy.qspy import QSpyRecords
+from qspypy.qspy_binary import decoder
+
+
+def target_key(packet):
+    """ Returns a key identifying the target build from a QS_TARGET_INFO packet
+
+    The key is made from the QP version and the build date and time, so it
+    changes whenever the firmware is rebuilt.  Returns None if the packet
+    cannot be decoded.
+    """
+    try:
+        info = decoder.decode(packet)
+    except struct.error:
+        return None
+    return '{0:04X}_{1:02d}{2:02d}{3:02d}_{4:02d}{5:02d}{6:02d}'.format(
+        info.version, info.year, info.month, info.day, info.hour, info.minute, info.second)
+
+
+class qs_dictionary():
+    """ Name to value index built from the QS_*_DICT records of the target.
+
+    With a cache directory the entries are saved per target build and
+    loaded again by set_target() when a later session sees the same build.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.signals = {}    # name -> {object address: signal}
+        self.objects = {}    # name -> address
+        self.functions = {}  # name -> address
+        self.users = {}      # name -> user record ID / command
+        self.cache_dir = cache_dir
+        self.target = None   # target_key() of the build the entries belong to
+
+    def __len__(self):
+        return len(self.signals) + len(self.objects) + len(self.functions) + len(self.users)
+
+    def clear(self):
+        """ Forgets all entries """
+        self.signals = {}
+        self.objects = {}
+        self.functions = {}
+        self.users = {}
+
+    def add_packet(self, packet):
+        """ Adds a dictionary record received on the binary channel
+
+        QSPY does not pass the dictionaries to text channel clients, the
+        client has to attach to QS_CHANNEL.BINARY as well.  Other packets
+        are ignored.
+
+        Args:
+          packet : received datagram
+        """
+        record_id = packet[1]
+        if record_id == QSpyRecords.QS_SIG_DICT:
+            record = decoder.decode(packet)
+            self.add_signal(record.name, record.sig, record.obj)
+        elif record_id == QSpyRecords.QS_OBJ_DICT:
+            record = decoder.decode(packet)
+            self.objects[record.name] = record.obj
+        elif record_id == QSpyRecords.QS_FUN_DICT:
+            record = decoder.decode(packet)
+            self.functions[record.name] = record.fun
+        elif record_id == QSpyRecords.QS_USR_DICT:
+            record = decoder.decode(packet)
+            self.users[record.name] = record.rec
+
+    def add_signal(self, name, sig, obj=0):
+        self.signals.setdefault(name, {})[obj] = sig
+
+    def signal(self, name, obj=None):
+        """ Returns the signal value for name or None if not known or ambiguous
+
+        Args:
+          name : signal name
+          obj : (optional) object address the signal is local to
+        """
+        entries = self.signals.get(name)
+        if not entries:
+            return None
+        if obj is not None and obj in entries:
+            return entries[obj]
+        if 0 in entries:
+            return entries[0]
+        if len(entries) == 1:
+            return next(iter(entries.values()))
+        return None
+
+    def object(self, name):
+        """ Returns the object address for name or None """
+        return self.objects.get(name)
+
+    def function(self, name):
+        """ Returns the function address for name or None """
+        return self.functions.get(name)
+
+    def user(self, name):
+        """ Returns the user record ID / command for name or None """
+        return self.users.get(name)
+
+    def set_target(self, key):
+        """ Tells the index which target build it is talking to
+
+        Entries of a different build are saved to the cache and replaced by
+        the cached entries of the new build (if any).
+
+        Args:
+          key : target_key() of the QS_TARGET_INFO record
+        """
+        if key is None or key == self.target:
+            return
+        if self.target is not None:
+            self.save_cache()
+        self.clear()
+        self.target = key
+        self.load_cache(key)
+
+    def cache_path(self, key):
+        return os.path.join(self.cache_dir, 'qspy_dict_{0}.json'.format(key))
+
+    def load_cache(self, key):
+        """ Loads cached entries
+
+        Only call this with the key of a QS_TARGET_INFO just received, the
+        entries hold addresses that are wrong for any other build.
+
+        Args:
+          key : target_key() of the build to load
+
+        Returns:
+          True if entries were loaded
+        """
+        if self.cache_dir is None:
+            return False
+        try:
+            with open(self.cache_path(key), 'r') as cache:
+                entries = json.load(cache)
+            signals = {name: {int(obj): sig for obj, sig in sigs.items()}
+                       for name, sigs in entries['signals'].items()}
+            objects, functions, users = entries['objects'], entries['functions'], entries['users']
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            # Runs on the qspy receive thread, a stale or corrupt cache is a miss
+            return False
+
+        self.target = key
+        self.signals = signals
+        self.objects = objects
+        self.functions = functions
+        self.users = users
+        return True
+
+    def save_cache(self):
+        """ Saves the entries of the current target build to the cache """
+        if self.cache_dir is None or self.target is None or len(self) == 0:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self.cache_path(self.target), 'w') as cache:
+            json.dump({'target': self.target, 'signals': self.signals, 'objects': self.objects,
+                       'functions': self.functions, 'users': self.users}, cache, indent=1)
@@ -25,29 +25,165 @@
 #
 
 import os
+import re
 import sys
 import signal
 import pytest
 import time
-from threading import Event
-from queue import Queue
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache
+from threading import Event, Condition
 from subprocess import Popen
 if sys.platform == 'win32':
     from subprocess import CREATE_NEW_CONSOLE
 
-from qspypy.qspy import qspy, QS_CHANNEL, QS_OBJ_KIND, FILTER, PRIO_COMMAND
-import qspypy.config as CONFIG
+from qspypy.qspy import qspy, qs_text_record, rx_stats_delta, format_rx_stats, QSpyRecords, QS_CHANNEL, QS_OBJ_KIND, FILTER, PRIO_COMMAND
+from qspypy.qspy_dict import qs_dictionary, target_key
+from qspypy.ring_buffer import ring_buffer
+from qspypy.qutest_latency import latency_profile
+from qspypy.target_pool import target_pool
+from qspypy.config import qutest_config
+
+
+# expect() prefix that skips the timestamp of a line
+TIMESTAMP_MATCH = '%timestamp'
+
+# First and longest wait (seconds) between ATTACH requests while QSpy starts
+ATTACH_RETRY_SEC = 0.010
+ATTACH_RETRY_MAX_SEC = 0.250
+
+
+class expect_matcher():
+    """ An expect() match string compiled for comparing with QS_TEXT packets
+
+    Like the original expect() the compare is on the start of the line:
+    the first len(expected) characters after the (optional) timestamp, with
+    a trailing * only marking that the line may go on.  For ASCII match
+    strings this is a bytes compare against the undecoded packet payload.
+    """
+    __slots__ = ('match', 'start', 'end', 'expected', 'pattern')
+
+    def __init__(self, match):
+        self.match = match
+        self.start = len(TIMESTAMP_MATCH) if match.startswith(TIMESTAMP_MATCH) else 0
+
+        if match.endswith('*'):
+            self.end = match.find('*', self.start)
+            match = match.rstrip('*')
+        else:
+            self.end = len(match)
+        self.expected = match[self.start:]
+
+        # A * inside the match shortens the compared line and an empty expected
+        # part also matches lines shorter than the timestamp, keep the text
+        # compare then
+        self.pattern = None
+        if self.expected and self.end - self.start == len(self.expected):
+            try:
+                self.pattern = self.expected.encode('ascii')
+            except UnicodeEncodeError:
+                pass
+
+    def matches(self, text):
+        """ Returns True if the qs_text_record matches """
+        if self.pattern is not None:
+            data = text.data
+            offset = qs_text_record.LINE_OFFSET
+            # Byte and character offsets agree while the skipped part is ASCII
+            if not self.start or max(data[offset:offset + self.start], default=0) < 0x80:
+                return data.startswith(self.pattern, offset + self.start)
+        return self.actual(text) == self.expected
+
+    def actual(self, text):
+        """ Returns the part of the qs_text_record line compared with expected """
+        return text.line[self.start:self.end]
+
+
+@lru_cache(maxsize=4096)
+def compile_match(match):
+    """ Returns the cached expect_matcher for a match string """
+    return expect_matcher(match)
+
+
+class regex_matcher():
+    """ An expect_re() pattern compiled to a bytes regular expression
+
+    The pattern is matched against the undecoded packet payload, only the
+    named groups of a match are decoded.
+    """
+    __slots__ = ('match', 'start', 'expected', 'regex')
+
+    def __init__(self, pattern):
+        self.match = pattern
+        self.start = 0
+        if pattern.startswith(TIMESTAMP_MATCH):
+            self.start = len(TIMESTAMP_MATCH)
+            pattern = pattern[self.start:]
+        self.expected = pattern
+        self.regex = re.compile(pattern.encode('utf-8'))
+
+    def matches(self, text):
+        """ Returns the re match object if the qs_text_record matches, otherwise None """
+        return self.regex.match(text.data, qs_text_record.LINE_OFFSET + self.start)
+
+    @staticmethod
+    def groups(result):
+        """ Returns the named groups of a match decoded to strings """
+        return {name: None if value is None else str(value, 'utf-8')
+                for name, value in result.groupdict().items()}
+
+    def actual(self, text):
+        """ Returns the part of the qs_text_record line the pattern is matched against """
+        return text.line[self.start:]
+
+
+@lru_cache(maxsize=1024)
+def compile_re(pattern):
+    """ Returns the cached regex_matcher for an expect_re() pattern """
+    return regex_matcher(pattern)
 
 
 class qutest_context():
     """ This class provides the main pytest based context."""
 
-    def __init__(self):
+    def __init__(self, config=None):
+        """
+        Args:
+          config : qutest_config with the settings of this context (default
+                   a qutest_config() of the module settings)
+        """
+        self.config = config if config is not None else qutest_config()
         self.qspy_process = None
         self.target_process = None
+        self.target_pool = None
         self.attached_event = Event()
         self.have_target_event = Event()
-        self.text_queue = Queue(maxsize=0)
+        self.text_queue = ring_buffer(self.config.TEXT_BUFFER_SIZE, self.config.TEXT_BUFFER_OVERFLOW)
+        self.text_dropped = 0
+        self.test_rx_stats = None
+        self.test_text_dropped = 0
+        self.dictionary = None
+        # Sequence number and content of the last QS_TARGET_INFO record
+        self.target_info = None
+        self.pipelined = self.config.PIPELINE_COMMANDS
+        self.ack_condition = Condition()
+        self.ack_pending = deque()
+        self.ack_failure = None
+        self.target_fault = None
+        # Record ID of the line that raised target_fault, None if no line did
+        self.fault_record = None
+        self.latency = latency_profile(self.config.EXPECT_TIMEOUT_PERCENTILE, self.config.EXPECT_TIMEOUT_MARGIN_SEC,
+                                       self.config.CACHE_DIR)
+        self.test_waited = 0.0
+        self.attach_time = None
+        self.attach_requests = 0
+        self.scheduler = None
+        self.target_clean = False
+        self.clean_on_reset = None
+        self.state_commands = 0
+        self.test_commands = 0
+        self.test_used_reset_output = False
         self.on_reset_callback = None
         self.on_setup_callback = None
         self.on_teardown_callback = None
@@ -55,34 +191,102 @@ class qutest_context():
     def session_setup(self):
         """ Setup that should run on once per session. """
 
+        start_time = time.perf_counter()
+        attach_timeout = self.config.QSPY_ATTACH_TIMEOUT_SEC
+
         # Automatically run qspy backend
-        if CONFIG.AUTOSTART_QSPY:
+        if self.config.AUTOSTART_QSPY:
             self.start_qspy()
-            # qspy will not listend for the attach immediately
-            time.sleep(CONFIG.QSPY_ATTACH_TIMEOUT_SEC)
+            # qspy will not listen for the attach immediately, allow it the
+            # startup time that used to be slept away as well
+            attach_timeout += self.config.QSPY_ATTACH_TIMEOUT_SEC
 
         self.qspy = qspy()
+        # Unwrapped callbacks for OnBatch, qspy has already fed the dictionary
+        self.batch_handlers = self.qspy.build_handlers(self)
+
+        channels = QS_CHANNEL.TEXT
+        if self.config.LOCAL_DICTIONARY:
+            # Cached entries are only used once QS_TARGET_INFO names their build
+            self.dictionary = qs_dictionary(self.config.CACHE_DIR)
+            # qspy only forwards the dictionary records on the binary channel
+            channels |= QS_CHANNEL.BINARY
+
+        self.latency.load()
+
+        if self.config.USE_LOCAL_TARGET and self.config.LOCAL_TARGET_POOL_SIZE > 0:
+            self.target_pool = target_pool(self.launch_local_target, qutest_context.halt_program,
+                                           self.config.LOCAL_TARGET_POOL_SIZE)
 
         self.attached_event.clear()
-        self.qspy.attach(self, host = CONFIG.QSPY_HOST, port = CONFIG.QSPY_UDP_PORT, local_port = CONFIG.QSPY_LOCAL_UDP_PORT)
+        self.qspy.attach(self, channels = channels, config = self.config, dictionary = self.dictionary)
         # Wait for attach
-        if not self.attached_event.wait(CONFIG.QSPY_ATTACH_TIMEOUT_SEC):
+        if not self.wait_attached(start_time, attach_timeout):
             __tracebackhide__ = True
+            # Stop the receive thread, it would keep the process alive
+            self.qspy.detach()
             pytest.fail(
                 "Timeout waiting for Attach to QSpy (is QSpy running and QSPY_COM_PORT correct?)")
 
+    def wait_attached(self, start_time, timeout):
+        """ Repeats the ATTACH request with exponential backoff until QSpy answers
+
+        Args:
+          start_time : time.perf_counter() value the session setup started at
+          timeout : seconds from start_time after which to give up
+
+        Returns:
+          True if attached, the time taken since start_time is kept in attach_time
+        """
+        deadline = start_time + timeout
+        self.attach_requests = 1
+        delay = ATTACH_RETRY_SEC
+        while not self.attached_event.wait(max(0.0, min(delay, deadline - time.perf_counter()))):
+            if time.perf_counter() >= deadline:
+                return False
+            # Requests sent before QSpy listens are lost, ask again
+            self.qspy.sendAttach(self.qspy.channels)
+            self.attach_requests += 1
+            delay = min(2 * delay, ATTACH_RETRY_MAX_SEC)
+        self.attach_time = time.perf_counter() - start_time
+        return True
+
     def session_teardown(self):
         """ Teardown that runs at the end of a session. """
         # Stop target executable
-        if CONFIG.USE_LOCAL_TARGET:
+        if self.config.USE_LOCAL_TARGET:
             self.stop_local_target()
+            if self.target_pool is not None:
+                self.target_pool.close()
 
-        self.qspy.detach()
+        self.qspy.detach(self.config.QSPY_DETACH_CONFIRM_SEC)
 
-        if CONFIG.AUTOSTART_QSPY:
+        if self.dictionary is not None:
+            self.dictionary.save_cache()
+        self.latency.save()
+
+        if self.config.AUTOSTART_QSPY:
             self.stop_qspy()
 
 
+    def session_summary(self):
+        """ Returns lines describing the session for the pytest terminal summary """
+        lines = []
+        if self.attach_time is not None:
+            lines.append('attached to QSpy in {0:.1f} ms ({1} ATTACH request{2})'.format(
+                1000 * self.attach_time, self.attach_requests, '' if self.attach_requests == 1 else 's'))
+        if self.qspy.join_time is not None:
+            if self.qspy.detach_confirmed is None:
+                confirmed = ''
+            elif self.qspy.detach_confirmed:
+                confirmed = ', DETACH confirmed by QSpy'
+            else:
+                confirmed = ', DETACH not confirmed by QSpy'
+            lines.append('qspy receive thread joined in {0:.1f} ms{1}'.format(
+                1000 * self.qspy.join_time, confirmed))
+        lines.extend(self.latency.report())
+        return lines
+
     @staticmethod
     def run_program(argumentList, startInConsole):
         """ Helper method for starting programs like qspy and target 
@@ -155,14 +359,14 @@ class qutest_context():
 
     def start_qspy(self):
         """ Helper to automatically start qspy. """
-        args = ['qspy', '-u' + str(CONFIG.QSPY_UDP_PORT)]
+        args = ['qspy', '-u' + str(self.config.QSPY_UDP_PORT)]
         
         # Local targets use tcp sockets
-        if CONFIG.USE_LOCAL_TARGET:
-            args.append('-t')
+        if self.config.USE_LOCAL_TARGET:
+            args.append('-t' + str(self.config.QSPY_TCP_PORT))
         else:
-            args.append('-c' + CONFIG.QSPY_COM_PORT)
-            args.append('-b' + str(CONFIG.QSPY_BAUD_RATE))
+            args.append('-c' + self.config.QSPY_COM_PORT)
+            args.append('-b' + str(self.config.QSPY_BAUD_RATE))
 
         # Start qspy
         self.qspy_process = qutest_context.run_program(args, True)
@@ -172,18 +376,30 @@ class qutest_context():
         if self.qspy_process is not None:
             qutest_context.halt_program(self.qspy_process)
 
+    def launch_local_target(self):
+        """ Starts a local target executable and returns its process. """
+        return qutest_context.run_program(
+            [self.config.LOCAL_TARGET_EXECUTABLE, self.config.LOCAL_TARGET_QSPY_HOST], self.config.LOCAL_TARGET_USES_CONSOLE)
+
     def start_local_target(self):
         """ Used to start a local target executable for dual targeting. """
 
-        self.target_process = qutest_context.run_program(
-            [CONFIG.LOCAL_TARGET_EXECUTABLE, CONFIG.LOCAL_TARGET_QSPY_HOST], CONFIG.LOCAL_TARGET_USES_CONSOLE)
+        if self.target_pool is not None:
+            # A warm spare is already waiting at the QSPY connection
+            self.target_process = self.target_pool.take()
+        else:
+            self.target_process = self.launch_local_target()
 
     def stop_local_target(self):
         """ Stops local target. """
 
         if self.target_process is not None:
             self.qspy.sendReset() # Sending reset halts target
-            time.sleep(0.500)
+            if self.target_pool is not None:
+                # QSPY accepts the next target as soon as this one exits
+                self.target_pool.retire(self.target_process)
+            else:
+                time.sleep(0.500)
             self.target_process = None
 
     def reset_target(self):
@@ -191,13 +407,19 @@ class qutest_context():
 
         # Clear have target flag
         self.have_target_event.clear()
+        self.target_clean = False
+
+        # Acks still outstanding from a failed test will never arrive
+        self.clear_acks()
+        self.clear_fault()
 
         # Flush queue in case they miss an expect
-        while not self.text_queue.empty():
-            print("Flushing Text:", self.text_queue.get())
+        for text in self.text_queue.get_all():
+            print("Flushing Text:", text.data)
+        self.text_dropped = self.text_queue.dropped
 
         # If running with a local target, kill and restart it
-        if CONFIG.USE_LOCAL_TARGET:
+        if self.config.USE_LOCAL_TARGET:
             if self.target_process is not None:
                 self.stop_local_target()
             self.start_local_target()
@@ -206,32 +428,51 @@ class qutest_context():
 
         # Wait for target to be back up
         assert self.have_target_event.wait(
-            CONFIG.TARGET_START_TIMEOUT_SEC), "Timeout waiting for target to reset"
+            self.config.TARGET_START_TIMEOUT_SEC), "Timeout waiting for target to reset"
+
+        if self.target_pool is not None:
+            # Only now queue the replacement spares behind the running target
+            self.target_pool.refill()
 
         # Call on_reset if defined
         if hasattr(self, "on_reset"):
             on_reset_method = getattr(self, 'on_reset')
             on_reset_method(self)
 
+    def rx_snapshot(self):
+        """ Marks the start of a test for rx_report() """
+        self.test_rx_stats = self.qspy.rxStats()
+        self.test_text_dropped = self.text_queue.dropped
+        self.test_waited = self.latency.waited
+
+    def rx_report(self):
+        """ Returns the receive telemetry since rx_snapshot() as text """
+        report = format_rx_stats(rx_stats_delta(self.test_rx_stats, self.qspy.rxStats()))
+        dropped = self.text_queue.dropped - self.test_text_dropped
+        if dropped:
+            report += '\ntext buffer overflow: {0} lines dropped ({1})'.format(
+                dropped, self.text_queue.overflow)
+        report += '\nexpect waited {0:.3f}s'.format(self.latency.waited - self.test_waited)
+        return report
+
     def Continue(self):
         """ Sends a continue to a paused target. """
 
-        self.qspy.sendContinue()
-        self.expect('           Trg-Ack  QS_RX_TEST_CONTINUE')
+        self.stimulus('QS_RX_TEST_CONTINUE', 'Continue()', self.qspy.sendContinue)
 
     def call_on_setup(self):
         """ Sends a setup command to target."""
 
-        self.qspy.sendSetup()
-        self.expect('           Trg-Ack  QS_RX_TEST_SETUP')
+        self.stimulus('QS_RX_TEST_SETUP', 'setup', self.qspy.sendSetup)
         if self.on_setup_callback is not None:
             self.on_setup_callback(self)
 
     def call_on_teardown(self):
         """ Sends a teardown command to target."""
 
-        self.qspy.sendTeardown()
-        self.expect('           Trg-Ack  QS_RX_TEST_TEARDOWN')
+        self.stimulus('QS_RX_TEST_TEARDOWN', 'teardown', self.qspy.sendTeardown)
+        # Every command of the test must be acknowledged before it ends
+        self.sync()
         if self.on_teardown_callback is not None:
             self.on_teardown_callback(self)
 
@@ -242,6 +483,22 @@ class qutest_context():
         if self.on_reset_callback is not None:
             self.on_reset_callback(self)
 
+        # Fresh for tests with the same reset handler until a command changes it
+        self.target_clean = True
+        self.clean_on_reset = self.on_reset_callback
+
+    def test_started(self):
+        """ Marks the start of a test for the reset scheduler """
+        self.test_commands = self.state_commands
+        self.test_used_reset_output = False
+
+    def note_expect(self):
+        """ Notes a test waiting for lines before its first command, taken to
+        be lines the reset made the target send
+        """
+        if self.state_commands == self.test_commands:
+            self.test_used_reset_output = True
+
 
     def expect_pause(self):
         """ Pause expectation. """
@@ -254,8 +511,7 @@ class qutest_context():
         Args:
             args : One or more qspy.FILTER enumerations
         """
-        self.qspy.sendGlobalFilters(*args)
-        self.expect('           Trg-Ack  QS_RX_GLB_FILTER')
+        self.stimulus('QS_RX_GLB_FILTER', 'glb_filter', self.qspy.sendGlobalFilters, *args)
 
     def loc_filter(self, object_kind, object_id):
         """ Sets a local filter.
@@ -265,8 +521,8 @@ class qutest_context():
           object_id : the object which can be an address integer or a dictionary name string
         """
 
-        self.qspy.sendLocalFilter(object_kind, object_id)
-        self.expect('           Trg-Ack  QS_RX_LOC_FILTER')
+        self.stimulus('QS_RX_LOC_FILTER', 'loc_filter',
+                      self.qspy.sendLocalFilter, object_kind, object_id)
 
     def current_obj(self, object_kind, object_id):
         """ Sets the current object in qspy.
@@ -276,8 +532,8 @@ class qutest_context():
         object_id : the object which can be an address integer or a dictionary name string
         """
 
-        self.qspy.sendCurrentObject(object_kind, object_id)
-        self.expect('           Trg-Ack  QS_RX_CURR_OBJ')
+        self.stimulus('QS_RX_CURR_OBJ', 'current_obj',
+                      self.qspy.sendCurrentObject, object_kind, object_id)
 
     def post(self, signal, parameters=None):
         """ Posts an event to the object selected with current_obj().
@@ -287,8 +543,8 @@ class qutest_context():
           parameters : optional event payload defined using struct.pack
         """
 
-        self.qspy.sendEvent(PRIO_COMMAND.POST.value,  signal, parameters)
-        self.expect('           Trg-Ack  QS_RX_EVENT')
+        self.stimulus('QS_RX_EVENT', 'post',
+                      self.qspy.sendEvent, PRIO_COMMAND.POST.value, signal, parameters)
 
     def publish(self, signal, parameters=None):
         """ Publishes an event in the system.
@@ -298,8 +554,8 @@ class qutest_context():
           parameters : optional event payload defined using struct.pack
         """
 
-        self.qspy.sendEvent(PRIO_COMMAND.PUBLISH,  signal, parameters)
-        self.expect('           Trg-Ack  QS_RX_EVENT')
+        self.stimulus('QS_RX_EVENT', 'publish',
+                      self.qspy.sendEvent, PRIO_COMMAND.PUBLISH, signal, parameters)
 
     def dispatch(self, signal, parameters=None):
         """ Dispatches an event to the object selected with current_obj().
@@ -309,14 +565,14 @@ class qutest_context():
           parameters : optional event payload defined using struct.pack
         """
 
-        self.qspy.sendEvent(PRIO_COMMAND.DISPATCH.value,  signal, parameters)
-        self.expect('           Trg-Ack  QS_RX_EVENT')
+        self.stimulus('QS_RX_EVENT', 'dispatch',
+                      self.qspy.sendEvent, PRIO_COMMAND.DISPATCH.value, signal, parameters)
 
     def init(self, signal=0, parameter=None):
         """ Take the top-most initial transition in the current object"""
 
-        self.qspy.sendEvent(PRIO_COMMAND.DO_INIT_TRANS, signal, parameter)
-        self.expect('           Trg-Ack  QS_RX_EVENT')
+        self.stimulus('QS_RX_EVENT', 'init',
+                      self.qspy.sendEvent, PRIO_COMMAND.DO_INIT_TRANS, signal, parameter)
 
     def probe(self, function, data_word):
         """ Sends a test probe to the target.
@@ -333,8 +589,8 @@ class qutest_context():
           data_word : a single uint 32 for the probe   
         """
 
-        self.qspy.sendTestProbe(function, data_word)
-        self.expect('           Trg-Ack  QS_RX_TEST_PROBE')
+        self.stimulus('QS_RX_TEST_PROBE', 'probe',
+                      self.qspy.sendTestProbe, function, data_word)
 
     def tick(self, rate=0):
         """ Triggers a system clock tick.
@@ -343,8 +599,7 @@ class qutest_context():
           rate : (optional) which clock rate to tick
         """
 
-        self.qspy.sendTick(rate)
-        self.expect('           Trg-Ack  QS_RX_TICK')
+        self.stimulus('QS_RX_TICK', 'tick', self.qspy.sendTick, rate)
 
     def command(self, command_id, param1=0, param2=0, param3=0):
         """ Sends a qspy command to the target.
@@ -356,8 +611,8 @@ class qutest_context():
           param3 : (optional) integer argument
         """
 
-        self.qspy.sendCommand(command_id, param1, param2, param3)
-        self.expect('           Trg-Ack  QS_RX_COMMAND')
+        self.stimulus('QS_RX_COMMAND', 'command',
+                      self.qspy.sendCommand, command_id, param1, param2, param3)
 
     def fill(self, offset, size, num, item = 0):
         """ Fills data into the target
@@ -368,8 +623,7 @@ class qutest_context():
           num : number of data items to fill
           item : (optional, default zero) data item to fill with
           """
-        self.qspy.sendFill(offset, size, num, item )
-        self.expect('           Trg-Ack  QS_RX_FILL')
+        self.stimulus('QS_RX_FILL', 'fill', self.qspy.sendFill, offset, size, num, item)
 
     def peek(self, offset, size, num):
         """ Peeks data at the given offset from the start address of the 
@@ -397,9 +651,196 @@ class qutest_context():
         assert size == 1 or size == 2 or size == 4, 'Size must be 1, 2, or 4'
         length = len(data)
         num = length // size
-        self.qspy.sendPoke(offset, size, num, data)
-        self.expect('           Trg-Ack  QS_RX_POKE')
+        self.stimulus('QS_RX_POKE', 'poke', self.qspy.sendPoke, offset, size, num, data)
+
+
+    def stimulus(self, ack, name, send, *args):
+        """ Sends a command to the target and accounts for its Trg-Ack
+
+        In lock-step mode this waits for the ack with expect(), when pipelined
+        the ack is queued and matched by the receive thread in tx order.
+
+        Args:
+          ack : QS_RX record name the target acknowledges, e.g. 'QS_RX_EVENT'
+          name : qutest method name used to identify the command in failures
+          send : qspy send method
+          args : arguments for send
+        """
+        self.check_unexpected_lines(name)
+
+        if name not in ('setup', 'teardown'):
+            # Anything but the test setup/teardown pair changes the target state
+            self.state_commands += 1
+            self.target_clean = False
+
+        if not self.pipelined:
+            send(*args)
+            self.expect_line(compile_match('           Trg-Ack  ' + ack))
+            return
+
+        self.check_acks()
+        description = '{0}({1})'.format(name, ', '.join(repr(arg) for arg in args))
+        # Queue before sending as the ack can arrive before send returns
+        entry = (ack, description, time.monotonic())
+        with self.ack_condition:
+            self.ack_pending.append(entry)
+        try:
+            send(*args)
+        except BaseException:
+            # Nothing was sent, so no ack will come for it
+            with self.ack_condition:
+                if entry in self.ack_pending:
+                    self.ack_pending.remove(entry)
+            raise
+
+    @contextmanager
+    def pipeline(self):
+        """ Sends the commands in the with block without waiting for each ack
+
+        The acks are matched in tx order as they arrive and the block ends
+        once all of them are in. A missing, failed or out-of-order ack fails
+        the test naming the command it belongs to.
+
+        Example:
+          with qutest.pipeline():
+              qutest.tick()
+              qutest.tick()
+        """
+        pipelined = self.pipelined
+        self.pipelined = True
+        try:
+            yield self
+            self.sync()
+        finally:
+            self.pipelined = pipelined
+
+    def sync(self):
+        """ Waits until every pipelined command has been acknowledged
+
+        Fails if no ack arrives for EXPECT_TIMEOUT_SEC while commands are pending.
+        """
+        with self.ack_condition:
+            while self.ack_pending and self.ack_failure is None:
+                pending = len(self.ack_pending)
+                _, description, _ = self.ack_pending[0]
+                if self.target_fault is not None:
+                    __tracebackhide__ = True
+                    pytest.fail('{0}, no ack for command {1} ({2} still pending)'.format(
+                        self.target_fault, description, pending))
+                self.ack_condition.wait(self.config.EXPECT_TIMEOUT_SEC)
+                if len(self.ack_pending) == pending and self.ack_failure is None \
+                        and self.target_fault is None:
+                    __tracebackhide__ = True
+                    pytest.fail('Ack Timeout for command {0} ({1} still pending)'.format(
+                        description, pending))
+        self.check_acks()
+
+    def check_acks(self):
+        """ Fails the test if a pipelined command was not acknowledged properly """
+        if self.ack_failure is not None:
+            failure = self.ack_failure
+            self.clear_acks()
+            __tracebackhide__ = True
+            pytest.fail(failure)
+
+    def clear_acks(self):
+        """ Forgets pipelined commands still waiting on an ack """
+        with self.ack_condition:
+            self.ack_pending.clear()
+            self.ack_failure = None
+            self.ack_condition.notify_all()
+
+    def on_ack(self, line):
+        """ Matches an ack line against the oldest pipelined command
+
+        Called on the qspy receive thread.
+
+        Returns:
+          False if no command was waiting for the ack
+        """
+        with self.ack_condition:
+            if not self.ack_pending:
+                return False
+            ack, description, sent = self.ack_pending.popleft()
+            fields = line.split()
+            if fields[:2] == ['Trg-Ack', ack]:
+                # Same key as the expect() of a lock-step command
+                self.latency.record('           Trg-Ack  ' + ack, time.monotonic() - sent)
+            elif self.ack_failure is None:
+                self.ack_failure = 'Ack Failed for command {0}! \nExpected:"Trg-Ack  {1}"\nReceived:"{2}"'.format(
+                    description, ack, line.strip())
+            self.ack_condition.notify_all()
+        return True
+
+    def expect_timeout(self, match):
+        """ Returns how long to wait for a line matching match
+
+        EXPECT_TIMEOUT_SEC, or with ADAPTIVE_EXPECT_TIMEOUT the timeout
+        derived from the waits recorded for match, at most EXPECT_TIMEOUT_SEC.
+        """
+        if self.config.ADAPTIVE_EXPECT_TIMEOUT:
+            return self.latency.timeout(match, self.config.EXPECT_TIMEOUT_SEC)
+        return self.config.EXPECT_TIMEOUT_SEC
+
+    def timeout_note(self, timeout, limit=None):
+        """ Notes an adaptive timeout in a timeout failure message
+
+        Args:
+          timeout : seconds waited
+          limit : seconds a fixed timeout would have allowed (default EXPECT_TIMEOUT_SEC)
+        """
+        if limit is None:
+            limit = self.config.EXPECT_TIMEOUT_SEC
+        if timeout < limit:
+            return ' (adaptive timeout {0:.3f}s)'.format(timeout)
+        return ''
+
+    def check_fault(self, match):
+        """ Fails the test if the target faulted and no more lines are queued
+
+        Args:
+          match : what the test was waiting for, for the failure message
+        """
+        if self.target_fault is not None and self.text_queue.empty():
+            __tracebackhide__ = True
+            pytest.fail('{0}, no more lines for match:"{1}"'.format(self.target_fault, match))
+
+    def fault_expected(self, text):
+        """ Clears the target fault when an expect matched the line that raised it
+
+        A test expecting the assertion goes on (e.g. to its teardown) as
+        if nothing had happened.
+        """
+        if text.record_id == self.fault_record:
+            self.clear_fault()
 
+    def clear_fault(self):
+        """ Forgets the target fault so expects wait for lines again """
+        with self.ack_condition:
+            self.target_fault = None
+            self.fault_record = None
+            self.text_queue.clear_interrupt()
+
+    def check_unexpected_lines(self, before):
+        """ In strict mode fails the test if lines were received that nothing expected
+
+        Args:
+          before : what is about to happen, for the failure message
+        """
+        if self.config.EXPECT_STRICT and not self.text_queue.empty():
+            lines = [text.line for text in self.text_queue.get_all()]
+            __tracebackhide__ = True
+            pytest.fail('Unexpected lines before {0}:\n{1}'.format(
+                before, '\n'.join('  "{0}"'.format(line) for line in lines)))
+
+    def check_text_overflow(self):
+        """ Fails the test if received lines were dropped since the last check """
+        dropped = self.text_queue.dropped - self.text_dropped
+        if dropped:
+            self.text_dropped = self.text_queue.dropped
+            __tracebackhide__ = True
+            pytest.fail('Text buffer overflow, {0} lines dropped ({1}, TEXT_BUFFER_SIZE={2})'.format(
+                dropped, self.text_queue.overflow, self.text_queue.capacity))
 
     def expect(self, match):
         """ asserts that match string is sent by the cut
@@ -411,57 +852,343 @@ class qutest_context():
                   %timestamp to ignore timestamp and/or 
                   postpended with * to ignore ending
         """
+        __tracebackhide__ = True
+        self.note_expect()
+        self.expect_line(compile_match(match))
 
-        try:
-            next_packet = self.text_queue.get(
-                timeout=CONFIG.EXPECT_TIMEOUT_SEC)
-        except:
-            __tracebackhide__ = True
-            pytest.fail('Expect Timeout for match:"{0}"'.format(match))
-            #assert False, 'Expect Timeout for match:"{0}"'.format(match)
+    def expect_re(self, pattern):
+        r""" asserts that the cut sends a line matching a regular expression
 
-        _, line = qspy.parse_QS_TEXT(next_packet)
+        If no line is returned in EXPECT_TIMEOUT_SEC the test will fail
 
-        magic_string = '%timestamp'
+        Args:
+          pattern : regular expression that must match the start of the line,
+                    end it with $ to match the whole line.  A %timestamp prefix
+                    skips the timestamp as in expect().
 
-        if match.startswith(magic_string):
-            line_start = len(magic_string)
-        else:
-            line_start = 0
+        Returns:
+          dict of the named groups of pattern, e.g. for
+          r'%timestamp Trg-Peek Offs=4,Size=2,Num=1,Data=<(?P<data>\w+)>'
+          {'data': '1234'}
+        """
+        __tracebackhide__ = True
+        self.note_expect()
+        return regex_matcher.groups(self.expect_line(compile_re(pattern)))
 
-        if match.endswith('*'):
-            line_end = match.find('*', line_start)
-            match = match.rstrip('*')
-        else:
-            line_end = len(match)
+    def expect_line(self, matcher):
+        """ Takes the next line from the text queue and asserts it matches
+
+        Args:
+          matcher : compiled matcher from compile_match() or compile_re()
+
+        Returns:
+          Whatever matcher.matches() returned for the line
+        """
+        self.check_acks()
+        self.check_text_overflow()
 
-        expected = match[line_start:]
-        actual = line[line_start:line_end]
-        #assert expected == actual, 'Expect Match Failed! \nExpected:\"{0}\"\nReceived:\"{1}\"'.format(expected, actual)
-        if expected != actual:
+        packets = self.text_queue.get_many(1)
+        if packets:
+            next_packet = packets[0]
+        else:
+            timeout = self.expect_timeout(matcher.match)
+            start = time.monotonic()
+            try:
+                next_packet = self.text_queue.get(timeout=timeout)
+            except:
+                __tracebackhide__ = True
+                self.check_acks()
+                self.check_text_overflow()
+                self.check_fault(matcher.match)
+                pytest.fail('Expect Timeout for match:"{0}"{1}'.format(
+                    matcher.match, self.timeout_note(timeout)))
+                #assert False, 'Expect Timeout for match:"{0}"'.format(match)
+            self.latency.record(matcher.match, time.monotonic() - start)
+
+        result = matcher.matches(next_packet)
+        if not result:
             __tracebackhide__ = True
             pytest.fail('Expect Match Failed! \nExpected:\"{0}\"\nReceived:\"{1}\"'.format(
-                expected, actual))
+                matcher.expected, matcher.actual(next_packet)))
+        if self.target_fault is not None:
+            self.fault_expected(next_packet)
+        return result
+
+    def expect_sequence(self, matches, timeout=None):
+        """ asserts that the cut sends lines matching each of matches in order
+
+        Same as calling expect() for each match, but all lines must arrive
+        within one overall timeout and are taken from the text queue in bulk.
+        The default timeout is the sum of the timeouts expect() would use
+        for the lines, so a slow line may borrow the time of fast ones.
+        The first line that does not match fails the test showing the lines
+        matched before it.
+
+        Args:
+          matches : list of match strings as used by expect()
+          timeout : (optional) seconds for the whole sequence, default the sum
+                    of the per line timeouts
+        """
+        __tracebackhide__ = True
+        self.expect_window(matches, 1, timeout)
+
+    def expect_unordered(self, matches, timeout=None):
+        """ asserts that the cut sends one line matching each of matches in any order
+
+        For lines of independent active objects whose order can vary.  Every
+        line received until all matches are satisfied must stand for a match
+        of its own; a line fitting several matches (e.g. overlapping globs)
+        is assigned so that the other lines still find theirs.
+
+        Args:
+          matches : set or list of match strings as used by expect(), a match
+                    listed twice must be matched by two lines
+          timeout : (optional) seconds for all lines, default the sum of the
+                    per line timeouts
+        """
+        __tracebackhide__ = True
+        matches = list(matches)
+        self.expect_window(matches, len(matches), timeout)
+
+    def expect_window(self, matches, window, timeout=None):
+        """ asserts that the cut sends lines matching matches with bounded reordering
+
+        The n-th line received (counting from 0) may stand for any of
+        matches[:n + window], so a line may arrive up to window - 1 places
+        before its position in matches.  The lines are assigned to the
+        matches one to one; a line that fits none of the free matches may
+        take over the match of an earlier line if that line can move to
+        another one, so the order of overlapping globs does not matter.  The
+        test fails at the first line for which no assignment exists.
+        A window of 1 is expect_sequence(), a window of len(matches) is
+        expect_unordered().
+
+        Args:
+          matches : list of match strings as used by expect()
+          window : how many places ahead of its position a line may arrive
+          timeout : (optional) seconds for all lines, default the sum of the
+                    per line timeouts
+        """
+        if not matches:
+            return
+        self.note_expect()
+        self.check_acks()
+        self.check_text_overflow()
+
+        matchers = [compile_match(match) for match in matches]
+        count = len(matchers)
+        if timeout is None:
+            # Each line gets the time expect() would give it
+            timeout = sum(self.expect_timeout(matcher.match) for matcher in matchers)
+            limit = count * self.config.EXPECT_TIMEOUT_SEC
+        else:
+            limit = timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        # Lines in arrival order, the index of the match each stands for and
+        # the line each match is taken by
+        lines = []
+        line_match = []
+        owner = [None] * count
+        fits = {}
+        waiting = None
+
+        def line_fits(line):
+            """ Indexes of the matches line may stand for, computed once per line """
+            if line not in fits:
+                packet = lines[line]
+                fits[line] = [index for index in range(min(count, line + window))
+                              if matchers[index].matches(packet)]
+            return fits[line]
+
+        def assign(line, visited):
+            """ Finds the line a match, moving earlier lines to other matches as needed """
+            for index in line_fits(line):
+                if index not in visited:
+                    visited.add(index)
+                    if owner[index] is None or assign(owner[index], visited):
+                        owner[index] = line
+                        line_match[line] = index
+                        return True
+            return False
+
+        while len(lines) < count:
+            packets = self.text_queue.get_many(count - len(lines))
+            if not packets:
+                __tracebackhide__ = True
+                pending = self.unmatched(matchers, owner)
+                self.check_fault(pending[0].match)
+                now = time.monotonic()
+                if waiting is None:
+                    waiting = now
+                remaining = deadline - now
+                if remaining <= 0:
+                    __tracebackhide__ = True
+                    self.check_acks()
+                    self.check_text_overflow()
+                    pytest.fail('Expect Timeout at line {0} of {1} for match:{2}{3}{4}'.format(
+                        len(lines) + 1, count, self.candidates(pending[:window]),
+                        self.timeout_note(timeout, limit),
+                        self.sequence_context(matchers, lines, line_match)))
+                self.text_queue.wait(remaining)
+                continue
+
+            waited = None
+            if waiting is not None:
+                waited = time.monotonic() - waiting
+                waiting = None
+
+            for packet in packets:
+                line = len(lines)
+                lines.append(packet)
+                line_match.append(None)
+                # Usually the first free match in the window fits
+                for index in range(min(count, line + window)):
+                    if owner[index] is None and matchers[index].matches(packet):
+                        owner[index] = line
+                        line_match[line] = index
+                        break
+                else:
+                    if not assign(line, set()):
+                        __tracebackhide__ = True
+                        pending = self.unmatched(matchers, owner)
+                        del lines[line:]
+                        pytest.fail('Expect Match Failed at line {0} of {1}! \nExpected:{2}\nReceived:\"{3}\"{4}'.format(
+                            line + 1, count, self.candidates(pending[:window]),
+                            pending[0].actual(packet),
+                            self.sequence_context(matchers, lines, line_match)))
+                if waited is not None:
+                    # The wait was for the first line of the batch
+                    self.latency.record(matchers[line_match[line]].match, waited)
+                    waited = None
+                if self.target_fault is not None:
+                    self.fault_expected(packet)
+
+    @staticmethod
+    def unmatched(matchers, owner):
+        """ Returns the matchers of expect_window() no line was assigned to yet """
+        return [matcher for matcher, line in zip(matchers, owner) if line is None]
+
+    @staticmethod
+    def candidates(matchers):
+        """ Formats the matches a line was compared with for a failure message """
+        if len(matchers) == 1:
+            return '"{0}"'.format(matchers[0].expected)
+        return ' one of' + ''.join('\n  "{0}"'.format(matcher.expected) for matcher in matchers)
+
+    @staticmethod
+    def sequence_context(matchers, lines, line_match, count=3):
+        """ Formats the last lines matched by expect_window() for a failure message
+
+        Args:
+          matchers : the matchers of expect_window()
+          lines : the lines received in the order they arrived
+          line_match : index of the matcher each line was assigned to
+        """
+        if not lines:
+            return ''
+        context = ['\nMatched before:']
+        for index in range(max(0, len(lines) - count), len(lines)):
+            context.append('  {0}: "{1}"'.format(
+                index + 1, matchers[line_match[index]].actual(lines[index])))
+        return '\n'.join(context)
 
     ################### qspy backend callbacks #######################
 
+    def is_pipelined_ack(self, record):
+        """ Matches the ack of a pipelined command instead of queueing it for expect()
+
+        Returns:
+          True if record was the ack of a pipelined command
+        """
+        if record[2] == QSpyRecords.QS_RX_STATUS and self.ack_pending:
+            _, line = qspy.parse_QS_TEXT(record)
+            return self.on_ack(line)
+        return False
+
+    def queue_assertion(self, lines, assertion):
+        """ Queues lines for expect() and flags the target assertion among them
+
+        Args:
+          lines : qs_text_record list to queue
+          assertion : the QS_ASSERT_FAIL qs_text_record of lines
+        """
+        # Under the lock an expect cannot take the line before the fault is set
+        with self.ack_condition:
+            self.text_queue.put_many(lines)
+            self.fault('Target assertion failed "{0}"'.format(assertion.line.strip()),
+                       QSpyRecords.QS_ASSERT_FAIL)
+
+    def fault(self, message, record_id=None):
+        """ Flags that the target will not send the expected lines anymore
+
+        Called on the qspy receive thread, waiting expects and syncs fail
+        at once (after the lines already queued) instead of timing out,
+        unless an expect matches the line with record_id that raised it.
+        """
+        with self.ack_condition:
+            if self.target_fault is None:
+                self.target_fault = message
+                self.fault_record = record_id
+            self.text_queue.interrupt()
+            self.ack_condition.notify_all()
+
+    def OnBatch(self, packets):
+        # Text lines of the whole batch go into the text queue at once
+        handlers = self.batch_handlers
+        lines = []
+        assertion = None
+        for packet in packets:
+            if packet[1] == QSpyRecords.QS_TEXT:
+                if not self.is_pipelined_ack(packet):
+                    lines.append(qs_text_record(packet))
+                    if packet[2] == QSpyRecords.QS_ASSERT_FAIL:
+                        assertion = lines[-1]
+            else:
+                handlers[packet[1]](packet)
+        if assertion is not None:
+            self.queue_assertion(lines, assertion)
+        elif lines:
+            self.text_queue.put_many(lines)
+
     def OnRecord_QS_TARGET_INFO(self, packet):
+        # On both channels qspy may pass the record twice in a row
+        target_info = (packet[0], bytes(packet[1:]))
+        if (self.target_info is not None and target_info[1] == self.target_info[1]
+                and target_info[0] == (self.target_info[0] + 1) & 0xFF):
+            return
+        self.target_info = target_info
+
+        # Only reset_target() and session start wait for the target info
+        if self.have_target_event.is_set():
+            self.fault('Target reset unexpectedly')
+        if self.dictionary is not None:
+            self.dictionary.set_target(target_key(packet))
         self.have_target_event.set()
 
     def OnPacket_ATTACH(self, packet):
         self.attached_event.set()
 
     def OnRecord_QS_TEXT(self, record):
-        # put packet in text queue
-        self.text_queue.put(record)
+        if not self.is_pipelined_ack(record):
+            # put line in text queue, copying it out of the qspy receive buffer
+            text = qs_text_record(record)
+            if record[2] == QSpyRecords.QS_ASSERT_FAIL:
+                self.queue_assertion([text], text)
+            else:
+                self.text_queue.put(text)
         #recordId, line = self.qspy.parse_QS_TEXT(record)
         #print('OnRecord_QS_TEXT record:{0}, line:"{1}"'.format(recordId.name, line) )
 
 def main():
     """ Main entry point for qutest """
 
-    options = ['-v', '--tb=short']
+    options = ['-v', '--tb=short', '-p', 'qspypy.qutest_scheduler']
     
+    # Settings from the command line, overlaid on the settings of the
+    # session once conftest.py has had its say
+    overrides = {}
+
     # Parse command line like Tcl script
     num_tests = 0
     args = sys.argv[1:]
@@ -486,23 +1213,24 @@ def main():
     if num_args > (num_tests) : 
         host_exe = args[num_tests]
         if len(host_exe) > 0: # passing "" means no local host
-            CONFIG.USE_LOCAL_TARGET = True
-            CONFIG.LOCAL_TARGET_EXECUTABLE = host_exe
+            overrides['USE_LOCAL_TARGET'] = True
+            overrides['LOCAL_TARGET_EXECUTABLE'] = host_exe
             #print(f'host_exe:{host_exe}')
     if num_args > (1 + num_tests): 
         host_port = args[1 + num_tests]
         host = host_port.split(':')
-        CONFIG.QSPY_HOST = host[0]
+        overrides['QSPY_HOST'] = host[0]
         if len(host) > 1: 
             port = host[1]
-            CONFIG.QSPY_UDP_PORT = int(port)
+            overrides['QSPY_UDP_PORT'] = int(port)
         #print(f'host_port:{host_port}')
     if num_args > (2 + num_tests): 
         local_port = args[2 + num_tests]
-        CONFIG.QSPY_LOCAL_UDP_PORT = int(local_port)
+        overrides['QSPY_LOCAL_UDP_PORT'] = int(local_port)
 
-    # Run pytest with options
-    pytest.main(options)
+    # Run pytest with options, the session fixture picks up the overrides
+    from qspypy.fixtures import session_config
+    pytest.main(options, plugins=[session_config(overrides)])
 
 if __name__ == "__main__":
     main()
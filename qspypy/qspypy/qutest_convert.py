@@ -33,6 +33,8 @@ def usage():
     print(" Converts one or more qutest Tcl scripts to Python.")
     print(" Example Usage:")
     print("     qutest_tcl2py test_example1.tcl test_example2.tcl")
+    print(" Options:")
+    print("     --group  write runs of expect lines as one expect_sequence() call")
 
 def write_header(file, tcl_script):
     file.write('#\n')
@@ -52,7 +54,18 @@ def write_footer(file):
     pytest.main(options)
 """)
 
-def convert(tcl_script):
+def write_expects(file, expects):
+    """ Writes the expect arguments collected by convert() and empties the list """
+    if len(expects) == 1:
+        file.write(f'    qutest.expect({expects[0]})\n')
+    elif expects:
+        file.write('    qutest.expect_sequence([\n')
+        for arguments in expects:
+            file.write(f'        {arguments},\n')
+        file.write('    ])\n')
+    expects.clear()
+
+def convert(tcl_script, group=False):
     base=os.path.basename(tcl_script)
     name, ext = os.path.splitext(base)
     py_script = name + ".py"
@@ -61,10 +74,15 @@ def convert(tcl_script):
     obj_kind_set = set([name for name, member in QS_OBJ_KIND.__members__.items()])
     filter_set = set([name for name, member in FILTER.__members__.items()])
 
+    # Arguments of consecutive expect lines when grouping
+    expects = []
+
     with open(tcl_script, 'r') as tcl:
         with open(py_script, 'w') as py:
             write_header(py, tcl_script)
             for line in tcl:
+                if group and not line.startswith('#') and line.split()[:1] != ['expect']:
+                    write_expects(py, expects)
                 if not line in ['\n', '\r\n']:
                     tokens = line.split()
                     if line.startswith('#'):                    
@@ -121,9 +139,13 @@ def convert(tcl_script):
                             else:
                                 arguments = ",".join(map(argmap, tokens[1:]))
 
-                        py.write(f'    qutest.{method}({arguments})\n')
+                        if group and method == 'expect':
+                            expects.append(arguments)
+                        else:
+                            py.write(f'    qutest.{method}({arguments})\n')
                 else:
                     py.write(line)     
+            write_expects(py, expects)
             write_footer(py)    
 
 def create_conftest():
@@ -147,9 +169,10 @@ def main():
 
     create_conftest()
 
-    input_files = sys.argv[1:]
+    input_files = [arg for arg in sys.argv[1:] if arg != '--group']
+    group = '--group' in sys.argv[1:]
     for file in input_files:
-        convert(file)
+        convert(file, group)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,139 @@
+# MIT License
+#
+# Copyright (c) 2018 Lotus Engineering, LLC
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+#
+# Latency profile of the lines waited for by expect(), used to report where
+# a session spent its time waiting and to derive expect timeouts from the
+# latencies observed in earlier sessions.
+#
+
+import json
+import os
+
+
+# File in the cache directory holding the profile
+LATENCY_FILE = 'qutest_latency.json'
+
+# Most recent samples kept per match string
+LATENCY_SAMPLES = 200
+
+# Samples needed before a match string gets a timeout of its own
+LATENCY_MIN_SAMPLES = 20
+
+
+class latency_profile():
+    """ Per match string record of how long expect() waited for its line.
+
+    Only waits that blocked are recorded, a line already received when
+    expect() was called says nothing about the target latency.
+    """
+
+    def __init__(self, percentile=99.0, margin=0.050, cache_dir=None):
+        """
+        Args:
+          percentile : percentile of the samples a derived timeout covers
+          margin : seconds added to the percentile
+          cache_dir : directory the profile is saved in, None to not save it
+        """
+        self.percentile = percentile
+        self.margin = margin
+        self.cache_dir = cache_dir
+        # match string -> recent wait times, persisted
+        self.samples = {}
+        # match string -> [waits, total seconds] of this session
+        self.session = {}
+        self.waited = 0.0
+        self.timeouts = {}
+
+    def record(self, match, seconds):
+        """ Records that expect() waited seconds for a line matching match """
+        samples = self.samples.setdefault(match, [])
+        samples.append(seconds)
+        if len(samples) > LATENCY_SAMPLES:
+            del samples[0]
+        self.timeouts.pop(match, None)
+
+        waits = self.session.setdefault(match, [0, 0.0])
+        waits[0] += 1
+        waits[1] += seconds
+        self.waited += seconds
+
+    def quantile(self, match, percentile):
+        """ Returns the percentile of the recorded waits for match, None without samples """
+        samples = self.samples.get(match)
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(len(ordered) * percentile / 100.0))
+        return ordered[index]
+
+    def timeout(self, match, limit):
+        """ Returns the timeout for waiting on a line matching match
+
+        The percentile of the recorded waits plus the margin, never more
+        than limit.  Returns limit until LATENCY_MIN_SAMPLES are recorded.
+        """
+        timeout = self.timeouts.get(match)
+        if timeout is None:
+            timeout = limit
+            if len(self.samples.get(match, ())) >= LATENCY_MIN_SAMPLES:
+                timeout = min(limit, self.quantile(match, self.percentile) + self.margin)
+            self.timeouts[match] = timeout
+        return min(timeout, limit)
+
+    def report(self, count=10):
+        """ Returns lines listing the match strings this session waited longest for """
+        if not self.session:
+            return []
+        lines = ['expect waited {0:.3f}s in total, longest waits:'.format(self.waited)]
+        longest = sorted(self.session.items(), key=lambda item: -item[1][1])[:count]
+        for match, (waits, total) in longest:
+            lines.append('  {0:8.3f}s {1:5} waits, p{2:g} {3:.3f}s  "{4}"'.format(
+                total, waits, self.percentile, self.quantile(match, self.percentile), match))
+        return lines
+
+    def cache_path(self):
+        return os.path.join(self.cache_dir, LATENCY_FILE)
+
+    def load(self):
+        """ Loads the samples saved by earlier sessions
+
+        Returns:
+          True if samples were loaded
+        """
+        if self.cache_dir is None:
+            return False
+        try:
+            with open(self.cache_path(), 'r') as cache:
+                self.samples = json.load(cache)['samples']
+        except (OSError, ValueError, KeyError):
+            return False
+        self.timeouts = {}
+        return True
+
+    def save(self):
+        """ Saves the samples for later sessions """
+        if self.cache_dir is None or not self.samples:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self.cache_path(), 'w') as cache:
+            json.dump({'samples': self.samples}, cache)
@@ -0,0 +1,204 @@
+# MIT License
+#
+# Copyright (c) 2018 Lotus Engineering, LLC
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+#
+# pytest plugin that cuts down on target resets.  Tests using the qutest
+# fixture start from a reset target, those using qutest_noreset continue
+# from the test before them, so the tests form chains that each start with
+# a reset.  With config.MINIMIZE_RESETS the reset of a chain is skipped when
+# the target is still as its last reset left it, and the chains of a module
+# are ordered so that the ones known to leave the target untouched run
+# first.  What each test did to the target is kept in a history file.
+#
+# Loaded by qutest, with plain pytest add
+#   pytest_plugins = ['qspypy.qutest_scheduler']
+# to the top level conftest.py.
+#
+
+import json
+import os
+import time
+
+import pytest
+
+from qspypy.config import qutest_config
+
+
+# File in the cache directory holding the test history
+SCHEDULE_FILE = 'qutest_schedule.json'
+
+
+class reset_scheduler():
+    """ Orders the test chains and decides which resets can be skipped.
+
+    A test may skip its reset when the target is clean, i.e. reset with the
+    same on_reset() handler and sent nothing but test setup/teardown since,
+    and the test did not wait for lines before its first command the last
+    time it ran (those are taken to be lines the reset makes the target
+    send).  Tests without history are always reset.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.cache_dir = None
+        # test node id -> {'clean': left the target clean, 'reset_output': waited for reset lines}
+        self.history = {}
+        self.context = None
+        self.target_tests = set()
+        self.failed = set()
+        self.chains = 0
+        self.moved = 0
+        self.resets = 0
+        self.skipped = 0
+        self.reset_seconds = 0.0
+
+    def cache_path(self):
+        return os.path.join(self.cache_dir, SCHEDULE_FILE)
+
+    def load(self):
+        """ Loads the history of earlier sessions
+
+        Returns:
+          True if history was loaded
+        """
+        if self.cache_dir is None:
+            return False
+        try:
+            with open(self.cache_path(), 'r') as cache:
+                self.history = json.load(cache)['tests']
+        except (OSError, ValueError, KeyError):
+            return False
+        return True
+
+    def save(self):
+        """ Saves the history for later sessions """
+        if self.cache_dir is None or not self.history:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self.cache_path(), 'w') as cache:
+            json.dump({'tests': self.history}, cache, indent=1)
+
+    def can_skip(self, nodeid):
+        """ True if the history says the test does not need the reset's lines """
+        return nodeid in self.history and not self.history[nodeid]['reset_output']
+
+    def leaves_clean(self, chain):
+        """ True if the history says every test of the chain leaves the target clean """
+        return all(item.nodeid in self.history and self.history[item.nodeid]['clean']
+                   for item in chain if item.nodeid in self.target_tests)
+
+    def chain_order(self, chain):
+        """ Sort key of a chain within its module: chains that leave the target
+        clean first, the ones that need a reset anyway at the front so the
+        others can use it, then chains that can start on a clean target.
+        """
+        if 'qutest' not in getattr(chain[0], 'fixturenames', ()):
+            # Tests before the first reset of the module stay in front
+            return -1
+        clean = self.leaves_clean(chain)
+        skip = self.can_skip(chain[0].nodeid)
+        if clean:
+            return 1 if skip else 0
+        return 2 if skip else 3
+
+    @pytest.hookimpl(trylast=True)
+    def pytest_collection_modifyitems(self, session, config, items):
+        settings = qutest_config()
+        self.enabled = settings.MINIMIZE_RESETS and settings.RESET_TARGET_ON_SETUP
+        if not self.enabled:
+            return
+        self.cache_dir = settings.CACHE_DIR
+        self.load()
+
+        # A qutest test starts a chain, the other tests after it in the same
+        # module (qutest_noreset ones and those not using the target) continue it
+        modules = {}
+        for item in items:
+            fixtures = getattr(item, 'fixturenames', ())
+            module = modules.setdefault(getattr(item, 'module', None), [])
+            if 'qutest' in fixtures or 'qutest_noreset' in fixtures:
+                self.target_tests.add(item.nodeid)
+            if 'qutest' in fixtures or not module:
+                module.append([item])
+            else:
+                module[-1].append(item)
+
+        ordered = []
+        for chains in modules.values():
+            self.chains += len(chains)
+            in_order = sorted(chains, key=self.chain_order)
+            self.moved += sum(1 for before, after in zip(chains, in_order) if before is not after)
+            for chain in in_order:
+                ordered.extend(chain)
+        items[:] = ordered
+
+    def set_context(self, context):
+        """ Sets the qutest_context the tests of the session run on """
+        self.context = context
+        context.scheduler = self
+
+    def reset(self, context, item):
+        """ Resets the target for a qutest test unless it can be skipped """
+        if (context.target_clean and context.clean_on_reset is context.on_reset_callback
+                and self.can_skip(item.nodeid)):
+            self.skipped += 1
+            return
+        start_time = time.perf_counter()
+        context.call_on_reset()
+        self.reset_seconds += time.perf_counter() - start_time
+        self.resets += 1
+
+    def pytest_runtest_logreport(self, report):
+        if not self.enabled or self.context is None or report.nodeid not in self.target_tests:
+            return
+        if report.failed:
+            self.failed.add(report.nodeid)
+        if report.when != 'teardown':
+            return
+
+        # A failed test, a command or a line left over leave the target dirty
+        context = self.context
+        clean = (report.nodeid not in self.failed and context.state_commands == context.test_commands
+                 and context.text_queue.empty())
+        if not clean:
+            context.target_clean = False
+        self.history[report.nodeid] = {'clean': clean, 'reset_output': context.test_used_reset_output}
+
+    def pytest_sessionfinish(self, session):
+        if self.enabled:
+            self.save()
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if not self.enabled or self.resets + self.skipped == 0:
+            return
+        terminalreporter.section('qspypy reset scheduler')
+        line = '{0} of {1} resets skipped'.format(self.skipped, self.resets + self.skipped)
+        if self.resets:
+            per_reset = self.reset_seconds / self.resets
+            line += ', saving about {0:.1f}s at {1:.0f} ms per reset'.format(
+                self.skipped * per_reset, 1000 * per_reset)
+        terminalreporter.write_line(line)
+        terminalreporter.write_line('{0} of {1} test chains reordered'.format(self.moved, self.chains))
+
+
+def pytest_configure(config):
+    config.pluginmanager.register(reset_scheduler(), 'qspypy_reset_scheduler')
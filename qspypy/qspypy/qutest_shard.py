@@ -0,0 +1,307 @@
+# MIT License
+#
+# Copyright (c) 2018 Lotus Engineering, LLC
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+#
+# Command line tool that runs a qutest suite as parallel shards.  Each worker
+# is a pytest process with its own QSPY ports and target (a local target
+# executable, a serial port or an already running QSPY), given to it through
+# QSPYPY_<NAME> environment overrides of config.py.  Test files are balanced
+# over the workers by their durations in earlier runs and the workers' junit
+# results are merged into one file.
+#
+
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ElementTree
+
+import qspypy.config as CONFIG
+
+
+# File in the cache directory holding the test file durations
+SHARD_FILE = 'qutest_shard.json'
+
+# Duration assumed for a test file that has not been run before
+DEFAULT_DURATION_SEC = 10.0
+
+
+class shard_durations():
+    """ Durations of the test files in earlier runs, used to balance the shards """
+
+    def __init__(self, cache_dir=None):
+        """
+        Args:
+          cache_dir : directory the durations are saved in, None to not save them
+        """
+        self.cache_dir = cache_dir
+        # test file -> seconds its tests took
+        self.durations = {}
+
+    def cache_path(self):
+        return os.path.join(self.cache_dir, SHARD_FILE)
+
+    def estimate(self, test_file):
+        """ Returns the expected duration of a test file """
+        if test_file in self.durations:
+            return self.durations[test_file]
+        if self.durations:
+            # New files are assumed to be average
+            return sum(self.durations.values()) / len(self.durations)
+        return DEFAULT_DURATION_SEC
+
+    def update(self, test_file, seconds):
+        self.durations[test_file] = seconds
+
+    def load(self):
+        """ Loads the durations saved by earlier runs
+
+        Returns:
+          True if durations were loaded
+        """
+        if self.cache_dir is None:
+            return False
+        try:
+            with open(self.cache_path(), 'r') as cache:
+                self.durations = json.load(cache)['durations']
+        except (OSError, ValueError, KeyError):
+            return False
+        return True
+
+    def save(self):
+        """ Saves the durations for later runs """
+        if self.cache_dir is None or not self.durations:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self.cache_path(), 'w') as cache:
+            json.dump({'durations': self.durations}, cache, indent=1)
+
+
+def find_test_files(paths):
+    """ Expands the command line paths into test files, like pytest the
+    default is every test_*.py and *_test.py below the current directory.
+    """
+    if not paths:
+        paths = ['.']
+    test_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for pattern in ('test_*.py', '*_test.py'):
+                test_files.extend(glob.glob(os.path.join(path, '**', pattern), recursive=True))
+        else:
+            test_files.append(path)
+    return sorted(set(os.path.relpath(test_file) for test_file in test_files))
+
+
+def balance(test_files, durations, workers):
+    """ Splits the test files into shards of about equal expected duration,
+    longest file first onto the shard with the least work so far.
+
+    Returns:
+      list of (expected seconds, [test files]) per worker
+    """
+    shards = [[0.0, []] for _ in range(workers)]
+    for test_file in sorted(test_files, key=durations.estimate, reverse=True):
+        shard = min(shards, key=lambda shard: shard[0])
+        shard[0] += durations.estimate(test_file)
+        shard[1].append(test_file)
+    return [(expected, sorted(files)) for expected, files in shards if files]
+
+
+def worker_environment(index, args):
+    """ config.py overrides giving worker index its own QSPY and target """
+    environment = {'QSPY_UDP_PORT': args.udp_port + index}
+
+    # Parallel workers would overwrite each other's cache files
+    if CONFIG.CACHE_DIR is not None:
+        environment['CACHE_DIR'] = os.path.join(CONFIG.CACHE_DIR, 'worker{0}'.format(index))
+    else:
+        environment['CACHE_DIR'] = None
+    if CONFIG.QSPY_LOCAL_UDP_PORT is not None:
+        environment['QSPY_LOCAL_UDP_PORT'] = CONFIG.QSPY_LOCAL_UDP_PORT + index
+
+    if args.qspy:
+        # Already running QSPY instances, one per worker
+        host, _, port = args.qspy[index].partition(':')
+        environment['QSPY_HOST'] = host
+        environment['QSPY_UDP_PORT'] = int(port) if port else CONFIG.QSPY_UDP_PORT
+        environment['AUTOSTART_QSPY'] = False
+    elif args.com_ports:
+        # A board per serial port, each with its own QSPY
+        environment['QSPY_COM_PORT'] = args.com_ports[index]
+        environment['USE_LOCAL_TARGET'] = False
+        environment['AUTOSTART_QSPY'] = True
+    else:
+        # Local target executables, each connected to its own QSPY
+        tcp_port = args.tcp_port + index
+        environment['USE_LOCAL_TARGET'] = True
+        environment['LOCAL_TARGET_EXECUTABLE'] = args.host_exe
+        environment['LOCAL_TARGET_QSPY_HOST'] = 'localhost:{0}'.format(tcp_port)
+        environment['QSPY_TCP_PORT'] = tcp_port
+        environment['AUTOSTART_QSPY'] = True
+
+    return {CONFIG.ENVIRONMENT_PREFIX + name: str(value) for name, value in environment.items()}
+
+
+def file_durations(junit_path, test_files):
+    """ Sums the junit test case times of each test file
+
+    Test cases are matched to files by their classname, the dotted module
+    path relative to the pytest rootdir.
+    """
+    modules = {test_file: '.' + os.path.splitext(test_file)[0].replace(os.sep, '.').lstrip('.') + '.'
+               for test_file in test_files}
+    durations = {}
+    for testcase in ElementTree.parse(junit_path).iter('testcase'):
+        classname = '.' + testcase.get('classname', '') + '.'
+        for test_file, module in modules.items():
+            if module in classname:
+                durations[test_file] = durations.get(test_file, 0.0) + float(testcase.get('time', 0.0))
+                break
+    return durations
+
+
+def merge_junit(junit_paths, output_path):
+    """ Writes the test suites of all workers into one junit file
+
+    Returns:
+      dict of tests, failures, errors and skipped totals
+    """
+    merged = ElementTree.Element('testsuites')
+    totals = {'tests': 0, 'failures': 0, 'errors': 0, 'skipped': 0}
+    for index, junit_path in enumerate(junit_paths):
+        root = ElementTree.parse(junit_path).getroot()
+        suites = [root] if root.tag == 'testsuite' else root.findall('testsuite')
+        for suite in suites:
+            suite.set('name', '{0} (worker {1})'.format(suite.get('name', 'pytest'), index))
+            for total in totals:
+                totals[total] += int(suite.get(total, 0))
+            merged.append(suite)
+    if output_path is not None:
+        ElementTree.ElementTree(merged).write(output_path, encoding='utf-8', xml_declaration=True)
+    return totals
+
+
+def run_shards(shards, args, output_dir):
+    """ Runs each shard in a pytest process of its own and waits for all of them
+
+    Returns:
+      list of (return code, seconds, junit path, log path) per shard
+    """
+    workers = []
+    for index, (expected, test_files) in enumerate(shards):
+        junit_path = os.path.join(output_dir, 'worker{0}.xml'.format(index))
+        log_path = os.path.join(output_dir, 'worker{0}.log'.format(index))
+        command = [sys.executable, '-m', 'pytest', '-v', '--tb=short',
+                   '--junitxml=' + junit_path] + args.pytest_args + test_files
+        environment = dict(os.environ, **worker_environment(index, args))
+        log = open(log_path, 'w')
+        print('worker {0}: {1} file(s), expected {2:.1f} s'.format(index, len(test_files), expected))
+        workers.append((subprocess.Popen(command, env=environment, stdout=log, stderr=subprocess.STDOUT),
+                        log, time.perf_counter(), junit_path, log_path))
+
+    results = []
+    for process, log, start_time, junit_path, log_path in workers:
+        process.wait()
+        log.close()
+        results.append((process.returncode, time.perf_counter() - start_time, junit_path, log_path))
+    return results
+
+
+def main():
+    """ Entry point for qutest_shard """
+    parser = argparse.ArgumentParser(
+        description='Runs qutest test files in parallel, each worker with its own QSPY and target',
+        epilog='Arguments after -- are passed to every pytest worker')
+    parser.add_argument('tests', nargs='*', help='test files or directories (default: current directory)')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--host-exe', help='local target executable, a copy is run per worker')
+    target.add_argument('--com-ports', type=lambda text: text.split(','),
+                        help='comma separated serial ports, one target board per worker')
+    target.add_argument('--qspy', type=lambda text: text.split(','),
+                        help='comma separated host[:port] of already running QSPY instances, one per worker')
+    parser.add_argument('-n', '--workers', type=int, default=2,
+                        help='number of workers for --host-exe (default 2)')
+    parser.add_argument('--udp-port', type=int, default=CONFIG.QSPY_UDP_PORT,
+                        help='QSPY UDP port of the first worker, the others count up (default {0})'.format(
+                            CONFIG.QSPY_UDP_PORT))
+    parser.add_argument('--tcp-port', type=int, default=CONFIG.QSPY_TCP_PORT,
+                        help='QSPY TCP target port of the first worker, the others count up (default {0})'.format(
+                            CONFIG.QSPY_TCP_PORT))
+    parser.add_argument('--junitxml', help='file to write the merged junit results to')
+
+    argv = sys.argv[1:]
+    pytest_args = []
+    if '--' in argv:
+        pytest_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+    args.pytest_args = pytest_args
+
+    if args.qspy:
+        workers = len(args.qspy)
+    elif args.com_ports:
+        workers = len(args.com_ports)
+    else:
+        workers = args.workers
+
+    test_files = find_test_files(args.tests)
+    if not test_files:
+        print('No test files found')
+        return 4
+
+    durations = shard_durations(CONFIG.CACHE_DIR)
+    durations.load()
+    shards = balance(test_files, durations, workers)
+
+    output_dir = tempfile.mkdtemp(prefix='qutest_shard_')
+    start_time = time.perf_counter()
+    results = run_shards(shards, args, output_dir)
+    elapsed = time.perf_counter() - start_time
+
+    junit_paths = []
+    exit_code = 0
+    for index, ((expected, test_files), (returncode, seconds, junit_path, log_path)) in enumerate(zip(shards, results)):
+        print('worker {0}: exit code {1} in {2:.1f} s (expected {3:.1f} s), log {4}'.format(
+            index, returncode, seconds, expected, log_path))
+        if returncode != 0:
+            exit_code = exit_code or returncode
+            with open(log_path, 'r') as log:
+                sys.stdout.write(log.read())
+        if os.path.exists(junit_path):
+            junit_paths.append(junit_path)
+            for test_file, seconds in file_durations(junit_path, test_files).items():
+                durations.update(test_file, seconds)
+    durations.save()
+
+    totals = merge_junit(junit_paths, args.junitxml)
+    print('{0} tests, {1} failures, {2} errors, {3} skipped on {4} workers in {5:.1f} s'.format(
+        totals['tests'], totals['failures'], totals['errors'], totals['skipped'], len(shards), elapsed))
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,165 @@
+# MIT License
+#
+# Copyright (c) 2018 Lotus Engineering, LLC
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+#
+# Single producer/single consumer ring buffer used to hand received lines
+# from the qspy receive thread to expect() without a lock per line.
+#
+
+from collections import deque
+from queue import Empty
+from threading import Event
+import time
+
+
+# Overflow policies
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+
+
+class ring_buffer():
+    """ Bounded FIFO for one producer thread and one consumer thread.
+
+    Items are kept in a deque, whose append and popleft are atomic, so
+    neither side takes a lock.  The consumer is only notified when it is
+    waiting, which means one notification per burst of puts.  When the
+    buffer is full the overflow policy drops either the oldest or the
+    newest item and the drop is counted in dropped.
+    """
+
+    def __init__(self, capacity, overflow=DROP_OLDEST):
+        assert capacity > 0, 'ring_buffer capacity must be positive'
+        assert overflow in (DROP_OLDEST, DROP_NEWEST), 'unknown overflow policy:{0}'.format(overflow)
+        self.items = deque()
+        self.capacity = capacity
+        self.overflow = overflow
+        self.dropped = 0
+        self.waiting = False
+        self.interrupted = False
+        self.ready = Event()
+
+    def __len__(self):
+        return len(self.items)
+
+    def empty(self):
+        return not self.items
+
+    def put(self, item):
+        """ Adds an item, called by the producer
+
+        Returns:
+          False if the item itself was dropped
+        """
+        items = self.items
+        if len(items) >= self.capacity:
+            self.dropped += 1
+            if self.overflow == DROP_NEWEST:
+                return False
+            items.popleft()
+        items.append(item)
+        self.notify()
+        return True
+
+    def put_many(self, new_items):
+        """ Adds a list of items with a single notification, called by the producer """
+        items = self.items
+        free = self.capacity - len(items)
+        if len(new_items) > free:
+            if self.overflow == DROP_NEWEST:
+                self.dropped += len(new_items) - free
+                new_items = new_items[:free]
+            else:
+                self.dropped += len(new_items) - free
+                for _ in range(min(len(new_items) - free, len(items))):
+                    items.popleft()
+                new_items = new_items[-self.capacity:]
+        items.extend(new_items)
+        self.notify()
+
+    def notify(self):
+        if self.waiting:
+            self.waiting = False
+            self.ready.set()
+
+    def interrupt(self):
+        """ Makes wait() return at once until clear_interrupt(), called from any thread """
+        self.interrupted = True
+        self.ready.set()
+
+    def clear_interrupt(self):
+        self.interrupted = False
+
+    def wait(self, timeout):
+        """ Waits until the buffer has items or is interrupted, called by the consumer
+
+        Returns:
+          True if there are items
+        """
+        if self.items:
+            return True
+        # Publish waiting only after clearing ready so a put in between is not lost
+        self.ready.clear()
+        self.waiting = True
+        if not self.items and not self.interrupted:
+            self.ready.wait(timeout)
+        self.waiting = False
+        return bool(self.items)
+
+    def get(self, timeout=None):
+        """ Removes the oldest item, called by the consumer
+
+        Raises:
+          queue.Empty if no item arrives within timeout seconds or the
+          buffer is empty and interrupted
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                return self.items.popleft()
+            except IndexError:
+                pass
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if self.interrupted or (remaining is not None and remaining <= 0):
+                raise Empty
+            self.wait(remaining)
+
+    def get_many(self, count):
+        """ Removes and returns up to count of the oldest items without waiting,
+        called by the consumer
+        """
+        items = []
+        try:
+            while len(items) < count:
+                items.append(self.items.popleft())
+        except IndexError:
+            pass
+        return items
+
+    def get_all(self):
+        """ Removes and returns every item in the buffer, called by the consumer """
+        items = []
+        try:
+            while True:
+                items.append(self.items.popleft())
+        except IndexError:
+            pass
+        return items
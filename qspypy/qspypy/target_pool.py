@@ -0,0 +1,114 @@
+# MIT License
+#
+# Copyright (c) 2018 Lotus Engineering, LLC
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+#
+# Pool of spare local target processes.  A spare is started ahead of time,
+# connects to QSPY's target port and waits in its listen backlog, so when
+# the running target exits on reset QSPY accepts the spare straight away.
+#
+
+from collections import deque
+import subprocess
+import threading
+
+
+class target_pool():
+    """ Keeps spare local target processes started for reset_target().
+
+    take() hands out a spare, refill() starts replacements in the background
+    once the taken target is connected, retire() waits for a target to exit
+    in the background and stops it if it does not.
+    """
+
+    def __init__(self, start, stop, size=1, exit_timeout=0.500):
+        """
+        Args:
+          start : callable starting a target process and returning its Popen
+          stop : callable forcing a target process to stop
+          size : number of spares kept started
+          exit_timeout : seconds a retired target gets to exit by itself
+        """
+        self.start = start
+        self.stop = stop
+        self.size = size
+        self.exit_timeout = exit_timeout
+        self.spares = deque()
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def fill(self):
+        """ Starts spares until there are size of them """
+        with self.lock:
+            while len(self.spares) < self.size:
+                self.spares.append(self.start())
+
+    def take(self):
+        """ Returns a started target process, a spare if one is ready """
+        with self.lock:
+            process = None
+            while self.spares and process is None:
+                process = self.spares.popleft()
+                if process.poll() is not None:
+                    # Spare died while waiting, e.g. QSPY refused it
+                    process = None
+        if process is None:
+            process = self.start()
+        return process
+
+    def refill(self):
+        """ Starts the spares taken so far in the background """
+        self.background(self.fill)
+
+    def retire(self, process):
+        """ Lets a target that was told to exit (e.g. by a reset) do so in the background """
+        def wait_exit():
+            try:
+                process.wait(self.exit_timeout)
+            except subprocess.TimeoutExpired:
+                self.halt(process)
+        self.background(wait_exit)
+
+    def halt(self, process):
+        """ Stops a process and waits for it, so it does not stay a zombie """
+        self.stop(process)
+        try:
+            process.wait(self.exit_timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+    def background(self, work):
+        self.threads = [thread for thread in self.threads if thread.is_alive()]
+        thread = threading.Thread(target=work, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def close(self):
+        """ Waits for the background work and stops the spares """
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        with self.lock:
+            while self.spares:
+                process = self.spares.popleft()
+                if process.poll() is None:
+                    self.halt(process)
@@ -43,6 +43,7 @@ setuptools.setup(
     keywords = 'qp qpcpp qtools qpc qutest',
     install_requires = ['pytest>=3.6.1'],
     entry_points = {
-        'console_scripts': ['qutest=qspypy.qutest:main', 'qutest_convert=qspypy.qutest_convert:main'],
+        'console_scripts': ['qutest=qspypy.qutest:main', 'qutest_convert=qspypy.qutest_convert:main',
+                            'qspypy_benchmark=qspypy.benchmark:main', 'qutest_shard=qspypy.qutest_shard:main'],
     }    
 )
\ No newline at end of file
@@ -0,0 +1,85 @@
+# MIT License
+#
+# Copyright (c) 2018 Lotus Engineering, LLC
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+#
+# expect() matchers compared with the original expect() line compare
+#
+
+import random
+
+from qspypy.qspy import qs_text_record, QSpyRecords
+from qspypy.qutest import compile_match, expect_matcher
+
+
+def original_matches(match, line):
+    """ The compare of the original qutest.expect() """
+    magic_string = '%timestamp'
+    if match.startswith(magic_string):
+        line_start = len(magic_string)
+    else:
+        line_start = 0
+    if match.endswith('*'):
+        line_end = match.find('*', line_start)
+        match = match.rstrip('*')
+    else:
+        line_end = len(match)
+    return match[line_start:] == line[line_start:line_end]
+
+
+def text(line):
+    return qs_text_record(bytes([0, QSpyRecords.QS_TEXT, QSpyRecords.QS_USER1]) + line.encode('utf-8'))
+
+
+def test_exact_and_glob():
+    assert compile_match('Trg-Ack  QS_RX_TICK').matches(text('Trg-Ack  QS_RX_TICK'))
+    assert not compile_match('Trg-Ack  QS_RX_TICK').matches(text('Trg-Ack  QS_RX_EVENT'))
+    assert compile_match('Trg-Ack*').matches(text('Trg-Ack  QS_RX_TICK'))
+    assert compile_match('%timestamp Trg-Ack*').matches(text('0000001234 Trg-Ack  QS_RX_TICK'))
+
+
+def test_non_ascii_timestamp():
+    # The timestamp is skipped by characters, not bytes
+    assert compile_match('%timestamp abc').matches(text('éééééééééé abc'))
+
+
+def test_empty_expected_on_short_line():
+    assert expect_matcher('%timestamp').matches(text('* '))
+    assert expect_matcher('%timestamp*').matches(text(''))
+
+
+def test_fuzz_against_original():
+    generator = random.Random(1234)
+    alphabet = 'ab *%é'
+
+    def random_text(length):
+        return ''.join(generator.choice(alphabet) for _ in range(generator.randrange(length)))
+
+    for _ in range(20000):
+        match = random_text(6)
+        if generator.random() < 0.5:
+            match = '%timestamp' + match
+        if generator.random() < 0.3:
+            match += '*'
+        line = random_text(16)
+        if generator.random() < 0.5 and not match.startswith('%timestamp'):
+            line = match.rstrip('*') + line
+        assert expect_matcher(match).matches(text(line)) == original_matches(match, line), (match, line)
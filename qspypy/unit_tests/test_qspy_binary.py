@@ -0,0 +1,134 @@
+# MIT License
+#
+# Copyright (c) 2018 Lotus Engineering, LLC
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+#
+# Binary channel record layouts, user record fields and theFmt tracking
+#
+
+from collections import namedtuple
+import struct
+
+import pytest
+
+from qspypy.qspy import QSpyRecords, theFmt, set_fmt
+from qspypy.qspy_binary import (qs_decoder, qs_unknown, decoder, formats_from_target_info,
+                                RECORD_LAYOUTS, USER_FMT)
+
+
+def packet(record, fmt, *values, tail=b''):
+    """ Builds a binary channel datagram with sequence number 7 """
+    return bytes([7, record]) + struct.pack('<' + fmt, *values) + tail
+
+
+@pytest.fixture
+def restore_fmt():
+    saved = dict(theFmt)
+    yield
+    theFmt.clear()
+    set_fmt(**saved)
+
+
+def test_fixed_layout():
+    record = decoder.decode(packet(QSpyRecords.QS_QEP_TRAN, 'IhIII', 10, 4, 0x2000, 0x100, 0x200))
+    assert record.record == QSpyRecords.QS_QEP_TRAN
+    assert record == (10, 4, 0x2000, 0x100, 0x200)
+    assert record.sig == 4
+    assert record.target == 0x200
+
+
+def test_active_post_byte_order():
+    # QActive_post_() of QP: time stamp, sender, signal, receiving AO, pool
+    # ID, reference count, free and minimum queue entries
+    data = bytes([7, QSpyRecords.QS_QF_ACTIVE_POST_FIFO,
+                  0x10, 0x00, 0x00, 0x00,
+                  0x00, 0x10, 0x00, 0x20,
+                  0x06, 0x00,
+                  0x40, 0x12, 0x00, 0x20,
+                  0x01, 0x00, 0x05, 0x03])
+    record = decoder.decode(data)
+    assert (record.tstamp, record.sender, record.sig, record.obj) == (0x10, 0x20001000, 6, 0x20001240)
+    assert (record.pool_id, record.ref_ctr, record.free, record.min) == (1, 0, 5, 3)
+
+
+def test_string_tail():
+    record = decoder.decode(packet(QSpyRecords.QS_OBJ_DICT, 'I', 0x2000, tail=b'l_blinky\0junk'))
+    assert record.obj == 0x2000
+    assert record.name == 'l_blinky'
+
+
+def test_bytes_tail():
+    record = decoder.decode(packet(QSpyRecords.QS_PEEK_DATA, 'IHBB', 1, 2, 1, 3, tail=b'\1\2\3'))
+    assert (record.offset, record.size, record.num) == (2, 1, 3)
+    assert record.data == b'\1\2\3'
+
+
+def test_text_record():
+    record = decoder.decode(bytes([7, QSpyRecords.QS_TEXT, 70]) + 'héllo'.encode('utf-8'))
+    assert record.rec == 70
+    assert record.line == 'héllo'
+
+
+def test_user_record_fields():
+    data = (bytes([USER_FMT.U8, 200, USER_FMT.I16]) + struct.pack('<h', -3)
+            + bytes([USER_FMT.STR]) + b'abc\0'
+            + bytes([USER_FMT.MEM, 2, 9, 8])
+            + bytes([USER_FMT.SIG]) + struct.pack('<hI', 5, 0x2000)
+            + bytes([USER_FMT.F64]) + struct.pack('<d', 0.5))
+    record = decoder.decode(packet(QSpyRecords.QS_USER1, 'I', 99, tail=data))
+    assert record.tstamp == 99
+    assert decoder.user_fields(record.data) == [
+        (USER_FMT.U8, 200), (USER_FMT.I16, -3), (USER_FMT.STR, 'abc'),
+        (USER_FMT.MEM, b'\x09\x08'), (USER_FMT.SIG, (5, 0x2000)), (USER_FMT.F64, 0.5)]
+
+
+def test_unknown_record():
+    assert decoder.decode(bytes([7, 200, 1, 2])) == qs_unknown(200, b'\1\2')
+
+
+def test_every_layout_compiles():
+    for record, (fields, tail) in RECORD_LAYOUTS.items():
+        entry = decoder.table[record.value]
+        assert entry[1]._fields == tuple(name for name, _ in fields) + ((tail[0],) if tail else ())
+
+
+def test_own_formats():
+    wide = qs_decoder(dict(theFmt, objPtr='Q'))
+    record = wide.decode(packet(QSpyRecords.QS_OBJ_DICT, 'Q', 1 << 40, tail=b'big\0'))
+    assert record.obj == 1 << 40
+    assert not wide.follows_fmt
+
+
+def test_set_fmt_refreshes_decoder(restore_fmt):
+    set_fmt(objPtr='Q', funPtr='Q')
+    record = decoder.decode(packet(QSpyRecords.QS_QEP_STATE_ENTRY, 'QQ', 1 << 40, 1 << 41))
+    assert (record.obj, record.state) == (1 << 40, 1 << 41)
+
+
+def test_formats_from_target_info():
+    info = namedtuple('info', ['sig_evt_size', 'eqc_mpc_size', 'mps_obj_size',
+                               'fun_tstamp_size', 'tec_size'])
+    formats = formats_from_target_info(info(0x22, 0x21, 0x82, 0x48, 0x02))
+    assert formats == {'objPtr': 'Q', 'funPtr': 'Q', 'tstamp': 'I', 'sig': 'H',
+                       'evtSize': 'H', 'queueCtr': 'B', 'poolCtr': 'H',
+                       'poolBlk': 'H', 'tevtCtr': 'H'}
+    assert set(formats) == set(theFmt)
@@ -0,0 +1,141 @@
+# MIT License
+#
+# Copyright (c) 2018 Lotus Engineering, LLC
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+#
+# Dictionary parsing, target build keys and the per build cache
+#
+
+import struct
+
+import pytest
+
+from qspypy.qspy import QSpyRecords
+from qspypy.qspy_dict import qs_dictionary, target_key
+from qspypy.qutest import qutest_context
+
+
+def target_info(version=0x0690, second=5, day=17):
+    """ Builds a QS_TARGET_INFO packet for a build made at 12:34:<second> on 2026-10-<day> """
+    return bytes([1, QSpyRecords.QS_TARGET_INFO]) + struct.pack(
+        '<BH13B', 0xFF, version, 0x22, 0x21, 0x42, 0x44, 0x02, 16, 0x11,
+        second, 34, 12, day, 10, 26)
+
+
+def dict_record(record, fmt, *values, name):
+    """ Builds a binary channel dictionary record with the default theFmt """
+    return bytes([1, record]) + struct.pack('<' + fmt, *values) + name.encode('utf-8') + b'\0'
+
+
+def test_add_packet():
+    index = qs_dictionary()
+    index.add_packet(dict_record(QSpyRecords.QS_OBJ_DICT, 'I', 0x20001000, name='l_blinky'))
+    index.add_packet(dict_record(QSpyRecords.QS_FUN_DICT, 'I', 0x1A2C, name='Blinky_off'))
+    index.add_packet(dict_record(QSpyRecords.QS_SIG_DICT, 'hI', 4, 0, name='TIMEOUT_SIG'))
+    index.add_packet(dict_record(QSpyRecords.QS_SIG_DICT, 'hI', 5, 0x20001000, name='LOCAL_SIG'))
+    index.add_packet(dict_record(QSpyRecords.QS_USR_DICT, 'B', 70, name='ON_CONTEXT'))
+    assert index.object('l_blinky') == 0x20001000
+    assert index.function('Blinky_off') == 0x1A2C
+    assert index.signal('TIMEOUT_SIG') == 4
+    assert index.signal('LOCAL_SIG', 0x20001000) == 5
+    assert index.user('ON_CONTEXT') == 70
+    assert len(index) == 5
+
+
+def test_text_lines_ignored():
+    index = qs_dictionary()
+    index.add_packet(bytes([1, QSpyRecords.QS_TEXT, QSpyRecords.QS_OBJ_DICT])
+                     + b'           Obj-Dict 0x20001000->l_blinky')
+    assert len(index) == 0
+
+
+def test_signal_lookup():
+    index = qs_dictionary()
+    index.add_signal('A_SIG', 7, 0x100)
+    index.add_signal('A_SIG', 8, 0x200)
+    assert index.signal('A_SIG') is None
+    assert index.signal('A_SIG', 0x200) == 8
+    index.add_signal('A_SIG', 9)
+    assert index.signal('A_SIG') == 9
+    assert index.signal('B_SIG') is None
+
+
+def test_target_key():
+    assert target_key(target_info()) == '0690_261017_123405'
+    assert target_key(target_info(second=6)) != target_key(target_info())
+    assert target_key(bytes([1, QSpyRecords.QS_TARGET_INFO, 0])) is None
+
+
+def test_cache_loaded_by_target(tmp_path):
+    index = qs_dictionary(str(tmp_path))
+    index.set_target(target_key(target_info()))
+    index.add_packet(dict_record(QSpyRecords.QS_OBJ_DICT, 'I', 0x20001000, name='l_blinky'))
+    index.add_packet(dict_record(QSpyRecords.QS_SIG_DICT, 'hI', 5, 0x20001000, name='LOCAL_SIG'))
+    index.save_cache()
+
+    later = qs_dictionary(str(tmp_path))
+    assert len(later) == 0
+    later.set_target(target_key(target_info()))
+    assert later.object('l_blinky') == 0x20001000
+    assert later.signal('LOCAL_SIG', 0x20001000) == 5
+
+
+def test_cache_of_other_build_not_used(tmp_path):
+    index = qs_dictionary(str(tmp_path))
+    index.set_target(target_key(target_info()))
+    index.add_packet(dict_record(QSpyRecords.QS_OBJ_DICT, 'I', 0x20001000, name='l_blinky'))
+
+    # Switching builds saves the old entries and starts empty
+    index.set_target(target_key(target_info(day=18)))
+    assert len(index) == 0
+    index.set_target(target_key(target_info()))
+    assert index.object('l_blinky') == 0x20001000
+
+
+@pytest.mark.parametrize('content', ['{"target": "x"}', '[1, 2]', '{"signals": []}',
+                                     '{"signals": {"A_SIG": {"zero": 1}}}', 'not json'])
+def test_corrupt_cache(tmp_path, content):
+    index = qs_dictionary(str(tmp_path))
+    key = target_key(target_info())
+    with open(index.cache_path(key), 'w') as cache:
+        cache.write(content)
+    assert not index.load_cache(key)
+    index.set_target(key)
+    assert len(index) == 0
+
+
+def test_no_cache_dir():
+    index = qs_dictionary()
+    index.set_target(target_key(target_info()))
+    index.add_packet(dict_record(QSpyRecords.QS_OBJ_DICT, 'I', 0x20001000, name='l_blinky'))
+    index.save_cache()
+    assert not index.load_cache(index.target)
+
+
+def test_target_info_on_both_channels():
+    context = qutest_context()
+    context.OnRecord_QS_TARGET_INFO(target_info())
+    # The binary channel copy right behind it is not a reset
+    context.OnRecord_QS_TARGET_INFO(bytes([2]) + target_info()[1:])
+    assert context.target_fault is None
+    context.OnRecord_QS_TARGET_INFO(bytes([9]) + target_info()[1:])
+    assert context.target_fault == 'Target reset unexpectedly'
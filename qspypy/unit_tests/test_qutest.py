@@ -0,0 +1,257 @@
+# MIT License
+#
+# Copyright (c) 2018 Lotus Engineering, LLC
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+#
+# qutest_context command acks, pipelining and target faults against the
+# local QSPY stand-in
+#
+
+import threading
+import time
+
+import pytest
+
+from qspypy.benchmark import qspy_stand_in
+from qspypy.config import qutest_config
+from qspypy.qspy import QSpyRecords, qs_text_record
+from qspypy.qutest import qutest_context
+
+
+class scripted_stand_in(qspy_stand_in):
+    """ Stand-in whose acks can be delayed, dropped or replaced """
+
+    def __init__(self):
+        super().__init__()
+        self.ack_delay = 0.0
+        # Trg-Ack name -> line sent instead of the ack, None drops the ack
+        self.replies = {}
+
+    def sendAck(self, name):
+        if self.ack_delay:
+            time.sleep(self.ack_delay)
+        if name in self.replies:
+            line = self.replies.pop(name)
+            if line is not None:
+                self.sendText(QSpyRecords.QS_RX_STATUS, line)
+            return
+        super().sendAck(name)
+
+
+@pytest.fixture
+def stand_in():
+    stand_in = scripted_stand_in()
+    stand_in.start()
+    yield stand_in
+    stand_in.close()
+
+
+@pytest.fixture
+def context(stand_in):
+    context = qutest_context(qutest_config(
+        AUTOSTART_QSPY=False, USE_LOCAL_TARGET=False, QSPY_HOST='127.0.0.1',
+        QSPY_UDP_PORT=stand_in.port, QSPY_LOCAL_UDP_PORT=None, CACHE_DIR=None,
+        EXPECT_TIMEOUT_SEC=0.200, PIPELINE_COMMANDS=False, LOCAL_DICTIONARY=False))
+    context.session_setup()
+    context.reset_target()
+    yield context
+    context.session_teardown()
+
+
+def test_lock_step(context):
+    context.tick()
+    context.command(1, 2, 3)
+    assert context.text_queue.empty()
+
+
+def test_pipeline_in_order(context):
+    with context.pipeline():
+        for _ in range(20):
+            context.tick()
+        context.command(1, 2, 3)
+        context.fill(0, 4, 2, 0xFF)
+    assert not context.ack_pending
+    # The acks were matched, none of them is left for expect()
+    assert context.text_queue.empty()
+
+
+def test_pipeline_wrong_ack(context, stand_in):
+    stand_in.replies['QS_RX_TICK'] = '           Trg-Ack  QS_RX_COMMAND'
+    with pytest.raises(pytest.fail.Exception, match=r'Ack Failed for command tick\(0\)'):
+        with context.pipeline():
+            context.tick()
+            context.command(1, 2, 3)
+    assert not context.ack_pending
+
+
+def test_pipeline_error_ack(context, stand_in):
+    stand_in.replies['QS_RX_COMMAND'] = '           Trg-ERR  QS_RX_COMMAND'
+    with pytest.raises(pytest.fail.Exception,
+                       match=r'command\(7, 0, 0, 0\)! \nExpected:"Trg-Ack  QS_RX_COMMAND"\nReceived:"Trg-ERR'):
+        with context.pipeline():
+            context.tick()
+            context.command(7)
+
+
+def test_pipeline_missing_ack(context, stand_in):
+    stand_in.replies['QS_RX_TICK'] = None
+    with pytest.raises(pytest.fail.Exception, match=r'Ack Timeout for command tick\(1\) \(1 still pending\)'):
+        with context.pipeline():
+            context.tick(1)
+
+
+def test_pipeline_send_error(context):
+    with context.pipeline():
+        with pytest.raises(AssertionError):
+            context.fill(0, 3, 1)
+        # The command that was never sent is not waited for
+        assert not context.ack_pending
+        context.tick()
+
+
+def test_expect_nothing():
+    context = qutest_context()
+    context.expect_sequence([])
+    context.expect_unordered(set())
+
+
+def queue_lines(context, *lines):
+    """ Puts text lines into the text queue as the receive thread would """
+    for line in lines:
+        context.text_queue.put(qs_text_record(bytes([0, QSpyRecords.QS_TEXT, QSpyRecords.QS_USER1])
+                                              + line.encode('utf-8')))
+
+
+def test_expect_unordered_overlapping_globs():
+    context = qutest_context(qutest_config(EXPECT_TIMEOUT_SEC=0.050))
+    queue_lines(context, '0000000001 AO-Post Obj=A,Sig=X', '0000000002 AO-Post Obj=B,Sig=X')
+    context.expect_unordered(['%timestamp AO-Post *', '%timestamp AO-Post Obj=A,*'])
+    assert context.text_queue.empty()
+
+
+def test_expect_window_reassigns():
+    context = qutest_context(qutest_config(EXPECT_TIMEOUT_SEC=0.050))
+    # The glob takes the first line, which has to move to the exact match
+    queue_lines(context, 'A B', 'A', 'C')
+    context.expect_window(['A*', 'A B', 'C'], 2)
+
+
+def test_expect_window_bound():
+    context = qutest_context(qutest_config(EXPECT_TIMEOUT_SEC=0.050))
+    # C is three places early, more than a window of 2 allows
+    queue_lines(context, 'C', 'A', 'B')
+    with pytest.raises(pytest.fail.Exception, match='Expect Match Failed at line 1 of 3'):
+        context.expect_window(['A', 'B', 'C'], 2)
+
+
+def test_expect_unordered_mismatch():
+    context = qutest_context(qutest_config(EXPECT_TIMEOUT_SEC=0.050))
+    queue_lines(context, 'A 1', 'A 2')
+    with pytest.raises(pytest.fail.Exception, match='(?s)at line 2 of 2.*Matched before:\n  1: "A"'):
+        context.expect_unordered(['A*', 'B*'])
+
+
+def test_expect_sequence_timeout():
+    context = qutest_context(qutest_config(EXPECT_TIMEOUT_SEC=0.050))
+    queue_lines(context, 'A')
+    with pytest.raises(pytest.fail.Exception, match='Expect Timeout at line 2 of 2 for match:"B"'):
+        context.expect_sequence(['A', 'B'])
+
+
+ASSERT_LINE = '0000000100 =ASSERT= Mod=qf_actq,Loc=110'
+
+
+def test_expected_assertion(context, stand_in):
+    stand_in.ack_delay = 0.005
+    context.call_on_setup()
+    context.command(1)
+    stand_in.sendText(QSpyRecords.QS_ASSERT_FAIL, ASSERT_LINE)
+    context.expect('%timestamp =ASSERT= Mod=qf_actq,Loc=110')
+    assert context.target_fault is None
+    context.call_on_teardown()
+    # A qutest_noreset test after it goes on as well
+    context.call_on_setup()
+    context.tick()
+
+
+def test_unexpected_assertion(context, stand_in):
+    stand_in.ack_delay = 0.005
+    context.call_on_setup()
+    stand_in.sendText(QSpyRecords.QS_ASSERT_FAIL, ASSERT_LINE)
+    with pytest.raises(pytest.fail.Exception, match='Expect Match Failed'):
+        context.expect('%timestamp BSP_LED_ON')
+
+    # Later waits fail at once instead of timing out
+    start = time.monotonic()
+    with pytest.raises(pytest.fail.Exception,
+                       match='Target assertion failed "{0}", no more lines for match:'
+                             '"           Trg-Ack  QS_RX_TEST_TEARDOWN"'.format(ASSERT_LINE)):
+        context.call_on_teardown()
+    with pytest.raises(pytest.fail.Exception, match=r'no ack for command tick\(0\)'):
+        with context.pipeline():
+            context.tick()
+    assert time.monotonic() - start < context.config.EXPECT_TIMEOUT_SEC
+
+    # Until the next reset, which flushes the acks still on their way
+    time.sleep(0.050)
+    context.reset_target()
+    context.call_on_setup()
+    context.call_on_teardown()
+
+
+def adaptive_context(waits):
+    """ Context with adaptive timeouts learnt from waits {match: seconds} """
+    context = qutest_context(qutest_config(ADAPTIVE_EXPECT_TIMEOUT=True, EXPECT_TIMEOUT_SEC=1.0,
+                                           EXPECT_TIMEOUT_MARGIN_SEC=0.050, CACHE_DIR=None))
+    for match, seconds in waits.items():
+        for _ in range(50):
+            context.latency.record(match, seconds)
+    return context
+
+
+def send_lines_later(context, lines, interval):
+    def send():
+        for line in lines:
+            time.sleep(interval)
+            queue_lines(context, line)
+    sender = threading.Thread(target=send)
+    sender.start()
+    return sender
+
+
+def test_expect_sequence_adaptive_deadline():
+    matches = ['L1', 'L2', 'L3', 'L4']
+    context = adaptive_context({match: 0.0 for match in matches})
+    # Every line is on time for its own 50 ms, the block takes longer than one line's
+    sender = send_lines_later(context, matches, 0.030)
+    try:
+        context.expect_sequence(matches)
+    finally:
+        sender.join()
+
+
+def test_expect_sequence_adaptive_timeout():
+    matches = ['L1', 'L2', 'L3', 'L4']
+    context = adaptive_context({match: 0.0 for match in matches})
+    queue_lines(context, 'L1', 'L2', 'L3')
+    with pytest.raises(pytest.fail.Exception, match=r'line 4 of 4 for match:"L4" \(adaptive timeout 0.200s\)'):
+        context.expect_sequence(matches)
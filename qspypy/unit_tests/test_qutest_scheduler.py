@@ -0,0 +1,145 @@
+# MIT License
+#
+# Copyright (c) 2018 Lotus Engineering, LLC
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+#
+# Chain ordering and reset skipping of the qutest reset scheduler
+#
+
+import json
+
+import pytest
+
+from qspypy.qutest_scheduler import reset_scheduler, SCHEDULE_FILE
+
+
+class fake_item():
+    """ Stands in for a collected pytest item """
+
+    def __init__(self, nodeid, fixture=None, module='test_a'):
+        self.nodeid = nodeid
+        self.fixturenames = ('qutest_session', fixture) if fixture else ()
+        self.module = module
+
+    def __repr__(self):
+        return self.nodeid
+
+
+class fake_context():
+    """ Stands in for the qutest_context the scheduler resets """
+
+    def __init__(self, clean):
+        self.target_clean = clean
+        self.on_reset_callback = None
+        self.clean_on_reset = None
+        self.resets = 0
+
+    def call_on_reset(self):
+        self.resets += 1
+
+
+def scheduler_with(history):
+    scheduler = reset_scheduler()
+    scheduler.history = history
+    return scheduler
+
+
+@pytest.fixture
+def minimize_resets(monkeypatch, tmp_path):
+    """ Enables the scheduler with the cache directory in tmp_path """
+    monkeypatch.setenv('QSPYPY_MINIMIZE_RESETS', 'True')
+    monkeypatch.setenv('QSPYPY_RESET_TARGET_ON_SETUP', 'True')
+    monkeypatch.setenv('QSPYPY_CACHE_DIR', str(tmp_path))
+    return tmp_path
+
+
+@pytest.mark.parametrize('history, expected', [
+    ({'a': {'clean': True, 'reset_output': True}}, 0),
+    ({'a': {'clean': True, 'reset_output': False}}, 1),
+    ({'a': {'clean': False, 'reset_output': False}}, 2),
+    ({'a': {'clean': False, 'reset_output': True}}, 3),
+    ({}, 3),
+])
+def test_chain_order(history, expected):
+    scheduler = scheduler_with(history)
+    chain = [fake_item('a', 'qutest')]
+    scheduler.target_tests = {'a'}
+    assert scheduler.chain_order(chain) == expected
+
+
+def test_chain_order_dirty_follower():
+    scheduler = scheduler_with({'a': {'clean': True, 'reset_output': False},
+                                'b': {'clean': False, 'reset_output': False}})
+    scheduler.target_tests = {'a', 'b', 'c'}
+    chain = [fake_item('a', 'qutest'), fake_item('b', 'qutest_noreset'), fake_item('c')]
+    assert scheduler.chain_order(chain) == 2
+    # Tests that do not use the target do not count
+    scheduler.target_tests = {'a'}
+    assert scheduler.chain_order(chain) == 1
+
+
+def test_chain_order_before_first_reset():
+    assert reset_scheduler().chain_order([fake_item('a', 'qutest_noreset')]) == -1
+
+
+def test_collection_reorders_chains(minimize_resets):
+    history = {'dirty': {'clean': False, 'reset_output': True},
+               'clean': {'clean': True, 'reset_output': False},
+               'clean_next': {'clean': True, 'reset_output': False},
+               'other': {'clean': False, 'reset_output': True}}
+    with open(str(minimize_resets / SCHEDULE_FILE), 'w') as cache:
+        json.dump({'tests': history}, cache)
+
+    items = [fake_item('setup'),
+             fake_item('dirty', 'qutest'), fake_item('dirty_next', 'qutest_noreset'),
+             fake_item('clean', 'qutest'), fake_item('clean_next', 'qutest_noreset'),
+             fake_item('other', 'qutest', module='test_b'), fake_item('new', 'qutest', module='test_b')]
+    scheduler = reset_scheduler()
+    scheduler.pytest_collection_modifyitems(None, None, items)
+
+    assert [item.nodeid for item in items] == ['setup', 'clean', 'clean_next', 'dirty', 'dirty_next',
+                                               'other', 'new']
+    assert (scheduler.chains, scheduler.moved) == (5, 2)
+    assert 'setup' not in scheduler.target_tests
+
+
+def test_collection_disabled(monkeypatch):
+    monkeypatch.setenv('QSPYPY_MINIMIZE_RESETS', 'False')
+    items = [fake_item('b', 'qutest'), fake_item('a', 'qutest')]
+    scheduler = scheduler_with({'a': {'clean': True, 'reset_output': False}})
+    scheduler.pytest_collection_modifyitems(None, None, items)
+    assert [item.nodeid for item in items] == ['b', 'a']
+    assert not scheduler.enabled
+
+
+@pytest.mark.parametrize('clean, history, resets', [
+    (True, {'a': {'clean': True, 'reset_output': False}}, 0),
+    (True, {'a': {'clean': True, 'reset_output': True}}, 1),
+    (False, {'a': {'clean': True, 'reset_output': False}}, 1),
+    (True, {}, 1),
+])
+def test_reset(clean, history, resets):
+    scheduler = scheduler_with(history)
+    context = fake_context(clean)
+    scheduler.reset(context, fake_item('a', 'qutest'))
+    assert context.resets == resets
+    assert (scheduler.resets, scheduler.skipped) == (resets, 1 - resets)
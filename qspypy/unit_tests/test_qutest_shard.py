@@ -0,0 +1,150 @@
+# MIT License
+#
+# Copyright (c) 2018 Lotus Engineering, LLC
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+#
+# Shard balancing, worker environments and junit merging of qutest_shard
+#
+
+import argparse
+import os
+import xml.etree.ElementTree as ElementTree
+
+import pytest
+
+import qspypy.config as CONFIG
+from qspypy.qutest_shard import (shard_durations, balance, worker_environment, file_durations,
+                                 merge_junit, DEFAULT_DURATION_SEC)
+
+
+def worker_args(**values):
+    args = {'udp_port': 7701, 'tcp_port': 6601, 'qspy': None, 'com_ports': None,
+            'host_exe': 'build/dpp'}
+    args.update(values)
+    return argparse.Namespace(**args)
+
+
+def write_junit(path, *suites):
+    """ Writes a junit file with suites of (name, [(classname, time, outcome)]) """
+    root = ElementTree.Element('testsuites')
+    for name, cases in suites:
+        suite = ElementTree.SubElement(root, 'testsuite', name=name, tests=str(len(cases)),
+                                       failures=str(sum(1 for _, _, outcome in cases
+                                                        if outcome == 'failure')),
+                                       errors='0', skipped='0')
+        for index, (classname, time, outcome) in enumerate(cases):
+            case = ElementTree.SubElement(suite, 'testcase', classname=classname,
+                                          name='test_{0}'.format(index), time=str(time))
+            if outcome is not None:
+                ElementTree.SubElement(case, outcome)
+    ElementTree.ElementTree(root).write(str(path))
+
+
+def test_estimate():
+    durations = shard_durations()
+    assert durations.estimate('test_a.py') == DEFAULT_DURATION_SEC
+    durations.update('test_a.py', 2.0)
+    durations.update('test_b.py', 4.0)
+    assert durations.estimate('test_a.py') == 2.0
+    assert durations.estimate('test_new.py') == 3.0
+
+
+def test_durations_cache(tmp_path):
+    durations = shard_durations(str(tmp_path))
+    assert not durations.load()
+    durations.update('test_a.py', 2.0)
+    durations.save()
+
+    later = shard_durations(str(tmp_path))
+    assert later.load()
+    assert later.estimate('test_a.py') == 2.0
+
+
+def test_balance():
+    durations = shard_durations()
+    for test_file, seconds in (('a.py', 7.0), ('b.py', 5.0), ('c.py', 4.0),
+                               ('d.py', 3.0), ('e.py', 1.0)):
+        durations.update(test_file, seconds)
+    shards = balance(['e.py', 'd.py', 'c.py', 'b.py', 'a.py'], durations, 2)
+    assert shards == [(10.0, ['a.py', 'd.py']), (10.0, ['b.py', 'c.py', 'e.py'])]
+
+
+def test_balance_more_workers_than_files():
+    shards = balance(['a.py', 'b.py'], shard_durations(), 4)
+    assert [files for _, files in shards] == [['a.py'], ['b.py']]
+
+
+def test_worker_environment_local_target(monkeypatch):
+    monkeypatch.setattr(CONFIG, 'CACHE_DIR', None)
+    monkeypatch.setattr(CONFIG, 'QSPY_LOCAL_UDP_PORT', None)
+    environment = worker_environment(1, worker_args())
+    assert environment['QSPYPY_QSPY_UDP_PORT'] == '7702'
+    assert environment['QSPYPY_QSPY_TCP_PORT'] == '6602'
+    assert environment['QSPYPY_LOCAL_TARGET_QSPY_HOST'] == 'localhost:6602'
+    assert environment['QSPYPY_LOCAL_TARGET_EXECUTABLE'] == 'build/dpp'
+    assert environment['QSPYPY_CACHE_DIR'] == 'None'
+    assert 'QSPYPY_QSPY_LOCAL_UDP_PORT' not in environment
+
+
+def test_worker_environment_cache_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(CONFIG, 'CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(CONFIG, 'QSPY_LOCAL_UDP_PORT', 7800)
+    first = worker_environment(0, worker_args())
+    second = worker_environment(1, worker_args())
+    assert first['QSPYPY_CACHE_DIR'] != second['QSPYPY_CACHE_DIR']
+    assert second['QSPYPY_CACHE_DIR'] == os.path.join(str(tmp_path), 'worker1')
+    assert (first['QSPYPY_QSPY_LOCAL_UDP_PORT'], second['QSPYPY_QSPY_LOCAL_UDP_PORT']) == ('7800', '7801')
+
+
+@pytest.mark.parametrize('args, expected', [
+    (worker_args(qspy=['10.0.0.1:7000', '10.0.0.2']),
+     {'QSPYPY_QSPY_HOST': '10.0.0.2', 'QSPYPY_QSPY_UDP_PORT': str(CONFIG.QSPY_UDP_PORT),
+      'QSPYPY_AUTOSTART_QSPY': 'False'}),
+    (worker_args(com_ports=['COM3', 'COM4']),
+     {'QSPYPY_QSPY_COM_PORT': 'COM4', 'QSPYPY_USE_LOCAL_TARGET': 'False',
+      'QSPYPY_AUTOSTART_QSPY': 'True'}),
+])
+def test_worker_environment_targets(args, expected):
+    environment = worker_environment(1, args)
+    assert {name: environment[name] for name in expected} == expected
+
+
+def test_file_durations(tmp_path):
+    junit_path = tmp_path / 'worker0.xml'
+    write_junit(junit_path, ('pytest', [('tests.test_dpp', 1.5, None),
+                                        ('tests.test_dpp', 0.5, 'failure'),
+                                        ('tests.test_dpp_table', 2.0, None),
+                                        ('other.test_x', 9.0, None)]))
+    test_files = [os.path.join('tests', 'test_dpp.py'), os.path.join('tests', 'test_dpp_table.py')]
+    assert file_durations(str(junit_path), test_files) == {test_files[0]: 2.0, test_files[1]: 2.0}
+
+
+def test_merge_junit(tmp_path):
+    write_junit(tmp_path / 'worker0.xml', ('pytest', [('tests.test_a', 1.0, None),
+                                                      ('tests.test_a', 1.0, 'failure')]))
+    write_junit(tmp_path / 'worker1.xml', ('pytest', [('tests.test_b', 1.0, None)]))
+    output_path = tmp_path / 'merged.xml'
+    totals = merge_junit([str(tmp_path / 'worker0.xml'), str(tmp_path / 'worker1.xml')],
+                         str(output_path))
+    assert totals == {'tests': 3, 'failures': 1, 'errors': 0, 'skipped': 0}
+    names = [suite.get('name') for suite in ElementTree.parse(str(output_path)).iter('testsuite')]
+    assert names == ['pytest (worker 0)', 'pytest (worker 1)']
@@ -0,0 +1,155 @@
+# MIT License
+#
+# Copyright (c) 2018 Lotus Engineering, LLC
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+#
+# The qspy and qspy_async receive paths against the local QSPY stand-in
+#
+
+import asyncio
+import socket
+import threading
+
+import pytest
+
+from qspypy.benchmark import qspy_stand_in, record_counter
+from qspypy.qspy import qspy, QSPY, QSpyRecords
+from qspypy.qspy_async import qspy_async
+
+
+# Seconds to wait for anything the stand-in sends
+WAIT_SEC = 5.0
+
+
+class line_collector(record_counter):
+    """ Keeps the received text lines and signals once count of them arrived """
+
+    def __init__(self, count):
+        super().__init__()
+        self.lines = []
+        self.attached = threading.Event()
+        self.target_info = threading.Event()
+        self.expected = count
+        self.done = threading.Event()
+
+    def OnPacket_ATTACH(self, packet):
+        self.attached.set()
+
+    def OnRecord_QS_TEXT(self, packet):
+        self.lines.append(bytes(packet[3:]))
+        self.check()
+
+    def OnRecord_QS_TARGET_INFO(self, packet):
+        self.target_info.set()
+
+    def OnBatch(self, packets):
+        for packet in packets:
+            if packet[1] == QSpyRecords.QS_TEXT:
+                self.lines.append(bytes(packet[3:]))
+            elif packet[1] == QSpyRecords.QS_TARGET_INFO:
+                self.target_info.set()
+            elif packet[1] == QSPY.ATTACH:
+                self.attached.set()
+        self.check()
+
+    def check(self):
+        self.count = len(self.lines)
+        if self.count >= self.expected:
+            self.done.set()
+
+
+@pytest.fixture
+def stand_in():
+    stand_in = qspy_stand_in()
+    stand_in.start()
+    yield stand_in
+    stand_in.close()
+
+
+@pytest.mark.parametrize('zero_copy, batch', [(False, False), (True, False),
+                                              (False, True), (True, True)])
+def test_receive_modes(stand_in, zero_copy, batch):
+    collector = line_collector(300)
+    link = qspy()
+    link.attach(collector, host='127.0.0.1', port=stand_in.port, zero_copy=zero_copy, batch=batch)
+    try:
+        # The stand-in only knows where to send once the ATTACH is in
+        assert collector.attached.wait(WAIT_SEC)
+        stand_in.flood(300, line='0000000001 line', progress=lambda: collector.count)
+        assert collector.done.wait(WAIT_SEC)
+        assert collector.lines == [b'0000000001 line'] * 300
+
+        link.sendReset()
+        assert collector.target_info.wait(WAIT_SEC)
+    finally:
+        confirmed = link.detach(confirm_timeout=WAIT_SEC)
+    assert confirmed
+    assert not link.is_alive()
+
+
+def test_detach_not_answered():
+    # Nothing listens on this socket, so the DETACH is never answered
+    silent = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    silent.bind(('127.0.0.1', 0))
+    link = qspy()
+    link.attach(record_counter(), host='127.0.0.1', port=silent.getsockname()[1], batch=True)
+    try:
+        assert link.detach(confirm_timeout=0.1) is False
+        assert not link.is_alive()
+    finally:
+        silent.close()
+
+
+def test_async_iteration(stand_in):
+    async def run():
+        link = qspy_async()
+        await link.attach(host='127.0.0.1', port=stand_in.port, timeout=WAIT_SEC)
+        stand_in.sendText(QSpyRecords.QS_USER1, 'first')
+        stand_in.sendText(QSpyRecords.QS_USER1, 'second')
+        lines = []
+        async for packet in link:
+            if packet[1] == QSpyRecords.QS_TEXT:
+                lines.append(packet[3:])
+            if len(lines) == 2:
+                break
+        link.detach()
+        return lines
+
+    lines = asyncio.run(asyncio.wait_for(run(), WAIT_SEC))
+    assert lines == [b'first', b'second']
+
+
+def test_async_attach_timeout():
+    silent = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    silent.bind(('127.0.0.1', 0))
+
+    async def run():
+        link = qspy_async()
+        with pytest.raises(asyncio.TimeoutError):
+            await link.attach(host='127.0.0.1', port=silent.getsockname()[1], timeout=0.1)
+        return link
+
+    try:
+        link = asyncio.run(run())
+        assert link.transport is None
+    finally:
+        silent.close()
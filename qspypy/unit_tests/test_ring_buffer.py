@@ -0,0 +1,119 @@
+# MIT License
+#
+# Copyright (c) 2018 Lotus Engineering, LLC
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+#
+# ring_buffer overflow policies, batch puts and consumer wakeups
+#
+
+from queue import Empty
+import threading
+import time
+
+import pytest
+
+from qspypy.ring_buffer import ring_buffer, DROP_OLDEST, DROP_NEWEST
+
+
+def test_put_drop_oldest():
+    buffer = ring_buffer(3, DROP_OLDEST)
+    for item in range(5):
+        assert buffer.put(item)
+    assert buffer.get_all() == [2, 3, 4]
+    assert buffer.dropped == 2
+
+
+def test_put_drop_newest():
+    buffer = ring_buffer(3, DROP_NEWEST)
+    results = [buffer.put(item) for item in range(5)]
+    assert results == [True, True, True, False, False]
+    assert buffer.get_all() == [0, 1, 2]
+    assert buffer.dropped == 2
+
+
+@pytest.mark.parametrize('overflow, kept', [(DROP_OLDEST, [3, 4, 5, 6]), (DROP_NEWEST, [0, 1, 2, 3])])
+def test_put_many_overflow(overflow, kept):
+    buffer = ring_buffer(4, overflow)
+    buffer.put_many([0, 1])
+    buffer.put_many([2, 3, 4, 5, 6])
+    assert buffer.get_all() == kept
+    assert buffer.dropped == 3
+
+
+@pytest.mark.parametrize('overflow, kept', [(DROP_OLDEST, [7, 8, 9]), (DROP_NEWEST, [0, 1, 2])])
+def test_put_many_larger_than_capacity(overflow, kept):
+    buffer = ring_buffer(3, overflow)
+    buffer.put_many(list(range(10)))
+    assert buffer.get_all() == kept
+    assert buffer.dropped == 7
+
+
+def test_get_many():
+    buffer = ring_buffer(10)
+    buffer.put_many([0, 1, 2])
+    assert buffer.get_many(2) == [0, 1]
+    assert buffer.get_many(5) == [2]
+    assert buffer.get_many(1) == []
+    assert buffer.empty() and len(buffer) == 0
+
+
+def test_get_timeout():
+    buffer = ring_buffer(10)
+    start = time.monotonic()
+    with pytest.raises(Empty):
+        buffer.get(timeout=0.05)
+    assert time.monotonic() - start >= 0.05
+
+
+def test_get_woken_by_producer():
+    buffer = ring_buffer(10)
+    timer = threading.Timer(0.05, buffer.put_many, args=([1, 2],))
+    timer.start()
+    assert buffer.get(timeout=2.0) == 1
+    assert buffer.get(timeout=0) == 2
+    timer.join()
+
+
+def test_interrupt():
+    buffer = ring_buffer(10)
+    buffer.put(1)
+    buffer.interrupt()
+    # Items already received are still handed out
+    assert buffer.get(timeout=2.0) == 1
+    start = time.monotonic()
+    with pytest.raises(Empty):
+        buffer.get(timeout=2.0)
+    assert time.monotonic() - start < 1.0
+
+    buffer.clear_interrupt()
+    with pytest.raises(Empty):
+        buffer.get(timeout=0.01)
+
+
+def test_interrupt_wakes_waiting_get():
+    buffer = ring_buffer(10)
+    timer = threading.Timer(0.05, buffer.interrupt)
+    timer.start()
+    start = time.monotonic()
+    with pytest.raises(Empty):
+        buffer.get(timeout=2.0)
+    assert time.monotonic() - start < 1.0
+    timer.join()